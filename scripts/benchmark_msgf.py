@@ -0,0 +1,216 @@
+"""
+Benchmark the MS-GF+ search time of a fixed mzML/FASTA pair across Java heap sizes
+and search thread counts, to choose msgf_ncpu, msgf_ramGB, msgf_heap_headroom_mb and
+msgf_threads.
+
+The searches run either with a local MSGFPlus.jar or inside the msgf docker image
+(the same one the workflow uses). The FASTA must be indexed already (BuildSA files
+next to it), otherwise the first run also builds the index.
+"""
+
+import argparse
+import csv
+import itertools
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import profiling
+
+
+def search_command(args, heap_mb, threads, output_mzid):
+    """
+    Command line of a MS-GF+ search
+
+    :param args: The parsed arguments
+    :param heap_mb: The Java heap in MB
+    :param threads: The number of search threads
+    :param output_mzid: The output mzid file
+    :return: The command line
+    :rtype: list[str]
+    """
+    mzml, fasta, conf = (Path(x).resolve() for x in (args.mzml, args.fasta, args.conf))
+    output_mzid = Path(output_mzid).resolve()
+    msgf = [
+        f"-Xmx{heap_mb}M",
+        "-jar",
+        args.jar if args.docker is None else "/app/MSGFPlus.jar",
+        "-s",
+        str(mzml),
+        "-d",
+        str(fasta),
+        "-conf",
+        str(conf),
+        "-thread",
+        str(threads),
+        "-o",
+        str(output_mzid),
+    ]
+    if args.docker is None:
+        return ["java"] + msgf
+    command = ["docker", "run", "--rm", f"--cpus={args.cpus or threads}"]
+    if args.memory_gb is not None:
+        command.append(f"--memory={args.memory_gb}g")
+    for mount in sorted({mzml.parent, fasta.parent, conf.parent, output_mzid.parent}):
+        command += ["-v", f"{mount}:{mount}"]
+    return command + [args.docker, "java"] + msgf
+
+
+def run_search(args, heap_mb, threads):
+    """
+    Runs and times one MS-GF+ search
+
+    :param args: The parsed arguments
+    :param heap_mb: The Java heap in MB
+    :param threads: The number of search threads
+    :return: The wall time in seconds and the exit code
+    :rtype: tuple[float, int]
+    """
+    with tempfile.TemporaryDirectory(dir=args.work_dir) as tmp:
+        command = search_command(args, heap_mb, threads, os.path.join(tmp, "out.mzid"))
+        start = time.perf_counter()
+        with profiling.span("search"):
+            process = subprocess.run(
+                command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True
+            )
+        seconds = time.perf_counter() - start
+    if process.returncode != 0:
+        print(process.stderr[-2000:], file=sys.stderr)
+    return seconds, process.returncode
+
+
+def create_arguments():
+    parser = argparse.ArgumentParser(
+        description="Benchmark MS-GF+ search time across heap sizes and thread counts"
+    )
+    parser.add_argument("-s", "--mzml", required=True, type=str, help="mzML file")
+    parser.add_argument(
+        "-d", "--fasta", required=True, type=str, help="FASTA file (indexed)"
+    )
+    parser.add_argument(
+        "-c", "--conf", required=True, type=str, help="MS-GF+ parameter file"
+    )
+    parser.add_argument(
+        "-j",
+        "--jar",
+        required=False,
+        type=str,
+        default="MSGFPlus.jar",
+        help="Local MSGFPlus.jar (ignored with --docker). Default: MSGFPlus.jar",
+    )
+    parser.add_argument(
+        "-k",
+        "--docker",
+        required=False,
+        type=str,
+        help="Optional: run the searches in this msgf docker image instead",
+    )
+    parser.add_argument(
+        "-t",
+        "--threads",
+        required=False,
+        nargs="+",
+        type=int,
+        default=[1, 2, 4, 8],
+        help="Search thread counts to test. Default: 1 2 4 8",
+    )
+    parser.add_argument(
+        "-x",
+        "--heap_mb",
+        required=False,
+        nargs="+",
+        type=int,
+        default=[4000, 8192, 13312],
+        help="Java heap sizes (MB) to test. Default: 4000 8192 13312",
+    )
+    parser.add_argument(
+        "--cpus",
+        required=False,
+        type=int,
+        help="Optional: CPUs of the docker container (default: the thread count)",
+    )
+    parser.add_argument(
+        "--memory_gb",
+        required=False,
+        type=int,
+        help="Optional: memory limit of the docker container in GB",
+    )
+    parser.add_argument(
+        "-n",
+        "--repeats",
+        required=False,
+        type=int,
+        default=1,
+        help="Number of runs of every setting. Default: 1",
+    )
+    parser.add_argument(
+        "-w",
+        "--work_dir",
+        required=False,
+        type=str,
+        help="Folder for the search outputs. Default: system temporary folder",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        required=False,
+        type=str,
+        default="benchmark_msgf.csv",
+        help="Results CSV file. Default: benchmark_msgf.csv",
+    )
+    profiling.add_argument(parser)
+    return parser
+
+
+def main():
+    parser = create_arguments()
+    args = parser.parse_args()
+    profiling.start(args.profile)
+
+    results = []
+    settings = list(itertools.product(args.heap_mb, args.threads))
+    print(f"+ {len(settings)} settings, {args.repeats} run(s) each")
+    for heap_mb, threads in settings:
+        for repeat in range(1, args.repeats + 1):
+            seconds, exit_code = run_search(args, heap_mb, threads)
+            status = "" if exit_code == 0 else f" (FAILED, exit code {exit_code})"
+            print(
+                f"\t- heap {heap_mb} MB, {threads} threads, run {repeat}: "
+                f"{seconds:.1f} s{status}"
+            )
+            results.append(
+                {
+                    "heap_mb": heap_mb,
+                    "threads": threads,
+                    "repeat": repeat,
+                    "seconds": round(seconds, 2),
+                    "exit_code": exit_code,
+                }
+            )
+
+    with profiling.span("results save"), open(args.output, "w", newline="") as outfile:
+        writer = csv.DictWriter(outfile, fieldnames=list(results[0]))
+        writer.writeheader()
+        writer.writerows(results)
+    print("+ Results: ", args.output)
+
+    succeeded = [r for r in results if r["exit_code"] == 0]
+    if succeeded:
+        best = min(succeeded, key=lambda r: (r["seconds"], r["threads"], r["heap_mb"]))
+        print(
+            f"+ Fastest: heap {best['heap_mb']} MB, {best['threads']} threads, "
+            f"{best['seconds']:.1f} s"
+        )
+        baseline = [r["seconds"] for r in succeeded if r["threads"] == min(args.threads)]
+        if baseline:
+            print(
+                f"+ Speed-up over {min(args.threads)} thread(s): "
+                f"{min(baseline) / best['seconds']:.1f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -4,21 +4,48 @@ destination bucket/folder.
 """
 
 import argparse
-import json
+import atexit
+import fnmatch
+import hashlib
 import logging
-import re
+import logging.handlers
 import sys
+import tarfile
+import threading
+import time
 import warnings
 from collections.abc import Callable
 from concurrent.futures import Future, ThreadPoolExecutor, as_completed
-from copy import copy
 from functools import wraps
 from pathlib import Path
+from queue import SimpleQueue
 from typing import List, Tuple, TypeVar
 
 import dateparser
 from google.api_core.exceptions import GoogleAPICallError, ServiceUnavailable
-from google.cloud.storage import Bucket, Client
+from google.cloud.storage import Blob, Bucket
+
+import profiling
+from cromwell_metadata import attempt_samples
+from gcs_client import DEFAULT_MAX_WORKERS, connection_stats, get_storage_client
+from local_destination import LocalBucket, download_blob
+from metadata_cache import load_json_blob
+from metadata_index import MetadataIndex
+from metadata_source import (
+    FINAL_STATUSES,
+    BucketMetadataSource,
+    MetadataSource,
+    open_metadata_source,
+    workflow_finished,
+)
+from tar_explode import (
+    MAX_BUFFERED_BYTES,
+    TAR_OUTPUTS,
+    ByteBudget,
+    explode_archive,
+    exploded_folder,
+    upload_manifest,
+)
 
 if sys.version_info >= (3, 10):
     from typing import ParamSpec
@@ -51,26 +78,94 @@ class ColoredFormatter(logging.Formatter):
         super().__init__(*args, **kwargs)
 
     def format(self, record):
-        colored_record = copy(record)
-        levelname = colored_record.levelname
+        # color the level name in place (the handlers of a record run one after the
+        # other) instead of copying every record
+        levelname = record.levelname
         seq = MAPPING.get(levelname, 37)  # default white
-        colored_record.levelname = f"{PREFIX}{seq}m{levelname}{SUFFIX}"
-        return super().format(colored_record)
+        record.levelname = f"{PREFIX}{seq}m{levelname}{SUFFIX}"
+        try:
+            return super().format(record)
+        finally:
+            record.levelname = levelname
+
+
+class RecordQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queues the log records as they are: the messages are formatted by the listener
+    thread, not by the copy threads.
+    """
+
+    def prepare(self, record):
+        return record
 
 
 base_logger = logging.getLogger("copy_pipeline_results")
 syslog = logging.StreamHandler()
 formatter = ColoredFormatter(
     "%(levelname)s :: %(asctime)s.%(msecs)03d :: %(task)s :: %(message)s",
-    datefmt="%Y/%M/%d %H:%M:%S",
+    datefmt="%Y/%m/%d %H:%M:%S",
 )
 syslog.setFormatter(formatter)
 base_logger.setLevel(logging.INFO)
 base_logger.addHandler(syslog)
 
+LOG_FILE_BYTES = 64 * 1024**2
+LOG_FILE_BACKUPS = 5
+WATCH_CHECKPOINT = "copy_pipeline_results.checkpoint"
+# the metadata keys read by the copy, requested from a Cromwell server (--metadata URL)
+COPY_METADATA_KEYS = [
+    "workflowName",
+    "status",
+    "start",
+    "end",
+    "inputs",
+    "outputs",
+    "executionStatus",
+    "shardIndex",
+    "attempt",
+    "stdout",
+    "commandLine",
+]
+
+
+def setup_logging(log_file: str | None, verbose: bool = False) -> logging.handlers.QueueListener:
+    """
+    Route the log records through a queue to a background thread writing them to the
+    console and to a rotating log file, so that the copy threads never wait for the
+    terminal. The per-file lines (DEBUG) only go to the log file, unless verbose.
+
+    :param log_file: The log file (DEBUG level), or None for the console only
+    :param verbose: Whether to also show the per-file lines on the console
+    :return: The started listener, to stop at the end of the copy
+    """
+    syslog.setLevel(logging.DEBUG if verbose else logging.INFO)
+    handlers = [syslog]
+    if log_file is not None:
+        file_handler = logging.handlers.RotatingFileHandler(
+            log_file, maxBytes=LOG_FILE_BYTES, backupCount=LOG_FILE_BACKUPS, delay=True
+        )
+        file_handler.setFormatter(
+            logging.Formatter(
+                "%(levelname)s :: %(asctime)s.%(msecs)03d :: %(threadName)s :: "
+                "%(task)s :: %(message)s",
+                datefmt=formatter.datefmt,
+            )
+        )
+        file_handler.setLevel(logging.DEBUG)
+        handlers.append(file_handler)
+
+    queue = SimpleQueue()
+    base_logger.removeHandler(syslog)
+    base_logger.addHandler(RecordQueueHandler(queue))
+    base_logger.setLevel(logging.DEBUG if log_file is not None or verbose else logging.INFO)
+    listener = logging.handlers.QueueListener(queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
 P = ParamSpec("P")
 R = TypeVar("R")
-_DEFAULT_POOL = ThreadPoolExecutor()
+_DEFAULT_POOL = ThreadPoolExecutor(max_workers=DEFAULT_MAX_WORKERS)
 
 
 def threadpool(f: Callable[P, R], pool: ThreadPoolExecutor | None = None) -> Callable[P, Future[R]]:
@@ -149,6 +244,134 @@ def parse_bucket_path(path: str) -> tuple[str, str]:
     return bucket, key
 
 
+class CopyFilter:
+    """
+    Selection of the files to copy (by sample, task and output name), applied to the
+    metadata while the copy is planned, so that unselected files are never requested.
+    """
+
+    def __init__(
+        self,
+        samples: set[str] | None = None,
+        tasks: set[str] | None = None,
+        outputs: list[str] | None = None,
+    ) -> None:
+        """
+        Create a CopyFilter. A None selection keeps everything.
+
+        :param samples: The sample ids (raw file names without .raw) to copy
+        :param tasks: The tasks (or output folders without _outputs) to copy
+        :param outputs: Glob patterns of the output names or file names to copy
+            (e.g. ppm_* or *.mzid). stdout and commandLine select the logs
+        """
+        self.samples = samples
+        self.tasks = tasks
+        self.outputs = outputs
+
+    def keep_task(self, task_id: str, output_folder: str | None = None) -> bool:
+        """
+        Whether a task is selected, by its id or its output folder.
+
+        :param task_id: The id of the call
+        :param output_folder: The output folder of the task (e.g. .../msgf_tryptic_outputs)
+        """
+        if self.tasks is None:
+            return True
+        names = {task_id}
+        if output_folder is not None:
+            names.add(Path(output_folder).name.removesuffix("_outputs"))
+        return bool(names & self.tasks)
+
+    def call_samples(self, call_attempt: dict) -> set[str]:
+        """
+        The sample ids named by the inputs of a call attempt.
+
+        :param call_attempt: The call_attempt metadata object
+        """
+        return attempt_samples(call_attempt)
+
+    def keep_attempt(self, call_attempt: dict) -> bool:
+        """
+        Whether a call attempt is selected: the calls that are not scattered (e.g.
+        wrapper_pp) belong to no sample and are always kept.
+
+        :param call_attempt: The call_attempt metadata object
+        """
+        if self.samples is None or call_attempt.get("shardIndex", -1) == -1:
+            return True
+        return bool(self.call_samples(call_attempt) & self.samples)
+
+    def keep_output(self, output_name: str, *file_names: str | None) -> bool:
+        """
+        Whether an output file is selected, by output name or file name.
+
+        :param output_name: The name of the output (key in the outputs dict)
+        :param file_names: The file names or paths of the output
+        """
+        if self.outputs is None:
+            return True
+        names = [output_name] + [Path(x).name for x in file_names if x]
+        return any(fnmatch.fnmatchcase(name, pattern) for name in names for pattern in self.outputs)
+
+    def signature(self, *options) -> str:
+        """
+        A short digest of the selection and of other copy options, so that the
+        checkpoint of a copy does not skip the files of a different selection.
+
+        :param options: The other options changing the copied files (e.g. copy_what)
+        """
+        selection = [
+            sorted(self.samples) if self.samples is not None else None,
+            sorted(self.tasks) if self.tasks is not None else None,
+            self.outputs,
+            *options,
+        ]
+        return hashlib.sha1(repr(selection).encode()).hexdigest()[:12]
+
+
+class CopyCheckpoint:
+    """
+    The call attempts whose outputs are already copied, one per line in a local file,
+    so that the watch mode (or a rerun after an interruption) copies them only once.
+    The keys are prefixed with the signature of the selection they were copied with:
+    a rerun with other samples, tasks or outputs does not skip them.
+    """
+
+    def __init__(self, path: str | None = None, selection: str = "") -> None:
+        """
+        Load the checkpoint file, if it exists.
+
+        :param path: The checkpoint file, or None to keep the checkpoint in memory
+        :param selection: The signature of the selection (see CopyFilter.signature)
+        """
+        self.path = path
+        self.selection = selection
+        self.done: set[str] = set()
+        self._lock = threading.Lock()
+        if path is not None and Path(path).exists():
+            with open(path, encoding="utf-8") as infile:
+                self.done.update(x.strip() for x in infile if x.strip())
+
+    def __contains__(self, key: str) -> bool:
+        return f"{self.selection}@{key}" in self.done
+
+    def __len__(self) -> int:
+        return sum(x.startswith(f"{self.selection}@") for x in self.done)
+
+    def add(self, key: str) -> None:
+        """
+        Record a copied call attempt.
+
+        :param key: The key of the attempt (from TaskSpec.attempt_key)
+        """
+        key = f"{self.selection}@{key}"
+        with self._lock:
+            self.done.add(key)
+            if self.path is not None:
+                with open(self.path, "a", encoding="utf-8") as outfile:
+                    outfile.write(f"{key}\n")
+
+
 class CopySpec:
     """
     Sets up a copy job from the target to the destination, contains common objects used
@@ -165,6 +388,15 @@ class CopySpec:
         destination_location: str,
         *,
         dry_run: bool,
+        max_workers: int = DEFAULT_MAX_WORKERS,
+        parquet: bool = False,
+        explode: bool = False,
+        copy_filter: CopyFilter | None = None,
+        index: str | None = None,
+        rollup_seconds: float = 30,
+        metadata_source: MetadataSource | None = None,
+        checkpoint: CopyCheckpoint | None = None,
+        watch: bool = False,
     ) -> None:
         """
         Create a CopySpec instance. Creates the source and destination bucket and folder
@@ -176,68 +408,182 @@ class CopySpec:
         :param source_location: The source of workflow outputs
             (e.g. gs://my-bucket/my-folder/outputs)
         :param destination_location: The destination to copy the outputs to
-            (e.g. gs://my-bucket/my-outputs)
+            (e.g. gs://my-bucket/my-outputs), or a local folder to download them to
         :param dry_run: Whether to actually copy the files
+        :param max_workers: The number of copy threads, and of slice download or
+            archive upload threads (sizes the connection pool)
+        :param parquet: Whether to also write the result tables as Parquet files
+        :param explode: Whether to copy the files inside the output archives instead
+            of the archives
+        :param copy_filter: The selection of samples, tasks and outputs to copy
+        :param index: A SQLite metadata index (see metadata_index.py) to plan the copy
+            from, instead of the metadata.json object. The metadata.json is indexed
+            first if it is not yet
+        :param rollup_seconds: How often the per-task progress is logged
+        :param metadata_source: Where to load the metadata from, instead of the
+            metadata.json file in the source folder
+        :param checkpoint: The call attempts already copied, which are skipped
+        :param watch: Whether the workflow may still be running: only the call
+            attempts that have finished are copied, the others at a later poll
         """
         source_bucket, source_folder = parse_bucket_path(source_location)
-        destination_bucket, destination_folder = parse_bucket_path(destination_location)
 
         self.wf_id = wf_id
-        self.client = Client(project=project)
+        self.local = not destination_location.startswith(("gs://", "s3://"))
+        # a connection per thread: the copy threads, plus the threads downloading the
+        # slices of the large files or uploading the files of the archives
+        connections = max_workers * (1 + self.local + explode)
+        self.client = get_storage_client(project, connections)
         self.source_bucket = self.client.get_bucket(source_bucket)
         self.source_folder = source_folder.rstrip("/")
-        self.destination_bucket = self.client.get_bucket(destination_bucket)
-        self.destination_folder = destination_folder.rstrip("/")
-        self.metadata = self.set_metadata()
-        self.wf_inputs = {
-            key.removeprefix("proteomics_msgfplus."): value
-            for key, value in self.metadata["inputs"].items()
-        }
+        if self.local:
+            # download to a local folder, the large files in parallel slices
+            self.destination_bucket = LocalBucket()
+            self.destination_folder = str(Path(destination_location).resolve())
+            self.slice_pool = ThreadPoolExecutor(max_workers=max_workers)
+        else:
+            destination_bucket, destination_folder = parse_bucket_path(destination_location)
+            self.destination_bucket = self.client.get_bucket(destination_bucket)
+            self.destination_folder = destination_folder.rstrip("/")
+        self.index = MetadataIndex(index) if index is not None else None
+        self.workflow_id = None
+        self.metadata_source = metadata_source or BucketMetadataSource(
+            self.source_bucket, self.source_folder
+        )
+        self.checkpoint = checkpoint if checkpoint is not None else CopyCheckpoint()
+        self.watching = watch
+        self.refresh_metadata()
         self.dry_run = dry_run
-
-        start_time = dateparser.parse(self.metadata["start"])
-        end_time = dateparser.parse(self.metadata["end"])
-        self.logger.info("Pipeline Running Time: %s", end_time - start_time)
+        self.parquet = parquet
+        self.explode = explode
+        if explode:
+            # shared by all the archives exploded at the same time
+            self.upload_pool = ThreadPoolExecutor(max_workers=max_workers)
+            self.upload_budget = ByteBudget(MAX_BUFFERED_BYTES)
+        self.max_workers = max_workers
+        self.copy_filter = copy_filter or CopyFilter()
 
         self.tasks: list[TaskSpec] = []
         self.running_futures: list[Future[None]] = []
 
+        self.copied_files = 0
+        self.copied_bytes = 0
+        self._copy_start = time.perf_counter()
+        self._metrics_lock = threading.Lock()
+        self.rollup_seconds = rollup_seconds
+        # per task: files planned, done and failed, and bytes copied
+        self.task_metrics: dict[str, dict[str, int]] = {}
+        self._reported: dict[str, tuple] = {}
+
     def set_metadata(self) -> dict:
         """
-        Find and set the metadata.json file in the source bucket/folder.
+        Load the metadata from its source: by default, find the metadata.json file in
+        the source bucket/folder.
 
         :return: The loaded metadata.json object.
         """
+        if not isinstance(self.metadata_source, BucketMetadataSource):
+            self.logger.info("Metadata source: %s", self.metadata_source.location)
+            try:
+                with profiling.span("metadata load"):
+                    return self.metadata_source.load()
+            except (OSError, ValueError) as e:
+                self.logger.error("Error: unable to load the metadata: %s", e)
+                sys.exit(1)
 
-        metadata = None
         self.logger.info("Searching for metadata.json in file list")
-        # assume that the metadata file is called metadata.json
-        metadata_blob = self.source_bucket.get_blob(f"{self.source_folder}/metadata.json")
-        if metadata_blob is not None:
-            self.logger.info("Metadata file location: %s", metadata_blob.name)
-            return json.loads(metadata_blob.download_as_string(client=None))
-
-        # if we can't find the metadata file, search for it
-        bucket_content_list = self.client.list_blobs(
-            self.source_bucket,
-            prefix=f"{self.source_folder}/",
-        )
-        # Get and load the metadata.json file
-        for blob in bucket_content_list:
-            m = re.match("(.*.metadata.json)", blob.name)
-            if m:
-                self.logger.info("Metadata file location: %s", m[1])
-                metadata = json.loads(blob.download_as_string(client=None))
-                break
-
-        if metadata is None:
+        metadata_blob = self.metadata_source.find_blob()
+        if metadata_blob is None:
             self.logger.error(
                 "Error: unable to find metadata.json file in %s specified",
                 f"gs://{self.source_bucket.name}/{self.source_folder}/",
             )
             sys.exit(1)
 
-        return metadata
+        self.logger.info("Metadata file location: %s", metadata_blob.name)
+        return self.load_metadata(metadata_blob)
+
+    def refresh_metadata(self) -> None:
+        """
+        Load the metadata again (watch mode) and update the workflow name and inputs.
+        """
+        self.metadata = self.set_metadata()
+        # e.g. proteomics_maxquant_scatter instead of proteomics_maxquant
+        self.wf_id = self.metadata.get("workflowName", self.wf_id)
+        self.wf_inputs = {
+            key.removeprefix(f"{self.wf_id}."): value
+            for key, value in self.metadata.get("inputs", {}).items()
+        }
+
+        start_time = self.metadata.get("start")
+        end_time = self.metadata.get("end")
+        if start_time is not None and end_time is not None:
+            self.logger.info(
+                "Pipeline Running Time: %s",
+                dateparser.parse(end_time) - dateparser.parse(start_time),
+            )
+        else:
+            self.logger.info(
+                "Workflow status: %s (started %s)",
+                self.metadata.get("status"),
+                start_time or "-",
+            )
+
+    @property
+    def running(self) -> bool:
+        """Whether the workflow has not finished yet (its metadata still changes)."""
+        return not workflow_finished(self.metadata)
+
+    def load_metadata(self, metadata_blob: Blob) -> dict:
+        """
+        Load the metadata.json file, or its workflow-level metadata from the index
+        (indexing it first if this generation of the file is not indexed yet).
+
+        :param metadata_blob: The metadata.json blob
+        :return: The metadata.json object (without the calls if using the index)
+        """
+        with profiling.span("metadata load"):
+            if self.index is None:
+                return load_json_blob(metadata_blob)
+            source = f"gs://{metadata_blob.bucket.name}/{metadata_blob.name}"
+            self.workflow_id = self.index.find(source, metadata_blob.generation)
+            if self.workflow_id is None:
+                self.workflow_id = self.index.add(
+                    load_json_blob(metadata_blob), source, metadata_blob.generation
+                )
+                self.logger.info("Indexed %s in %s", self.workflow_id, self.index.path)
+            return self.index.workflow(self.workflow_id)
+
+    def has_call(self, task_id: str) -> bool:
+        """
+        Whether the workflow ran a task.
+
+        :param task_id: The id of the call (e.g. wrapper_pp)
+        """
+        call_name = f"{self.wf_id}.{task_id}"
+        if self.index is not None:
+            return call_name in self.index.call_names(self.workflow_id)
+        return call_name in self.metadata["calls"]
+
+    def call_attempts(self, task_id: str) -> list[dict]:
+        """
+        The call attempts of a task selected by the copy filter. With an index, the
+        samples are selected by the database instead of scanning all the attempts.
+
+        :param task_id: The id of the call
+        :return: The call_attempt metadata objects
+        """
+        call_name = f"{self.wf_id}.{task_id}"
+        if self.index is not None:
+            return self.index.call_attempts(
+                self.workflow_id, call_name, self.copy_filter.samples
+            )
+        # a running workflow has no calls of the tasks that have not started yet
+        return [
+            x
+            for x in self.metadata["calls"].get(call_name, [])
+            if self.copy_filter.keep_attempt(x)
+        ]
 
     def create_task(
         self,
@@ -262,24 +608,171 @@ class CopySpec:
             not provided
         :param inputs: Any global inputs to copy
         """
-        self.tasks.append(
-            TaskSpec(
+        if not self.copy_filter.keep_task(task_id, output_folder or f"{task_id}_outputs"):
+            self.logger.info("Skipping %s (not selected)", output_folder or task_id)
+            return
+        with profiling.span("planning"):
+            self.tasks.append(
+                TaskSpec(
+                    task_id,
+                    stdout_filename,
+                    command_filename,
+                    outputs,
+                    self,
+                    output_folder,
+                    inputs,
+                ),
+            )
+
+    def destination_url(self, path: str) -> str:
+        """
+        Location of a copied file, for the logs.
+
+        :param path: The path of the file in the destination bucket (or local folder)
+        :return: The gs:// location (or the local path)
+        """
+        if self.local:
+            return path
+        return f"gs://{self.destination_bucket.name}/{path}"
+
+    def _task_metrics(self, task_id: str) -> dict[str, int]:
+        return self.task_metrics.setdefault(
+            task_id, {"planned": 0, "done": 0, "failed": 0, "bytes": 0}
+        )
+
+    def record_planned(self, task_id: str) -> None:
+        """
+        Count a file to copy in the metrics of its task.
+
+        :param task_id: The id of the call
+        """
+        with self._metrics_lock:
+            self._task_metrics(task_id)["planned"] += 1
+
+    def record_copy(self, size: int | None, task_id: str = "General") -> None:
+        """
+        Count a copied file in the copy metrics.
+
+        :param size: The size of the file in bytes
+        :param task_id: The id of the call
+        """
+        with self._metrics_lock:
+            self.copied_files += 1
+            self.copied_bytes += size or 0
+            metrics = self._task_metrics(task_id)
+            metrics["done"] += 1
+            metrics["bytes"] += size or 0
+
+    def record_failure(self, task_id: str) -> None:
+        """
+        Count a file that could not be copied in the metrics of its task.
+
+        :param task_id: The id of the call
+        """
+        with self._metrics_lock:
+            self._task_metrics(task_id)["failed"] += 1
+
+    def log_rollup(self, changed_only: bool = True) -> None:
+        """
+        Log the progress of every task: files done, failed and planned, and GB copied.
+
+        :param changed_only: Only the tasks that progressed since the last rollup
+        """
+        with self._metrics_lock:
+            snapshot = {k: dict(v) for k, v in self.task_metrics.items()}
+        for task_id, metrics in snapshot.items():
+            state = tuple(metrics.values())
+            if changed_only and self._reported.get(task_id) == state:
+                continue
+            self._reported[task_id] = state
+            self.logger.info(
+                "%s: %d/%d files done, %d failed, %.2f GB",
                 task_id,
-                stdout_filename,
-                command_filename,
-                outputs,
-                self,
-                output_folder,
-                inputs,
-            ),
+                metrics["done"],
+                metrics["planned"],
+                metrics["failed"],
+                metrics["bytes"] / 1024**3,
+            )
+
+    def _report_progress(self, stop: threading.Event) -> None:
+        while not stop.wait(self.rollup_seconds):
+            self.log_rollup()
+
+    def log_metrics(self) -> None:
+        """Log the number of files and bytes copied, and the connection reuse."""
+        elapsed = time.perf_counter() - self._copy_start
+        self.logger.info(
+            "Copied %d files (%.2f GB) in %.1f s",
+            self.copied_files,
+            self.copied_bytes / 1024**3,
+            elapsed,
         )
+        stats = connection_stats(self.client)
+        self.logger.info(
+            "HTTP requests: %d, connections opened: %d, connection reuse: %.1f%%",
+            stats["requests"],
+            stats["connections"],
+            stats["reuse_rate"] * 100,
+        )
+
+    def run_tasks(self) -> int:
+        """
+        Run all tasks for the copy job, logging their progress periodically, and add
+        the call attempts whose files were all copied to the checkpoint.
 
-    def run_tasks(self) -> List[None]:
-        """Run all tasks for the copy job."""
-        for task in self.tasks:
-            task.run_copy()
+        :return: The number of call attempts copied
+        """
+        stop = threading.Event()
+        reporter = threading.Thread(
+            target=self._report_progress, args=(stop,), name="rollup", daemon=True
+        )
+        reporter.start()
+        planned: dict[str, list[Future[bool]]] = {}
+        try:
+            with profiling.span("copying"):
+                for task in self.tasks:
+                    planned.update(task.run_copy())
+                self.running_futures = [f for futures in planned.values() for f in futures]
+                for _ in as_completed(self.running_futures):
+                    pass
+        finally:
+            stop.set()
+            reporter.join()
+
+        copied = 0
+        for key, futures in planned.items():
+            errors = [f.exception() for f in futures if f.exception() is not None]
+            for e in errors:
+                self.logger.error("----> Unable to copy a file of %s: %r", key, e)
+            if not errors and all(f.result() for f in futures):
+                self.checkpoint.add(key)
+                copied += 1
+        self.log_rollup(changed_only=False)
+        return copied
+
+    def watch(self, plan: Callable[["CopySpec"], None], poll_seconds: float) -> None:
+        """
+        Copy the outputs of a running workflow as its call attempts finish: copy the
+        finished attempts that are not in the checkpoint, poll the metadata again and
+        repeat until the workflow has finished.
 
-        return [f.result() for f in as_completed(self.running_futures)]
+        :param plan: Creates the tasks of the copy job from the current metadata
+        :param poll_seconds: The time between two polls of the metadata
+        """
+        while True:
+            self.tasks = []
+            plan(self)
+            copied = self.run_tasks()
+            self.logger.info(
+                "Copied the outputs of %d call attempt(s), %d in the checkpoint",
+                copied,
+                len(self.checkpoint),
+            )
+            if not self.running:
+                break
+            self.logger.info("Next poll of the metadata in %.0f s", poll_seconds)
+            time.sleep(poll_seconds)
+            self.refresh_metadata()
 
 
 class TaskSpec:
@@ -320,9 +813,21 @@ class TaskSpec:
         self.copy_spec = copy_spec
         self.output_folder = output_folder or f"{copy_spec.destination_folder}/{task_id}_outputs"
 
-        self.calls = copy_spec.metadata["calls"][f"{copy_spec.wf_id}.{self.task_id}"]
+        self.calls = copy_spec.call_attempts(self.task_id)
         self.attempt = {}
         self.logger = logging.LoggerAdapter(base_logger, {"task": task_id.upper()})
+        if copy_spec.copy_filter.samples is not None:
+            self.logger.info("%d call attempts selected", len(self.calls))
+
+    def log_failure(self, msg: str, *args) -> None:
+        """
+        Log a file that could not be copied, and count it in the task metrics.
+
+        :param msg: The log message
+        :param args: The log message arguments
+        """
+        self.copy_spec.record_failure(self.task_id)
+        self.logger.error(msg, *args)
 
     @property
     def command_filename(self) -> str:
@@ -357,35 +862,62 @@ class TaskSpec:
         :param file_name: the file name
         """
         cmd_txt = call_attempt.get("commandLine")
+        if not self.copy_spec.copy_filter.keep_output("commandLine", file_name):
+            return
         if cmd_txt is not None:
             cmd_txt_name = f"{self.output_folder}/{file_name}"
-            self.logger.info("- Command to file: %s", cmd_txt_name)
+            self.logger.debug("- Command to file: %s", cmd_txt_name)
             if not self.copy_spec.dry_run:
                 new_blob_command = self.copy_spec.destination_bucket.blob(cmd_txt_name)
                 new_blob_command.upload_from_string(cmd_txt, content_type="text/plain")
         else:
             self.logger.warning("----> Unable to copy commandLine")
 
-    def run_copy(self) -> None:
+    def attempt_key(self, call_attempt: dict) -> str:
         """
-        Copy files from the source to the destination.
+        The key of a call attempt of this task in the copy checkpoint.
+
+        :param call_attempt: The call_attempt metadata object
+        """
+        return (
+            f"{self.output_folder}/{self.task_id}"
+            f":{call_attempt.get('shardIndex', -1)}:{call_attempt.get('attempt', 1)}"
+        )
+
+    def run_copy(self) -> dict[str, list[Future[bool]]]:
+        """
+        Copy files from the source to the destination, skipping the call attempts in
+        the checkpoint (and, when watching, the attempts that have not finished).
+
+        :return: The copies of every call attempt (and of the inputs), by checkpoint key
         """
+        planned = {}
         # copy any source files
-        if self.inputs is not None:
+        inputs_key = f"{self.output_folder}/{self.task_id}:inputs"
+        if self.inputs is not None and inputs_key not in self.copy_spec.checkpoint:
             inputs_dict = self.copy_spec.wf_inputs
+            planned[inputs_key] = []
             for key, directory in self.inputs:
-                self.copy_file_to_new_location(
+                planned[inputs_key] += self.copy_file_to_new_location(
                     inputs_dict,
                     key,
                     f"{directory.rstrip('/')}/{Path(inputs_dict[key]).name}".lstrip("/"),
                 )
 
         for call_attempt in self.calls:
+            key = self.attempt_key(call_attempt)
+            execution_status = call_attempt["executionStatus"]
+            if key in self.copy_spec.checkpoint:
+                continue
+            if self.copy_spec.watching and execution_status not in FINAL_STATUSES:
+                # copied at a later poll, once it has finished
+                continue
+            planned[key] = []
             # set the attempt to get the proper stdout filename
             self.attempt = call_attempt
             # copy any stdout file if given a filename
             if self.stdout_filename is not None and "stdout" in call_attempt:
-                self.copy_file_to_new_location(
+                planned[key] += self.copy_file_to_new_location(
                     call_attempt,
                     "stdout",
                     self.stdout_filename,
@@ -395,22 +927,22 @@ class TaskSpec:
             if self.command_filename is not None:
                 self.write_command_to_file(call_attempt, self.command_filename)
 
-            execution_status = call_attempt["executionStatus"]
             if execution_status == "Done":
                 # copy all outputs
                 call_outputs = call_attempt["outputs"]
                 for output in self.outputs:
-                    self.copy_file_to_new_location(call_outputs, output)
+                    planned[key] += self.copy_file_to_new_location(call_outputs, output)
             else:
                 self.logger.warning(" (-) Execution Status: %s", execution_status)
                 self.logger.warning(" (-) Data cannot be copied")
+        return planned
 
     def copy_file_to_new_location(
         self,
         attempt_outputs_dict: dict,
         output_name: str,
         new_filename: str = None,
-    ) -> None:
+    ) -> list[Future[bool]]:
         """
         Copy a file from the given dictionary at the key `output_name` in the source
         bucket to the destination bucket with the new path (and optional filename).
@@ -418,22 +950,131 @@ class TaskSpec:
         :param attempt_outputs_dict: The dictionary being searched
         :param output_name: The key to look for the file in the `attempt_outputs_dict`
         :param new_filename: An optional new filename to give the object
+        :return: The copies started
         """
         file_to_copy = attempt_outputs_dict.get(output_name)
+        keep = self.copy_spec.copy_filter.keep_output
+        futures = []
         if file_to_copy is not None:
             if isinstance(file_to_copy, list):
                 for f in file_to_copy:
-                    self.copy_single_file(f, new_filename, output_name)
+                    if keep(output_name, f, new_filename):
+                        self.copy_spec.record_planned(self.task_id)
+                        futures.append(self.copy_single_file(f, new_filename, output_name))
             elif isinstance(file_to_copy, str):
-                self.copy_single_file(file_to_copy, new_filename, output_name)
+                if keep(output_name, file_to_copy, new_filename):
+                    self.copy_spec.record_planned(self.task_id)
+                    futures.append(self.copy_single_file(file_to_copy, new_filename, output_name))
             else:
-                self.logger.error(
+                self.log_failure(
                     "----> Unable to copy %s, key has unsupported type %s",
                     output_name,
                     type(file_to_copy),
                 )
         else:
-            self.logger.error("----> Unable to copy %s, key does not exist", output_name)
+            self.log_failure("----> Unable to copy %s, key does not exist", output_name)
+        return futures
+
+    def convert_to_parquet(self, original_file: Blob, new_file_path: str, output_name: str) -> None:
+        """
+        Write a copied result table as a Parquet file next to it (--parquet).
+
+        :param original_file: The blob of the table
+        :param new_file_path: The path of the copied table
+        :param output_name: The name of the output in the outputs dict
+        """
+        from parquet_tables import PARQUET_OUTPUTS, convert_table, parquet_name
+
+        if output_name not in PARQUET_OUTPUTS:
+            return
+        parquet_path = parquet_name(new_file_path)
+        try:
+            with profiling.span("parquet conversion"):
+                result = convert_table(
+                    original_file, self.copy_spec.destination_bucket.blob(parquet_path)
+                )
+        except (GoogleAPICallError, ValueError, OSError) as e:
+            self.logger.error("----> Unable to convert %s to Parquet: %s", output_name, e)
+            return
+        self.logger.info(
+            "Converted - %s to %s (%d rows, %d columns)",
+            output_name,
+            self.copy_spec.destination_url(parquet_path),
+            result["rows"],
+            result["columns"],
+        )
+
+    def explode_archive(self, original_file: Blob, new_file_path: str, output_name: str) -> bool:
+        """
+        Copy the files inside an output archive (--explode) to a folder named after
+        the archive, with a manifest of the files.
+
+        :param original_file: The blob of the archive
+        :param new_file_path: The path the archive would be copied to
+        :param output_name: The name of the output in the outputs dict
+        :return: Whether the archive was exploded (or would be, in a dry run)
+        """
+        folder = exploded_folder(new_file_path)
+        destination = f"{self.copy_spec.destination_url(folder)}/"
+        if self.copy_spec.dry_run:
+            self.logger.debug("DRY RUN: Exploded - %s archive to %s", output_name, destination)
+            return True
+        try:
+            with profiling.span("archive explode"):
+                manifest = explode_archive(
+                    original_file,
+                    self.copy_spec.destination_bucket,
+                    folder,
+                    pool=self.copy_spec.upload_pool,
+                    budget=self.copy_spec.upload_budget,
+                )
+            with profiling.span("manifest upload"):
+                upload_manifest(
+                    manifest, self.copy_spec.destination_bucket, f"{folder}_manifest.csv"
+                )
+        except (GoogleAPICallError, ValueError, OSError, tarfile.TarError) as e:
+            self.log_failure("----> Unable to explode %s to %s: %s", output_name, destination, e)
+            return False
+        for entry in manifest:
+            self.copy_spec.record_copy(entry["size"], self.task_id)
+        self.logger.info(
+            "Exploded - %s archive to %s (%d files, manifest: %s_manifest.csv)",
+            output_name,
+            destination,
+            len(manifest),
+            Path(folder).name,
+        )
+        return True
+
+    def download_file(self, original_file: Blob, new_file_path: str, output_name: str) -> bool:
+        """
+        Download a file to the local destination, checking its CRC32C.
+
+        :param original_file: The blob of the file
+        :param new_file_path: The local path of the file
+        :param output_name: The name of the output in the outputs dict
+        :return: Whether the file was downloaded (or would be, in a dry run)
+        """
+        source = f"gs://{original_file.bucket.name}/{original_file.name}"
+        if self.copy_spec.dry_run:
+            self.logger.debug("DRY RUN: Downloaded - %s file from %s to %s", output_name, source, new_file_path)
+            return True
+        try:
+            slices = download_blob(original_file, new_file_path, self.copy_spec.slice_pool)
+        except (GoogleAPICallError, ValueError, OSError) as e:
+            self.log_failure("----> Unable to download %s from %s: %s", output_name, source, e)
+            return False
+        self.copy_spec.record_copy(original_file.size, self.task_id)
+        self.logger.debug(
+            "Downloaded - %s file from %s to %s (%d slices, CRC32C verified)",
+            output_name,
+            source,
+            new_file_path,
+            slices,
+        )
+        if self.copy_spec.parquet:
+            self.convert_to_parquet(original_file, new_file_path, output_name)
+        return True
 
     @threadpool
     def copy_single_file(
@@ -441,13 +1082,14 @@ class TaskSpec:
         orig_filename: str,
         new_filename: str,
         output_name: str,
-    ) -> None:
+    ) -> bool:
         """
         Copy a single file with the original filename to the new_filename.
 
         :param orig_filename: The original file's gs://path
         :param new_filename: The new file's filename
         :param output_name: The name of the output in the outputs dict
+        :return: Whether the file was copied (or would be, in a dry run)
         """
         # remove the gs://<bucket>/ prefix from the data
         orig_file_bucket, orig_filename = parse_bucket_path(orig_filename)
@@ -464,16 +1106,21 @@ class TaskSpec:
             # get the other bucket
             other_bucket = self.copy_spec.client.get_bucket(orig_file_bucket)
             if other_bucket is None:
-                self.logger.error(
+                self.log_failure(
                     "----> Unable to copy %s file at %s, bucket does not exist",
                     output_name,
                     orig_filename,
                 )
-                return
+                return False
             # get the original file from the other bucket
             original_file = other_bucket.get_blob(orig_filename)
         # copy the original file if it exists, log an error if it doesn't
-        if original_file is not None:
+        if original_file is not None and self.copy_spec.explode and output_name in TAR_OUTPUTS:
+            return self.explode_archive(original_file, new_file_path, output_name)
+        elif original_file is not None and self.copy_spec.local:
+            return self.download_file(original_file, new_file_path, output_name)
+        elif original_file is not None:
+            copied = False
             if not self.copy_spec.dry_run:
                 try:
                     self.copy_spec.source_bucket.copy_blob(
@@ -481,6 +1128,10 @@ class TaskSpec:
                         self.copy_spec.destination_bucket,
                         new_file_path,
                     )
+                    self.copy_spec.record_copy(original_file.size, self.task_id)
+                    copied = True
+                    if self.copy_spec.parquet:
+                        self.convert_to_parquet(original_file, new_file_path, output_name)
                 except ServiceUnavailable as e:
                     if "use the Rewrite method" in e.message:
                         self.logger.warning(
@@ -488,7 +1139,7 @@ class TaskSpec:
                             "allowed time. Attempting to copy using the rewrite method.",
                             output_name,
                             orig_filename,
-                            f"gs://{self.copy_spec.destination_bucket.name}/" f"{new_file_path}",
+                            self.copy_spec.destination_url(new_file_path),
                         )
                         try:
                             dest_blob = self.copy_spec.destination_bucket.blob(new_file_path)
@@ -501,59 +1152,61 @@ class TaskSpec:
                                     bytes_rewritten,
                                     bytes_to_rewrite,
                                 ) = dest_blob.rewrite(original_file, token=rewrite_token)
-                                self.logger.info(
+                                self.logger.debug(
                                     "%s: Progress so far: %.2f%% (%d/%d) bytes.",
-                                    f"gs://{self.copy_spec.destination_bucket.name}/"
-                                    f"{new_file_path}",
+                                    self.copy_spec.destination_url(new_file_path),
                                     bytes_rewritten / bytes_to_rewrite * 100,
                                     bytes_rewritten,
                                     bytes_to_rewrite,
                                 )
                                 if not rewrite_token:
                                     break
+                            self.copy_spec.record_copy(original_file.size, self.task_id)
+                            copied = True
+                            if self.copy_spec.parquet:
+                                self.convert_to_parquet(original_file, new_file_path, output_name)
                         except GoogleAPICallError as e:
-                            self.logger.error(
+                            self.log_failure(
                                 "----> Unable to rewrite %s from %s to %s. " "Google API error: %s",
                                 output_name,
                                 orig_filename,
-                                f"gs://{self.copy_spec.destination_bucket.name}/"
-                                f"{new_file_path}",
+                                self.copy_spec.destination_url(new_file_path),
                                 e,
                             )
                     else:
-                        self.logger.error(
+                        self.log_failure(
                             "----> Unable to copy %s from %s to %s. " "Google API error: %s",
                             output_name,
                             orig_filename,
-                            f"gs://{self.copy_spec.destination_bucket.name}/" f"{new_file_path}",
+                            self.copy_spec.destination_url(new_file_path),
                             e,
                         )
                 except GoogleAPICallError as e:
-                    self.logger.error(
+                    self.log_failure(
                         "----> Unable to copy %s from %s to %s. " "Google API error: %s",
                         output_name,
                         orig_filename,
-                        f"gs://{self.copy_spec.destination_bucket.name}/{new_file_path}",
+                        self.copy_spec.destination_url(new_file_path),
                         e,
                     )
 
-            log_copy = "Copied"
-            if self.copy_spec.dry_run:
-                log_copy = "DRY RUN: Copied"
-            self.logger.info(
-                "%s - %s file from %s to %s",
-                log_copy,
-                output_name,
-                f"gs://{orig_file_bucket}/{orig_filename}",
-                f"gs://{self.copy_spec.destination_bucket.name}/{new_file_path}",
-            )
+            if copied or self.copy_spec.dry_run:
+                self.logger.debug(
+                    "%s - %s file from %s to %s",
+                    "DRY RUN: Copied" if self.copy_spec.dry_run else "Copied",
+                    output_name,
+                    f"gs://{orig_file_bucket}/{orig_filename}",
+                    self.copy_spec.destination_url(new_file_path),
+                )
+            return copied or self.copy_spec.dry_run
         else:
-            self.logger.error(
+            self.log_failure(
                 "----> Unable to copy %s from %s to %s",
                 output_name,
                 orig_filename,
-                f"gs://{self.copy_spec.destination_bucket.name}/{new_file_path}",
+                self.copy_spec.destination_url(new_file_path),
             )
+            return False
 
 
 def create_args():
@@ -588,8 +1241,8 @@ def create_args():
         "--destination",
         required=True,
         type=str,
-        help="Full path to copy the files to. Required. "
-        "(e.g. gs://my-bucket/test/results/input_test_gcp_s6-global-2files-8/)",
+        help="Full path to copy the files to, or a local folder to download them to. "
+        "Required. (e.g. gs://my-bucket/test/results/input_test_gcp_s6-global-2files-8/)",
     )
     parser.add_argument(
         "-c",
@@ -601,43 +1254,168 @@ def create_args():
         help="What would you like to copy: <full>: all msgfplus outputs "
         "<results>: plexedpiper results only",
     )
+    parser.add_argument(
+        "-w",
+        "--max_workers",
+        required=False,
+        type=int,
+        default=DEFAULT_MAX_WORKERS,
+        help=f"Number of files copied concurrently. Default: {DEFAULT_MAX_WORKERS}",
+    )
+    parser.add_argument(
+        "--parquet",
+        action="store_true",
+        help="Also write the PlexedPiper (ratio, RII) and MaxQuant (evidence, msms, "
+        "proteinGroups) result tables as Parquet files next to the copied text files. "
+        "Requires pyarrow",
+    )
+    parser.add_argument(
+        "-x",
+        "--index",
+        required=False,
+        type=str,
+        help="Optional: SQLite metadata index (see metadata_index.py). The "
+        "metadata.json is indexed on the first run, and the copy is planned with "
+        "indexed queries on the later ones",
+    )
+    parser.add_argument(
+        "--explode",
+        action="store_true",
+        help="Copy the files inside the wrapper_pp archives (MASIC, PHRP and AScore "
+        "outputs) into folders named after the archives, instead of the tar.gz files",
+    )
+    parser.add_argument(
+        "-s",
+        "--samples",
+        required=False,
+        nargs="+",
+        type=str,
+        help="Only copy the outputs of these samples (raw file names, with or without "
+        ".raw). The outputs of the tasks that are not scattered are always copied",
+    )
+    parser.add_argument(
+        "-f",
+        "--samples_file",
+        required=False,
+        type=str,
+        help="File with the samples to copy, one per line (see --samples)",
+    )
+    parser.add_argument(
+        "-t",
+        "--tasks",
+        required=False,
+        nargs="+",
+        type=str,
+        help="Only copy the outputs of these tasks (e.g. ppm_errorcharter msgf_tryptic)",
+    )
+    parser.add_argument(
+        "-g",
+        "--outputs",
+        required=False,
+        nargs="+",
+        type=str,
+        help="Only copy the outputs whose name or file name matches one of these glob "
+        "patterns (e.g. 'ppm_*' '*.mzid'). Use stdout and commandLine for the logs",
+    )
+    parser.add_argument(
+        "-l",
+        "--log_file",
+        required=False,
+        type=str,
+        default="copy_pipeline_results.log",
+        help="Log file with a line per copied file (rotated every "
+        f"{LOG_FILE_BYTES // 1024**2} MB). Default: copy_pipeline_results.log",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="Also show a line per copied file on the console (by default only the "
+        "periodic progress of every task, warnings and errors)",
+    )
+    parser.add_argument(
+        "--rollup_seconds",
+        required=False,
+        type=float,
+        default=30,
+        help="How often the progress of every task is shown (seconds). Default: 30",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Copy the outputs of a running workflow: poll its metadata (from "
+        "--metadata, required) every --poll_seconds and copy the outputs of every call "
+        "attempt as soon as it has finished, until the workflow has finished",
+    )
+    parser.add_argument(
+        "--poll_seconds",
+        required=False,
+        type=float,
+        default=300,
+        help="How often the metadata is polled in watch mode (seconds). Default: 300",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        required=False,
+        type=str,
+        help="File listing the call attempts already copied, which are skipped (e.g. "
+        "to resume an interrupted copy). Default in watch mode: "
+        f"{WATCH_CHECKPOINT}",
+    )
+    parser.add_argument(
+        "--metadata",
+        required=False,
+        type=str,
+        help="Optional: load the metadata of the workflow from a local metadata.json "
+        "(e.g. refreshed with `caper metadata WORKFLOW_ID > metadata.json`) or from "
+        "the Cromwell/Caper server running it (e.g. http://localhost:8000, the "
+        "workflow id being the last folder of -o), instead of the metadata.json in the "
+        "origin folder, which Caper writes only when the workflow has finished",
+    )
     parser.add_argument(
         "--dry-run",
         action="store_true",
         help="Don't actually copy the files, just print what it's going to do",
     )
+    profiling.add_argument(parser)
     return parser
 
 
-def main():
-    parser = create_args()
-    args = parser.parse_args()
-    logger = logging.LoggerAdapter(base_logger, {"task": "General"})
-
-    project_name = args.project.rstrip("/")
-    logger.info("GCP project: %s", project_name)
-    origin = args.origin.rstrip("/")
-    logger.info("Origin: %s", origin)
-    destination = args.destination.rstrip("/")
-    logger.info("Destination: %s", destination)
-    method_proteomics = args.method_proteomics
-    logger.info("+ Proteomics Pipeline METHOD: %s", method_proteomics)
+def create_copy_filter(args: argparse.Namespace) -> CopyFilter:
+    """
+    Create the selection of samples, tasks and outputs from the arguments.
 
-    if args.dry_run:
-        logger.info("This is a dry run, no files will be copied")
+    :param args: The parsed arguments
+    :return: The copy filter
+    """
+    samples = None
+    if args.samples is not None or args.samples_file is not None:
+        samples = set(args.samples or [])
+        if args.samples_file is not None:
+            with open(args.samples_file) as samples_file:
+                samples.update(x.strip() for x in samples_file if x.strip() and not x.startswith("#"))
+        samples = {x.removesuffix(".raw") for x in samples}
+    tasks = set(args.tasks) if args.tasks is not None else None
+    return CopyFilter(samples=samples, tasks=tasks, outputs=args.outputs)
+
+
+def plan_copy(copy_job: CopySpec, method_proteomics: str, copy_what: str) -> None:
+    """
+    Create the copy tasks of a job from its current metadata (again at every poll of
+    the watch mode).
 
+    :param copy_job: The copy job
+    :param method_proteomics: The proteomics method (msgfplus or maxquant)
+    :param copy_what: What to copy (full, results or ppinputs)
+    """
+    logger = logging.LoggerAdapter(base_logger, {"task": "General"})
     if method_proteomics == "maxquant":
-        logger.info("PROTEOMICS METHOD: maxquant")
-        logger.info("+ Copy MAXQUANT outputs-----------------------------")
-        copy_job = CopySpec(
-            wf_id="proteomics_maxquant",
-            project=project_name,
-            source_location=origin,
-            destination_location=destination,
-            dry_run=args.dry_run,
-        )
+        # the scatter/gather workflow produces the outputs in its combined task
+        maxquant_task = "maxquant"
+        if copy_job.wf_id == "proteomics_maxquant_scatter":
+            maxquant_task = "maxquant_combined"
         copy_job.create_task(
-            "maxquant",
+            maxquant_task,
             "console-maxquant-stdout.log",
             "maxquant-command.log",
             [
@@ -658,44 +1436,59 @@ def main():
                 "sites",
             ],
         )
-    else:
-        copy_job = CopySpec(
-            wf_id="proteomics_msgfplus",
-            project=project_name,
-            source_location=origin,
-            destination_location=destination,
-            dry_run=args.dry_run,
-        )
-        logger.info("PROTEOMICS METHOD: msgfplus")
-        if "inputs" in copy_job.metadata:
-            is_ptm = copy_job.wf_inputs.get("isPTM") or (
-                copy_job.wf_inputs.get("proteomics_experiment") != "pr"
-            )
-            if is_ptm is None:
-                logger.warning("Unable to determine if PTM experiment, no key found")
-                is_ptm = False
+        return
 
-            if is_ptm:
-                logger.info("######## PTM PROTEOMICS EXPERIMENT ########")
-            else:
-                logger.info(
-                    "####### GLOBAL PROTEIN ABUNDANCE EXPERIMENT #######",
-                )
-        if args.copy_what == "full":
-            logger.info("Ready to copy ALL MSGF-plus outputs")
+    if copy_what == "full":
+        logger.info("Ready to copy ALL MSGF-plus outputs")
+
+        if copy_job.has_call("ascore"):
+            copy_job.create_task(
+                task_id="ascore",
+                stdout_filename=lambda x: f"{x['inputs']['seq_file_id']}-ascore-stdout.log",
+                command_filename="ascore-command.log",
+                outputs=[
+                    "syn_plus_ascore",
+                    "syn_ascore",
+                    "syn_ascore_proteinmap",
+                    "output_ascore_logfile",
+                ],
+            )
 
-            if "proteomics_msgfplus.ascore" in copy_job.metadata["calls"]:
+        # fused_search runs the MS-GF+ tryptic search, MZRefiner, PPMErrorCharter
+        # and the identification search as a single task: its outputs go to the
+        # same folders as the per-task outputs
+        if copy_job.has_call("msgf_fused_search"):
+            fused_outputs = {
+                "msgf_tryptic": ["mzid"],
+                "msconvert_mzrefiner": ["mzml_fixed"],
+                "msgf_identification": ["rename_mzmlfixed", "mzid_final"],
+            }
+            if copy_job.wf_inputs.get("fused_ppm_errorcharter", True):
+                fused_outputs["ppm_errorcharter"] = [
+                    "ppm_masserror_png",
+                    "ppm_histogram_png",
+                ]
+            for task_id, outputs in fused_outputs.items():
+                # the stdout and command are copied once, with the final outputs
+                is_final = task_id == "msgf_identification"
                 copy_job.create_task(
-                    task_id="ascore",
-                    stdout_filename=lambda x: f"{x['inputs']['seq_file_id']}-ascore-stdout.log",
-                    command_filename="ascore-command.log",
-                    outputs=[
-                        "syn_plus_ascore",
-                        "syn_ascore",
-                        "syn_ascore_proteinmap",
-                        "output_ascore_logfile",
-                    ],
+                    task_id="msgf_fused_search",
+                    stdout_filename=(
+                        (lambda x: f"{x['inputs']['sample_id']}-msgf_fused_search-stdout.log")
+                        if is_final
+                        else None
+                    ),
+                    command_filename="msgf_fused_search-command.log" if is_final else None,
+                    outputs=outputs,
+                    output_folder=f"{copy_job.destination_folder}/{task_id}_outputs",
                 )
+        else:
+            copy_job.create_task(
+                task_id="msgf_tryptic",
+                stdout_filename=lambda x: f"{x['inputs']['sample_id']}" f"-msgf_tryptic-stdout.log",
+                command_filename="msgf_tryptic-command.log",
+                outputs=["mzid"],
+            )
 
             copy_job.create_task(
                 task_id="msconvert_mzrefiner",
@@ -711,104 +1504,112 @@ def main():
                 outputs=["ppm_masserror_png", "ppm_histogram_png"],
             )
 
-            copy_job.create_task(
-                task_id="masic",
-                stdout_filename=lambda x: f"{Path(x['inputs']['raw_file']).name.replace('.raw', '')}-masic-stdout.log",
-                command_filename="masic-command.log",
-                outputs=[
-                    "ReporterIons_output_file",
-                    "PeakAreaHistogram_output_file",
-                    "RepIonObsRateHighAbundance_output_file",
-                    "RepIonObsRate_output_txt_file",
-                    "MSMS_scans_output_file",
-                    "SICs_output_file",
-                    "MS_scans_output_file",
-                    "SICstats_output_file",
-                    "ScanStatsConstant_output_file",
-                    "RepIonStatsHighAbundance_output_file",
-                    "ScanStatsEx_output_file",
-                    "ScanStats_output_file",
-                    "PeakWidthHistogram_output_file",
-                    "RepIonStats_output_file",
-                    "DatasetInfo_output_file",
-                    "RepIonObsRate_output_png_file",
-                ],
-            )
+            # the files searched in chunks have no msgf_identification call
+            if copy_job.has_call("msgf_identification"):
+                copy_job.create_task(
+                    task_id="msgf_identification",
+                    stdout_filename=lambda x: f"{x['inputs']['sample_id']}-msgf_identification-stdout.log",
+                    command_filename="msgf_identification-command.log",
+                    outputs=["rename_mzmlfixed", "mzid_final"],
+                )
 
-            copy_job.create_task(
-                task_id="msconvert",
-                stdout_filename=lambda x: f"{Path(x['inputs']['raw_file']).name.replace('.raw', '')}-msconvert-stdout.log",
-                command_filename="msconvert-command.log",
-                outputs=["mzml"],
-            )
+            # the merged results of the files searched in chunks (identification_chunk_mb)
+            if copy_job.has_call("mzid_merge"):
+                copy_job.create_task(
+                    task_id="mzml_split",
+                    stdout_filename=None,
+                    command_filename=None,
+                    outputs=["rename_mzmlfixed"],
+                    output_folder=f"{copy_job.destination_folder}/msgf_identification_outputs",
+                )
+                # the logs of the chunk searches, e.g. SAMPLE-part0-msgf_identification-stdout.log
+                copy_job.create_task(
+                    task_id="msgf_identification_chunk",
+                    stdout_filename=lambda x: (
+                        f"{x['inputs']['sample_id']}-{Path(x['inputs']['input_fixed_mzml']).parent.name}"
+                        "-msgf_identification-stdout.log"
+                    ),
+                    command_filename="msgf_identification_chunk-command.log",
+                    outputs=[],
+                    output_folder=f"{copy_job.destination_folder}/msgf_identification_outputs",
+                )
+                copy_job.create_task(
+                    task_id="mzid_merge",
+                    stdout_filename=lambda x: f"{x['inputs']['sample_id']}-mzid_merge-stdout.log",
+                    command_filename="mzid_merge-command.log",
+                    outputs=["mzid_final"],
+                    output_folder=f"{copy_job.destination_folder}/msgf_identification_outputs",
+                )
 
-            copy_job.create_task(
-                task_id="msgf_identification",
-                stdout_filename=lambda x: f"{x['inputs']['sample_id']}-msgf_identification-stdout.log",
-                command_filename="msgf_identification-command.log",
-                outputs=["rename_mzmlfixed", "mzid_final"],
-            )
+        copy_job.create_task(
+            task_id="masic",
+            stdout_filename=lambda x: f"{Path(x['inputs']['raw_file']).name.replace('.raw', '')}-masic-stdout.log",
+            command_filename="masic-command.log",
+            outputs=[
+                "ReporterIons_output_file",
+                "PeakAreaHistogram_output_file",
+                "RepIonObsRateHighAbundance_output_file",
+                "RepIonObsRate_output_txt_file",
+                "MSMS_scans_output_file",
+                "SICs_output_file",
+                "MS_scans_output_file",
+                "SICstats_output_file",
+                "ScanStatsConstant_output_file",
+                "RepIonStatsHighAbundance_output_file",
+                "ScanStatsEx_output_file",
+                "ScanStats_output_file",
+                "PeakWidthHistogram_output_file",
+                "RepIonStats_output_file",
+                "DatasetInfo_output_file",
+                "RepIonObsRate_output_png_file",
+            ],
+        )
 
+        copy_job.create_task(
+            task_id="msconvert",
+            stdout_filename=lambda x: f"{Path(x['inputs']['raw_file']).name.replace('.raw', '')}-msconvert-stdout.log",
+            command_filename="msconvert-command.log",
+            outputs=["mzml"],
+        )
+
+        # not called when the sequence db index comes from the cache
+        if copy_job.has_call("msgf_sequences"):
             copy_job.create_task(
                 task_id="msgf_sequences",
                 stdout_filename="msgf_sequences-stdout.log",
                 command_filename="msgf_sequences-command.log",
-                outputs=["revcat_fasta, sequencedb_files"],
+                outputs=["revcat_fasta", "sequencedb_files"],
             )
 
-            copy_job.create_task(
-                task_id="msgf_tryptic",
-                stdout_filename=lambda x: f"{x['inputs']['sample_id']}" f"-msgf_tryptic-stdout.log",
-                command_filename="msgf_tryptic-command.log",
-                outputs=["mzid"],
-            )
-
-            copy_job.create_task(
-                task_id="phrp",
-                stdout_filename=lambda x: f"{Path(x['inputs']['input_tsv']).name.replace('.tsv', '')}-phrp-stdout.log",
-                command_filename="phrp-command.log",
-                outputs=[
-                    "syn_ResultToSeqMap",
-                    "fht",
-                    "PepToProtMapMTS",
-                    "syn_ProteinMods",
-                    "syn_SeqToProteinMap",
-                    "syn",
-                    "syn_ModSummary",
-                    "syn_SeqInfo",
-                    "syn_ModDetails",
-                ],
-            )
-
-            copy_job.create_task(
-                task_id="mzidtotsvconverter",
-                stdout_filename=lambda x: f"{x['inputs']['sample_id']}-mzidtotsvconverter-stdout.log",
-                command_filename="mzidtotsvconverter-command.log",
-                outputs=["tsv"],
-            )
+        copy_job.create_task(
+            task_id="phrp",
+            stdout_filename=lambda x: f"{Path(x['inputs']['input_tsv']).name.replace('.tsv', '')}-phrp-stdout.log",
+            command_filename="phrp-command.log",
+            outputs=[
+                "syn_ResultToSeqMap",
+                "fht",
+                "PepToProtMapMTS",
+                "syn_ProteinMods",
+                "syn_SeqToProteinMap",
+                "syn",
+                "syn_ModSummary",
+                "syn_SeqInfo",
+                "syn_ModDetails",
+            ],
+        )
 
-            if "proteomics_msgfplus.wrapper_pp" in copy_job.metadata["calls"]:
-                copy_job.create_task(
-                    task_id="wrapper_pp",
-                    stdout_filename=None,
-                    command_filename="wrapper_results-command.log",
-                    outputs=[
-                        "results_ratio",
-                        "results_rii",
-                        "final_output_masic_tar",
-                        "final_output_phrp_tar",
-                        "final_output_ascore",
-                    ],
-                )
-            else:
-                logger.error("(-) Plexed piper not available")
+        copy_job.create_task(
+            task_id="mzidtotsvconverter",
+            stdout_filename=lambda x: f"{x['inputs']['sample_id']}-mzidtotsvconverter-stdout.log",
+            command_filename="mzidtotsvconverter-command.log",
+            outputs=["tsv"],
+        )
 
-        elif args.copy_what == "ppinputs":
-            logger.info("Ready to copy ONLY PlexedPiper results + inputs")
+        if copy_job.has_call("wrapper_pp"):
             copy_job.create_task(
                 task_id="wrapper_pp",
                 stdout_filename=None,
-                command_filename=None,
+                command_filename="wrapper_results-command.log",
                 outputs=[
                     "results_ratio",
                     "results_rii",
@@ -816,34 +1617,159 @@ def main():
                     "final_output_phrp_tar",
                     "final_output_ascore",
                 ],
-                output_folder=copy_job.destination_folder,
-                inputs=[
-                    ("fasta_sequence_db", ""),
-                    ("sd_samples", "study_design"),
-                    ("sd_fractions", "study_design"),
-                    ("sd_references", "study_design"),
-                ],
             )
+        elif not copy_job.running:
+            logger.error("(-) Plexed piper not available")
 
-        elif args.copy_what == "results":
-            logger.info("Ready to copy ONLY PlexedPiper (RII + Ratio) results")
-            if "proteomics_msgfplus.wrapper_pp" in copy_job.metadata["calls"]:
-                copy_job.create_task(
-                    task_id="wrapper_pp",
-                    stdout_filename=None,
-                    command_filename=None,
-                    outputs=["results_ratio", "results_rii"],
-                    output_folder=f"{copy_job.destination_folder}",
-                )
+    elif copy_what == "ppinputs":
+        logger.info("Ready to copy ONLY PlexedPiper results + inputs")
+        copy_job.create_task(
+            task_id="wrapper_pp",
+            stdout_filename=None,
+            command_filename=None,
+            outputs=[
+                "results_ratio",
+                "results_rii",
+                "final_output_masic_tar",
+                "final_output_phrp_tar",
+                "final_output_ascore",
+            ],
+            output_folder=copy_job.destination_folder,
+            inputs=[
+                ("fasta_sequence_db", ""),
+                ("sd_samples", "study_design"),
+                ("sd_fractions", "study_design"),
+                ("sd_references", "study_design"),
+            ],
+        )
+
+    elif copy_what == "results":
+        logger.info("Ready to copy ONLY PlexedPiper (RII + Ratio) results")
+        if copy_job.has_call("wrapper_pp"):
+            copy_job.create_task(
+                task_id="wrapper_pp",
+                stdout_filename=None,
+                command_filename=None,
+                outputs=["results_ratio", "results_rii"],
+                output_folder=f"{copy_job.destination_folder}",
+            )
+        elif not copy_job.running:
+            logger.error("(-) Plexed piper not available")
+    else:
+        err_msg = "You should not have gotten here"
+        raise ValueError(err_msg)
+
+
+def main():
+    parser = create_args()
+    args = parser.parse_args()
+    profiling.start(args.profile)
+    if args.index is not None and (args.watch or args.metadata is not None):
+        parser.error("-x/--index reads the metadata.json of the origin folder, it cannot "
+                     "be used with --watch or --metadata")
+    if args.watch and args.metadata is None:
+        parser.error("--watch requires --metadata: Caper writes the metadata.json of the "
+                     "origin folder only when the workflow has finished")
+    # flush the queued log records on exit
+    atexit.register(setup_logging(args.log_file, args.verbose).stop)
+    logger = logging.LoggerAdapter(base_logger, {"task": "General"})
+    copy_filter = create_copy_filter(args)
+    if copy_filter.samples is not None:
+        logger.info("Selected samples: %d", len(copy_filter.samples))
+    if copy_filter.tasks is not None:
+        logger.info("Selected tasks: %s", ", ".join(sorted(copy_filter.tasks)))
+    if copy_filter.outputs is not None:
+        logger.info("Selected outputs: %s", ", ".join(copy_filter.outputs))
+
+    if args.parquet:
+        try:
+            import parquet_tables  # noqa: F401
+        except ImportError:
+            print("Please pip install `pyarrow` to use --parquet", file=sys.stderr)
+            sys.exit(1)
+
+    # the copy threads, as many as connections in the storage client pool
+    global _DEFAULT_POOL
+    _DEFAULT_POOL = ThreadPoolExecutor(max_workers=args.max_workers)
+
+    project_name = args.project.rstrip("/")
+    logger.info("GCP project: %s", project_name)
+    origin = args.origin.rstrip("/")
+    logger.info("Origin: %s", origin)
+    destination = args.destination.rstrip("/")
+    logger.info("Destination: %s", destination)
+    method_proteomics = args.method_proteomics
+    logger.info("+ Proteomics Pipeline METHOD: %s", method_proteomics)
+
+    if args.dry_run:
+        logger.info("This is a dry run, no files will be copied")
+
+    metadata_source = None
+    if args.metadata is not None:
+        try:
+            metadata_source = open_metadata_source(
+                args.metadata, Path(origin).name, COPY_METADATA_KEYS
+            )
+        except ValueError as e:
+            parser.error(str(e))
+    if args.watch and args.checkpoint is None:
+        args.checkpoint = WATCH_CHECKPOINT
+    if args.watch:
+        logger.info(
+            "Watching the workflow every %.0f s, checkpoint: %s",
+            args.poll_seconds,
+            args.checkpoint,
+        )
+
+    copy_job = CopySpec(
+        wf_id=f"proteomics_{method_proteomics}",
+        project=project_name,
+        source_location=origin,
+        destination_location=destination,
+        dry_run=args.dry_run,
+        max_workers=args.max_workers,
+        parquet=args.parquet,
+        explode=args.explode,
+        copy_filter=copy_filter,
+        index=args.index,
+        rollup_seconds=args.rollup_seconds,
+        metadata_source=metadata_source,
+        checkpoint=CopyCheckpoint(
+            None if args.dry_run else args.checkpoint,
+            copy_filter.signature(args.copy_what, args.parquet, args.explode),
+        ),
+        watch=args.watch,
+    )
+    if method_proteomics == "maxquant":
+        logger.info("PROTEOMICS METHOD: maxquant")
+        logger.info("+ Copy MAXQUANT outputs-----------------------------")
+    else:
+        logger.info("PROTEOMICS METHOD: msgfplus")
+        if "inputs" in copy_job.metadata:
+            is_ptm = copy_job.wf_inputs.get("isPTM") or (
+                copy_job.wf_inputs.get("proteomics_experiment") != "pr"
+            )
+            if is_ptm is None:
+                logger.warning("Unable to determine if PTM experiment, no key found")
+                is_ptm = False
+
+            if is_ptm:
+                logger.info("######## PTM PROTEOMICS EXPERIMENT ########")
             else:
-                logger.error("(-) Plexed piper not available")
-        else:
-            err_msg = "You should not have gotten here"
-            raise ValueError(err_msg)
+                logger.info(
+                    "####### GLOBAL PROTEIN ABUNDANCE EXPERIMENT #######",
+                )
 
+    if args.watch:
+        copy_job.watch(
+            lambda job: plan_copy(job, method_proteomics, args.copy_what), args.poll_seconds
+        )
+    else:
+        plan_copy(copy_job, method_proteomics, args.copy_what)
         copy_job.run_tasks()
-        _DEFAULT_POOL.shutdown(wait=True, cancel_futures=False)
-        logger.info("All Done!")
+    _DEFAULT_POOL.shutdown(wait=True, cancel_futures=False)
+    copy_job.log_metrics()
+    logger.info("All Done!")
 
 
 if __name__ == "__main__":
@@ -5,7 +5,14 @@ import sys
 import warnings
 from pathlib import Path
 
-from google.cloud import storage
+from gcs_client import get_storage_client
+from maxquant_sizing import DEFAULT_MODEL, candidate_shapes, choose_shape, load_model
+from mqpar import (
+    dump_mqpar, load_mqpar, raw_file_name, read_experimental_design, render_mqpar,
+    single_file_mqpar, validate_mqpar,
+)
+import profiling
+from stage_raw_files import read_raw_manifest
 
 
 warnings.filterwarnings(
@@ -27,7 +34,9 @@ def arg_parser():
     )
     parser.add_argument(
         '-p', '--parameters_maxquant', required=True, type=str,
-        help='MaxQuant parameter FILE location on GCP (relative to bucket_name_config)'
+        help='MaxQuant parameter FILE location on GCP (relative to bucket_name_config). '
+             'It is used as a template: the raw files, sequence db and number of threads '
+             'are filled in'
     )
     parser.add_argument(
         '-q', '--sequence_db', required=True, type=str,
@@ -35,12 +44,19 @@ def arg_parser():
              'folder)'
     )
     parser.add_argument(
-        '-v', '--bucket_name_raw', required=True, type=str,
-        help='Bucket name with raw files'
+        '-v', '--bucket_name_raw', required=False, type=str,
+        help='Bucket name with raw files. Required unless -j is used'
+    )
+    parser.add_argument(
+        '-f', '--folder_raw', required=False, type=str,
+        help='Full path to the proteomics raw files on GCP, without including bucket '
+             'name. Required unless -j is used'
     )
     parser.add_argument(
-        '-f', '--folder_raw', required=True, type=str,
-        help='Full path to the proteomics raw files on GCP, without including bucket name'
+        '-j', '--raw_manifest', required=False, type=str,
+        help='Optional: manifest of the raw files uploaded by stage_raw_files.py. The '
+             'raw files and their sizes are taken from it instead of listing '
+             '<folder_raw>'
     )
     parser.add_argument(
         '-d', '--docker_respository', required=True, type=str,
@@ -58,13 +74,114 @@ def arg_parser():
         '-e', '--experiment_prot', required=True, type=str,
         help='Proteomics experiment. One of the following: pr, ph, ub, ac'
     )
+    parser.add_argument(
+        '-t', '--target_hours', required=False, type=float, default=24,
+        help='Target MaxQuant wall time in hours: the cheapest VM shape predicted to '
+             'meet it is chosen. Default: 24'
+    )
+    parser.add_argument(
+        '-z', '--sizing_model', required=False, type=str, default=str(DEFAULT_MODEL),
+        help='MaxQuant sizing model (JSON). Refit it from past runs with '
+             'maxquant_sizing.py'
+    )
+    parser.add_argument(
+        '-s', '--scatter', action='store_true',
+        help='Generate the configuration for the scatter/gather workflow '
+             '(proteomics_maxquant_scatter.wdl): the per raw file steps run on '
+             'separate VMs and the combined steps on a final one. Default: FALSE'
+    )
+    parser.add_argument(
+        '-x', '--experimental_design', required=False, type=str,
+        help='Optional: local MaxQuant experimental design file (tab separated with '
+             'the columns Name, Fraction and Experiment). By default, every raw file '
+             'is its own experiment without fractions'
+    )
+    profiling.add_argument(parser)
     return parser
 
 
+def write_mqpar_files(storage_client, bucket_name_config, parameters_maxquant,
+                      raw_files, sequence_db, ncpu, file_ncpu, design,
+                      output_folder_local, config_name):
+    """
+    Renders the MaxQuant parameter template (mqpar.xml) for the raw files and the
+    allocated CPUs, validates it and writes it locally (next to the config file) and
+    next to the template on GCP. If <file_ncpu> is given (scatter workflow), one
+    single raw file mqpar.xml is also written per raw file.
+
+    :param storage_client: The storage client
+    :param bucket_name_config: Bucket name with config files
+    :param parameters_maxquant: MaxQuant parameter template location (relative to
+        bucket)
+    :param raw_files: The raw files (gs:// paths)
+    :param sequence_db: The sequence db (gs:// path)
+    :param ncpu: The number of CPUs of the (combined) MaxQuant task
+    :param file_ncpu: The number of CPUs of the per raw file tasks, or None
+    :param design: Mapping of raw file name to (experiment, fraction), or None
+    :param output_folder_local: Path to which JSON outputs are written
+    :param config_name: The config file name without extension
+    :return: The gs:// path of the rendered mqpar.xml and the list of gs:// paths of
+        the single raw file mqpar.xml files
+    :rtype: tuple[str, list[str]]
+    """
+    bucket = storage_client.bucket(bucket_name_config)
+    mqpar_blob = bucket.get_blob(parameters_maxquant)
+    if mqpar_blob is None:
+        print("\n\tERROR: MaxQuant parameter file not found: ", parameters_maxquant)
+        sys.exit(1)
+    template = load_mqpar(mqpar_blob.download_as_bytes().decode('utf-8'))
+
+    try:
+        root = render_mqpar(template, raw_files, sequence_db, ncpu, design)
+    except ValueError as e:
+        print("\n\tERROR: ", e)
+        sys.exit(1)
+    errors = validate_mqpar(root, ncpu)
+    if errors:
+        print("\n\tERROR: Invalid MaxQuant parameters:")
+        for error in errors:
+            print("\t- ", error)
+        sys.exit(1)
+    print("+ MaxQuant parameters rendered: ", len(raw_files), "raw files,",
+          ncpu, "threads")
+
+    gcp_folder = os.path.dirname(parameters_maxquant)
+    gcp_name = f'{gcp_folder}/{config_name}-mqpar.xml'.lstrip('/')
+    text = dump_mqpar(root)
+    with open(os.path.join(output_folder_local, f'{config_name}-mqpar.xml'), 'w',
+              encoding="utf-8") as outfile:
+        outfile.write(text)
+    bucket.blob(gcp_name).upload_from_string(text, content_type='text/xml')
+    print("+ MaxQuant parameters uploaded to: ", f'gs://{bucket_name_config}/{gcp_name}')
+
+    mqpar_files = []
+    if file_ncpu is None:
+        return f'gs://{bucket_name_config}/{gcp_name}', mqpar_files
+
+    local_folder = os.path.join(output_folder_local, f'{config_name}-mqpar')
+    Path(local_folder).mkdir(parents=True, exist_ok=True)
+    gcp_folder = f'{gcp_folder}/{config_name}-mqpar'.lstrip('/')
+
+    for raw_file in raw_files:
+        raw_name = raw_file_name(raw_file)
+        text = single_file_mqpar(root, raw_name, file_ncpu)
+        with open(os.path.join(local_folder, f'{raw_name}.xml'), 'w', encoding="utf-8") as outfile:
+            outfile.write(text)
+        bucket.blob(f'{gcp_folder}/{raw_name}.xml').upload_from_string(
+            text, content_type='text/xml'
+        )
+        mqpar_files.append(f'gs://{bucket_name_config}/{gcp_folder}/{raw_name}.xml')
+
+    print("+ Single raw file mqpar.xml files uploaded to: ",
+          f'gs://{bucket_name_config}/{gcp_folder}')
+    return f'gs://{bucket_name_config}/{gcp_name}', mqpar_files
+
+
 def main():
     # PROCESS ARGUMENTS
     parser = arg_parser()
     args = parser.parse_args()
+    profiling.start(args.profile)
 
     gcp_project = args.gcp_project
     bucket_name_config = args.bucket_name_config.rstrip('/')
@@ -75,9 +192,15 @@ def main():
     sequence_db = args.sequence_db.rstrip('/')
     sequence_db_full = 'gs://' + bucket_name_config + '/' + sequence_db
 
-    bucket_name_raw = args.bucket_name_raw.rstrip('/')
-    folder_raw = args.folder_raw.rstrip('/')
-    full_folder_raw = 'gs://' + bucket_name_raw + '/' + folder_raw
+    if args.raw_manifest is None and (args.bucket_name_raw is None or args.folder_raw is None):
+        parser.error('-v/--bucket_name_raw and -f/--folder_raw are required without '
+                     '-j/--raw_manifest')
+    if args.raw_manifest is None:
+        bucket_name_raw = args.bucket_name_raw.rstrip('/')
+        folder_raw = args.folder_raw.rstrip('/')
+        full_folder_raw = 'gs://' + bucket_name_raw + '/' + folder_raw
+    else:
+        full_folder_raw = args.raw_manifest
 
     docker_repository = args.docker_respository.rstrip('/')
 
@@ -85,12 +208,16 @@ def main():
     output_config_yaml = args.output_config_yaml
 
     experiment_prot = args.experiment_prot
+    wf_id = 'proteomics_maxquant_scatter' if args.scatter else 'proteomics_maxquant'
 
     # Summary to the user
     print("\nWRITE JSON CONFIG FILE FOR MAXQUANT PROTEOMICS PIPELINE")
     print("----------------------------------------------")
     print("+ GCP gcp_project:", gcp_project)
-    print("+ Raw file location: ", full_folder_raw)
+    if args.raw_manifest is None:
+        print("+ Raw file location: ", full_folder_raw)
+    else:
+        print("+ Raw file manifest: ", full_folder_raw)
     # print("+ Study design location: ", full_study_design)
     print("+ MaxQuant parameters FILE location: ", parameters_maxquant_full)
     print("+ Docker repository: ", docker_repository)
@@ -102,9 +229,14 @@ def main():
     print("+ Proteomics experiment: ", experiment_prot)
 
     # Load maxquant template file
-    template = os.path.join(
-        dirname, f'inputs/templates/maxquant/config-maxquant.json'
-    )
+    if args.scatter:
+        template = os.path.join(
+            dirname, f'inputs/templates/maxquant/config-maxquant-scatter.json'
+        )
+    else:
+        template = os.path.join(
+            dirname, f'inputs/templates/maxquant/config-maxquant.json'
+        )
     # READ TEMPLATE CONFIG FILE
     print('+ Template json: ', template)
 
@@ -115,21 +247,31 @@ def main():
         # print(json.dumps(json_data, indent=4, sort_keys=True))
 
     # Load and process raw files' blobs
-    storage_client = storage.Client(gcp_project)
-    all_blobs = storage_client.list_blobs(bucket_name_raw, prefix=folder_raw)
-
-    print("+ Load raw files from GCP")
-
-    i = 0
-    raw_files = []
-
-    for blob in all_blobs:
-        if blob.name.endswith('.raw'):
-            filename = blob.name
-            # print('\t- Raw file location: ', filename)
-            a = 'gs://' + bucket_name_raw + '/' + filename
-            raw_files.append(a)
-            i += 1
+    storage_client = get_storage_client(gcp_project)
+    if args.raw_manifest is not None:
+        # the exact list uploaded by stage_raw_files.py, without listing the bucket
+        all_blobs = []
+        manifest = read_raw_manifest(args.raw_manifest)
+        raw_files = [entry['raw_file'] for entry in manifest]
+        raw_sizes = [entry['size'] for entry in manifest]
+        i = len(raw_files)
+        print("+ Load raw files from the manifest")
+    else:
+        all_blobs = storage_client.list_blobs(bucket_name_raw, prefix=folder_raw)
+        i = 0
+        raw_files = []
+        raw_sizes = []
+        print("+ Load raw files from GCP")
+
+    with profiling.span('listing'):
+        for blob in all_blobs:
+            if blob.name.endswith('.raw'):
+                filename = blob.name
+                # print('\t- Raw file location: ', filename)
+                a = 'gs://' + bucket_name_raw + '/' + filename
+                raw_files.append(a)
+                raw_sizes.append(blob.size)
+                i += 1
 
     # CHECK POINT IF RAW FILES ARE NOT FOUND
     if i == 0:
@@ -138,30 +280,54 @@ def main():
     else:
         print("+ Total number of raw files found: ", i)
 
-    # Assign number of CPUs
-    ncpu = 0
-    mq_ram_gb = 0
-
-    if i >= 95:
-        ncpu = 95
-        mq_ram_gb = 95 * 4
-    else:
-        ncpu = i
-        mq_ram_gb = i * 4
+    # Assign number of CPUs and RAM from the sizing model
+    print("+ Total size of raw files (GB): ", round(sum(raw_sizes) / 1024 ** 3, 1))
+    with profiling.span('sizing'):
+        sizing_model = load_model(args.sizing_model)
+        candidates = candidate_shapes(sizing_model, raw_sizes)
+        shape = choose_shape(sizing_model, raw_sizes, args.target_hours)
+    for candidate in sorted(candidates, key=lambda x: x['ncpu']):
+        print(f"\t- {candidate['ncpu']} CPUs, {candidate['ramGB']} GB: "
+              f"{candidate['hours']:.1f} h, ${candidate['cost']:.2f}")
+
+    if shape['hours'] > args.target_hours:
+        print(f"+ WARNING: no VM shape is predicted to finish within "
+              f"{args.target_hours} hours. Using the fastest one")
+    ncpu = shape['ncpu']
+    mq_ram_gb = shape['ramGB']
+    print(f"+ VM shape: {ncpu} CPUs, {mq_ram_gb} GB "
+          f"(predicted {shape['hours']:.1f} h, ${shape['cost']:.2f})")
 
     # WRITE JSON FILE
 
     # DOCKER CPUS and RAM
-    json_data['proteomics_maxquant.mq_ncpu'] = ncpu
-    json_data['proteomics_maxquant.mq_ramGB'] = mq_ram_gb
+    json_data[f'{wf_id}.mq_ncpu'] = ncpu
+    json_data[f'{wf_id}.mq_ramGB'] = mq_ram_gb
 
     # RAW-FILES
-    json_data['proteomics_maxquant.raw_file'] = raw_files
+    json_data[f'{wf_id}.raw_file'] = raw_files
 
     # SEQUENCE DB
-    json_data['proteomics_maxquant.fasta_sequence_db'] = sequence_db_full
+    json_data[f'{wf_id}.fasta_sequence_db'] = sequence_db_full
 
-    json_data['proteomics_maxquant.mq_parameters'] = parameters_maxquant_full
+    # MAXQUANT PARAMETERS: rendered from the template for the allocated CPUs
+    design = None
+    if args.experimental_design is not None:
+        with open(args.experimental_design, encoding="utf-8") as design_file:
+            design = read_experimental_design(design_file.read())
+    Path(output_folder_local).mkdir(parents=True, exist_ok=True)
+    with profiling.span('mqpar render'):
+        mq_parameters, mq_parameters_per_file = write_mqpar_files(
+            storage_client, bucket_name_config, parameters_maxquant, raw_files,
+            sequence_db_full, ncpu,
+            json_data.get(f'{wf_id}.mq_file_ncpu') if args.scatter else None,
+            design, output_folder_local, Path(output_config_yaml).stem
+        )
+    json_data[f'{wf_id}.mq_parameters'] = mq_parameters
+
+    # SCATTER: one mqpar.xml per raw file
+    if args.scatter:
+        json_data[f'{wf_id}.mq_parameters_per_file'] = mq_parameters_per_file
 
     for (k, v) in json_data.items():
         if 'docker-repository' in str(v):
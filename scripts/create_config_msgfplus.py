@@ -1,10 +1,15 @@
 import argparse
+import csv
+import io
 import json
 import os
 import warnings
 from pathlib import Path
 
-from google.cloud import storage
+import profiling
+import sequence_db_cache
+from gcs_client import get_storage_client
+from stage_raw_files import read_raw_manifest
 
 
 warnings.filterwarnings(
@@ -121,11 +126,20 @@ def create_arguments():
     parser.add_argument(
         "-f",
         "--folder_raw",
-        required=True,
+        required=False,
         type=str,
         help="Full path to the proteomics raw files on GCP, without including bucket "
         "name relative to bucket_name_raw (if it is different from "
-        "bucket_name_config)",
+        "bucket_name_config). Required unless -j is used",
+    )
+    parser.add_argument(
+        "-j",
+        "--raw_manifest",
+        required=False,
+        type=str,
+        help="Optional: manifest of the raw files uploaded by stage_raw_files.py. "
+        "The raw files and their sizes are taken from it instead of listing "
+        "<folder_raw>",
     )
     parser.add_argument(
         "-d",
@@ -182,6 +196,63 @@ def create_arguments():
         type=str,
         help="Name of Protein database (either RefSeq or UniProt)",
     ),
+    parser.add_argument(
+        "-n",
+        "--n_subconfigs",
+        required=False,
+        type=int,
+        default=1,
+        help="Optional: split the raw files by plex (according to the study design "
+        "fractions.txt) into N configuration files that can run concurrently. "
+        "PlexedPiper is then run once on the merged outputs "
+        "(see create_config_plexedpiper.py). Default: 1 (no split)",
+    ),
+    parser.add_argument(
+        "-k",
+        "--sequence_db_cache",
+        required=False,
+        type=str,
+        help="Optional: MS-GF+ sequence db index cache location (e.g. "
+        "gs://bucket/msgfplus-sequence-db-cache). If the index of the sequence db is "
+        "cached, the workflow skips msgf_sequences (see sequence_db_cache.py)",
+    ),
+    parser.add_argument(
+        "-z",
+        "--msgf_heap_headroom_mb",
+        required=False,
+        type=int,
+        help="Optional: memory (MB) of the MS-GF+ VMs left out of the Java heap for "
+        "the JVM itself and the OS. The heap is msgf_ramGB minus this headroom. "
+        "Default: 2048 (workflow default)",
+    ),
+    parser.add_argument(
+        "-t",
+        "--msgf_threads",
+        required=False,
+        type=int,
+        help="Optional: number of MS-GF+ search threads. Default: msgf_ncpu",
+    ),
+    parser.add_argument(
+        "-w",
+        "--fused_search",
+        action="store_true",
+        help="Run the MS-GF+ tryptic search, MZRefiner, PPMErrorCharter and the "
+        "identification search of every raw file as a single task on one VM "
+        "(msgf_* resources, fused_search_docker). The outputs are the same. "
+        "Default: FALSE (one task per step)",
+    ),
+    parser.add_argument(
+        "-l",
+        "--identification_chunk_mb",
+        required=False,
+        type=int,
+        help="Optional: split the refined mzML file of every raw file into one chunk "
+        "per this many MB (at most identification_max_chunks chunks, a workflow "
+        "input) and run the MS-GF+ identification search of the chunks in parallel. "
+        "The results are merged into a single mzid file. "
+        "Not used with -w. Default: 0 (one search per file)",
+    )
+    profiling.add_argument(parser)
 
     return parser
 
@@ -204,12 +275,19 @@ class MSGFConfigurationGenerator:
     pr_ratio: str
     bucket_name_raw: str
     folder_raw: str
+    raw_manifest: str
     docker_msgf: str
     refine_prior: bool
     unique_only: bool
     sequence_db_name: str
     output_folder_local: str
     output_config_json: str
+    n_subconfigs: int
+    sequence_db_cache: str
+    msgf_heap_headroom_mb: int
+    msgf_threads: int
+    fused_search: bool
+    identification_chunk_mb: int
 
     def __init__(self):
         """
@@ -221,10 +299,12 @@ class MSGFConfigurationGenerator:
         parser = create_arguments()
         self._parser = parser
         self.args = parser.parse_args()
+        profiling.start(self.args.profile)
         for key, val in self.args.__dict__.items():
             setattr(self, key, val)
         self.template = None
         self.json_data = None
+        self.raw_file_sizes = {}
 
     def sanitize_options(self):
         """
@@ -237,11 +317,6 @@ class MSGFConfigurationGenerator:
         parameters_msgf = self.args.parameters_msgf.rstrip("/")
         self.parameters_msgf = f"gs://{self.bucket_name_config}/{parameters_msgf}"
 
-        study_design_location = self.args.study_design_location.rstrip("/")
-        self.study_design_location = (
-            f"gs://{self.bucket_name_raw}/{study_design_location}"
-        )
-
         sequence_db = self.args.sequence_db.rstrip("/")
         self.sequence_db = f"gs://{self.bucket_name_config}/{sequence_db}"
 
@@ -250,8 +325,16 @@ class MSGFConfigurationGenerator:
         else:
             self.bucket_name_raw = self.bucket_name_config
 
-        folder_raw = self.args.folder_raw.rstrip("/")
-        self.folder_raw = f"gs://{self.bucket_name_raw}/{folder_raw}"
+        study_design_location = self.args.study_design_location.rstrip("/")
+        self.study_design_location = (
+            f"gs://{self.bucket_name_raw}/{study_design_location}"
+        )
+
+        if self.raw_manifest is None and self.folder_raw is None:
+            self._parser.error("one of -f/--folder_raw or -j/--raw_manifest is required")
+        if self.folder_raw is not None:
+            folder_raw = self.args.folder_raw.rstrip("/")
+            self.folder_raw = f"gs://{self.bucket_name_raw}/{folder_raw}"
 
         self.docker_msgf = self.args.docker_msgf.rstrip("/")
 
@@ -267,7 +350,10 @@ class MSGFConfigurationGenerator:
         print("----------------------------------------------")
         print("+ GCP gcp_project:", self.gcp_project)
         print("+ Quantification method:", self.quant_method)
-        print("+ Raw file location: ", self.folder_raw)
+        if self.raw_manifest is not None:
+            print("+ Raw file manifest: ", self.raw_manifest)
+        else:
+            print("+ Raw file location: ", self.folder_raw)
         print("+ Study design location: ", self.study_design_location)
         print("+ MSGFplus parameter FOLDER location: ", self.parameters_msgf)
         print("+ Docker registry for MSGF containers: ", self.docker_msgf)
@@ -276,6 +362,14 @@ class MSGFConfigurationGenerator:
             print(
                 "+ Global proteomics file (for prioritized inference): ", self.pr_ratio
             )
+        if self.sequence_db_cache is not None:
+            print("+ Sequence db index cache: ", self.sequence_db_cache)
+        if self.fused_search:
+            print("+ Fused MS-GF+ search: TRUE")
+        if self.identification_chunk_mb:
+            print(
+                "+ MS-GF+ identification chunks (MB): ", self.identification_chunk_mb
+            )
 
     def load_template(self):
         """
@@ -335,8 +429,16 @@ class MSGFConfigurationGenerator:
         :return: A list of strings with the raw files formatted
         :rtype: list[str]
         """
+        if self.raw_manifest is not None:
+            # the exact list uploaded by stage_raw_files.py, without listing the bucket
+            entries = read_raw_manifest(self.raw_manifest)
+            for entry in entries:
+                self.raw_file_sizes[entry["raw_file"]] = entry["size"]
+            print("+ Total number of raw files in the manifest: ", len(entries))
+            return [entry["raw_file"] for entry in entries]
+
         # Load and process raw files' blobs
-        storage_client = storage.Client(self.gcp_project)
+        storage_client = get_storage_client(self.gcp_project)
         all_blobs = storage_client.list_blobs(
             self.bucket_name_raw, prefix=self.args.folder_raw
         )
@@ -349,6 +451,7 @@ class MSGFConfigurationGenerator:
                 filename = blob.name
                 a = "gs://" + self.bucket_name_raw + "/" + filename
                 raw_files.append(a)
+                self.raw_file_sizes[a] = blob.size
 
         # CHECK POINT IF RAW FILES ARE NOT FOUND
         if len(raw_files) == 0:
@@ -368,7 +471,8 @@ class MSGFConfigurationGenerator:
                 "proteomics_msgfplus.results_prefix"
             ] = "omicspipelines-prot-results"
 
-        raw_files = self.load_and_process_raw_files()
+        with profiling.span("listing"):
+            raw_files = self.load_and_process_raw_files()
 
         # WRITE JSON FILE
         # RAW-FILES
@@ -398,6 +502,23 @@ class MSGFConfigurationGenerator:
                 self.json_data[k] = self.json_data[k].replace(
                     "docker-repository", self.docker_msgf
                 )
+        # MS-GF+ JVM HEAP AND THREADS
+        self.set_msgf_heap_and_threads()
+        # FUSED SEARCH: tryptic search, mzRefiner and identification on one VM
+        if self.fused_search:
+            self.json_data["proteomics_msgfplus.fused_search"] = True
+        # IDENTIFICATION SEARCH BY MZML CHUNKS
+        if self.identification_chunk_mb is not None:
+            if self.identification_chunk_mb < 0:
+                raise ValueError("The identification chunk size must be 0 or more")
+            if self.fused_search:
+                print("+ WARNING: identification chunks are not used with -w")
+            self.json_data[
+                "proteomics_msgfplus.identification_chunk_mb"
+            ] = self.identification_chunk_mb
+        # SEQUENCE DB INDEX (skips msgf_sequences if already built)
+        if self.sequence_db_cache is not None:
+            self.use_sequence_db_cache()
         # RESULTS FILE NAME:
         if self.results_prefix is not None:
             self.json_data["proteomics_msgfplus.results_prefix"] = self.results_prefix
@@ -410,7 +531,7 @@ class MSGFConfigurationGenerator:
         if self.pr_ratio is not None:
             self.json_data["proteomics_msgfplus.pr_ratio"] = self.pr_ratio
         else:
-            if "pr_ratio" in self.json_data:
+            if "proteomics_msgfplus.pr_ratio" in self.json_data:
                 del self.json_data["proteomics_msgfplus.pr_ratio"]
 
         # QUANTIFICATION METHODS: check supported options
@@ -436,15 +557,236 @@ class MSGFConfigurationGenerator:
         # print('self.proteomics_experiment = ', self.proteomics_experiment)
         return self.json_data
 
+    def set_msgf_heap_and_threads(self):
+        """
+        Sets the MS-GF+ heap headroom and search threads, and checks them against the
+        memory and CPUs of the MS-GF+ VMs
+
+        :raise: ValueError
+        """
+        ram_gb = self.json_data["proteomics_msgfplus.msgf_ramGB"]
+        ncpu = self.json_data["proteomics_msgfplus.msgf_ncpu"]
+        headroom_mb = self.json_data.get(
+            "proteomics_msgfplus.msgf_heap_headroom_mb", 2048
+        )
+        if self.msgf_heap_headroom_mb is not None:
+            headroom_mb = self.msgf_heap_headroom_mb
+            self.json_data["proteomics_msgfplus.msgf_heap_headroom_mb"] = headroom_mb
+        heap_mb = ram_gb * 1024 - headroom_mb
+        if heap_mb < 1024:
+            raise ValueError(
+                f"The MS-GF+ heap would be {heap_mb} MB: the headroom "
+                f"({headroom_mb} MB) must leave at least 1 GB of the "
+                f"{ram_gb} GB of msgf_ramGB"
+            )
+
+        threads = ncpu
+        if self.msgf_threads is not None:
+            if self.msgf_threads < 1:
+                raise ValueError("The number of MS-GF+ threads must be at least 1")
+            if self.msgf_threads > ncpu:
+                print(
+                    f"+ WARNING: {self.msgf_threads} MS-GF+ threads on "
+                    f"{ncpu} CPUs (msgf_ncpu)"
+                )
+            threads = self.msgf_threads
+            self.json_data["proteomics_msgfplus.msgf_threads"] = threads
+        print(f"+ MS-GF+ Java heap: {heap_mb} MB, search threads: {threads}")
+
+    def use_sequence_db_cache(self):
+        """
+        Looks up the MS-GF+ index of the sequence db in the cache and, if found, adds
+        it to the configuration so that the workflow does not build it again
+        """
+        storage_client = get_storage_client(self.gcp_project)
+        cached = sequence_db_cache.lookup(
+            storage_client,
+            self.sequence_db_cache,
+            self.sequence_db,
+            self.json_data["proteomics_msgfplus.msgf_docker"],
+        )
+        if cached is None:
+            print(
+                "+ Sequence db index not cached yet: msgf_sequences will build it "
+                "(cache it after the run with sequence_db_cache.py)"
+            )
+            return
+        for key, value in cached.items():
+            print(f"+ Cached sequence db index ({key}): {value}")
+            self.json_data[f"proteomics_msgfplus.{key}"] = value
+
+    def load_study_design_table(self, file_name):
+        """
+        Downloads and parses one of the (tab separated) study design files
+
+        :param file_name: The study design file name (e.g. fractions.txt)
+        :return: The rows of the table
+        :rtype: list[dict]
+        :raise: FileNotFoundError
+        """
+        study_design_location = self.args.study_design_location.rstrip("/")
+        storage_client = get_storage_client(self.gcp_project)
+        blob = storage_client.bucket(self.bucket_name_raw).get_blob(
+            f"{study_design_location}/{file_name}"
+        )
+        if blob is None:
+            raise FileNotFoundError(
+                f"ERROR: {file_name} not found in {self.study_design_location}"
+            )
+        text = blob.download_as_bytes().decode("utf-8")
+        return list(csv.DictReader(io.StringIO(text), delimiter="\t"))
+
+    def split_by_plex(self, json_data):
+        """
+        Partitions the raw files by plex into (at most) <n_subconfigs> groups with
+        balanced raw file sizes. All the fractions of a plex stay in the same group.
+
+        :param json_data: The filled template JSON dict
+        :return: A list of (sub-config JSON dict, list of PlexIDs) tuples
+        :rtype: list[tuple[dict, list[str]]]
+        :raise: ValueError
+        """
+        fractions = self.load_study_design_table("fractions.txt")
+        samples = self.load_study_design_table("samples.txt")
+
+        dataset_plex = {row["Dataset"]: row["PlexID"] for row in fractions}
+        sample_plexes = {row["PlexID"] for row in samples}
+        missing_plexes = set(dataset_plex.values()) - sample_plexes
+        if missing_plexes:
+            raise ValueError(
+                f"PlexIDs {sorted(missing_plexes)} are in fractions.txt but not in "
+                f"samples.txt"
+            )
+
+        plex_raw_files = {}
+        for raw_file in json_data["proteomics_msgfplus.raw_file"]:
+            dataset = os.path.basename(raw_file).removesuffix(".raw")
+            if dataset not in dataset_plex:
+                raise ValueError(
+                    f"Raw file {raw_file} is not listed in fractions.txt"
+                )
+            plex_raw_files.setdefault(dataset_plex[dataset], []).append(raw_file)
+
+        for plex in sorted(set(dataset_plex.values()) - set(plex_raw_files)):
+            print(f"+ WARNING: no raw files found for plex {plex}")
+
+        # Largest plexes first, each one to the currently smallest group
+        n_groups = min(self.n_subconfigs, len(plex_raw_files))
+        groups = [{"plexes": [], "raw_files": [], "bytes": 0} for _ in range(n_groups)]
+        plex_bytes = {
+            plex: sum(self.raw_file_sizes.get(f) or 0 for f in files)
+            for plex, files in plex_raw_files.items()
+        }
+        for plex in sorted(plex_raw_files, key=lambda x: (-plex_bytes[x], x)):
+            group = min(groups, key=lambda x: x["bytes"])
+            group["plexes"].append(plex)
+            group["raw_files"].extend(plex_raw_files[plex])
+            group["bytes"] += plex_bytes[plex]
+
+        sub_configs = []
+        for group in groups:
+            sub_config = dict(json_data)
+            sub_config["proteomics_msgfplus.raw_file"] = group["raw_files"]
+            sub_config["proteomics_msgfplus.run_plexedpiper"] = False
+            sub_configs.append((sub_config, group["plexes"]))
+            print(
+                f"+ Sub-config with plexes {', '.join(group['plexes'])}: "
+                f"{len(group['raw_files'])} raw files "
+                f"({group['bytes'] / 1024 ** 3:.1f} GB)"
+            )
+
+        return sub_configs
+
+    def plexedpiper_template(self, json_data):
+        """
+        Builds the configuration of the proteomics_plexedpiper workflow which merges
+        the outputs of the split sub-workflows. The MASIC/PHRP/AScore outputs are
+        filled in by create_config_plexedpiper.py once the sub-workflows are done.
+
+        :param json_data: The filled template JSON dict
+        :return: The proteomics_plexedpiper JSON dict
+        :rtype: dict
+        """
+        shared_keys = [
+            "results_prefix",
+            "species",
+            "proteomics_experiment",
+            "fasta_sequence_db",
+            "sequence_db_name",
+            "wrapper_ncpu",
+            "wrapper_ramGB",
+            "wrapper_docker",
+            "wrapper_disk",
+            "wrapper_preemptible",
+            "sd_fractions",
+            "sd_references",
+            "sd_samples",
+            "pr_ratio",
+            "unique_only",
+            "refine_prior",
+        ]
+        pp_json = {
+            f"proteomics_plexedpiper.{k}": json_data[f"proteomics_msgfplus.{k}"]
+            for k in shared_keys
+            if f"proteomics_msgfplus.{k}" in json_data
+        }
+        for k in ["ReporterIons_output_file", "SICstats_output_file", "syn", "syn_ascore"]:
+            pp_json[f"proteomics_plexedpiper.{k}"] = []
+        return pp_json
+
+    def save_split_configurations(self, json_data):
+        """
+        Splits the configuration by plex and saves the sub-configurations, the
+        PlexedPiper merge template, and a split manifest listing them
+
+        :param json_data: The edited template JSON dict
+        """
+        stem = self.output_config_json.removesuffix(".json")
+        Path(self.output_folder_local).mkdir(parents=True, exist_ok=True)
+
+        parts = []
+        for (i, (sub_config, plexes)) in enumerate(self.split_by_plex(json_data)):
+            part_name = f"{stem}-part{i + 1:02d}.json"
+            part_path = os.path.join(self.output_folder_local, part_name)
+            print("+ Full path for the sub-config file: ", part_path)
+            with open(part_path, "w") as outfile:
+                json.dump(sub_config, outfile, indent=4)
+            parts.append(
+                {
+                    "config": part_name,
+                    "plexes": plexes,
+                    "raw_files": len(sub_config["proteomics_msgfplus.raw_file"]),
+                }
+            )
+
+        pp_name = f"{stem}-plexedpiper.json"
+        pp_path = os.path.join(self.output_folder_local, pp_name)
+        print("+ Full path for the PlexedPiper merge template: ", pp_path)
+        with open(pp_path, "w") as outfile:
+            json.dump(self.plexedpiper_template(json_data), outfile, indent=4)
+
+        manifest_path = os.path.join(self.output_folder_local, f"{stem}-split.json")
+        print("+ Full path for the split manifest: ", manifest_path)
+        with open(manifest_path, "w") as outfile:
+            json.dump(
+                {"parts": parts, "plexedpiper_template": pp_name}, outfile, indent=4
+            )
+
 
 def main():
     # PROCESS ARGUMENTS
     opts = MSGFConfigurationGenerator()
     opts.sanitize_options()
     opts.argument_validation_output()
-    opts.load_template()
-    json_data = opts.fill_json()
-    opts.save_configuration(json_data)
+    with profiling.span("template load"):
+        opts.load_template()
+    with profiling.span("template filling"):
+        json_data = opts.fill_json()
+    with profiling.span("configuration save"):
+        if opts.n_subconfigs > 1:
+            opts.save_split_configurations(json_data)
+        else:
+            opts.save_configuration(json_data)
 
     print("+ ALL DONE!")
 
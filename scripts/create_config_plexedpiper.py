@@ -0,0 +1,155 @@
+import argparse
+import json
+import os
+import sys
+import warnings
+from pathlib import Path
+
+from gcs_client import get_storage_client
+from metadata_cache import load_json_blob
+import profiling
+
+
+warnings.filterwarnings(
+    "ignore", "Your application has authenticated using end user credentials"
+)
+
+# proteomics_msgfplus outputs merged into the proteomics_plexedpiper inputs
+MERGED_OUTPUTS = [
+    "ReporterIons_output_file",
+    "SICstats_output_file",
+    "syn",
+    "syn_ascore",
+]
+
+
+def create_arguments():
+    """
+    Creates argument parser instance
+
+    :return: ArgumentParser object with valid options
+    :rtype: argparse.ArgumentParser
+    """
+    parser = argparse.ArgumentParser(
+        description="Script to generate the PlexedPiper configuration file that "
+        "merges the outputs of split MSGF+ sub-workflows"
+    )
+    parser.add_argument(
+        "-g", "--gcp_project", required=True, type=str, help="GCP project name"
+    )
+    parser.add_argument(
+        "-t",
+        "--template",
+        required=True,
+        type=str,
+        help="PlexedPiper merge template generated by create_config_msgfplus.py "
+        "(<output_config_json>-plexedpiper.json)",
+    )
+    parser.add_argument(
+        "-b",
+        "--bucket_origin",
+        required=True,
+        type=str,
+        help="Bucket with the sub-workflow output files",
+    )
+    parser.add_argument(
+        "-r",
+        "--results_folder",
+        required=True,
+        type=str,
+        help="Path to the results folder (e.g. results/proteomics_msgfplus)",
+    )
+    parser.add_argument(
+        "-i",
+        "--caper_job_id",
+        required=True,
+        nargs="+",
+        type=str,
+        help="Caper job ids of the sub-workflows, one per sub-config",
+    )
+    parser.add_argument(
+        "-o",
+        "--output_config_json",
+        required=True,
+        type=str,
+        help="Full path of the JSON configuration file generated by this script",
+    )
+    profiling.add_argument(parser)
+    return parser
+
+
+def load_workflow_outputs(bucket, results_folder, caper_job_id):
+    """
+    Loads the outputs of a finished proteomics_msgfplus sub-workflow from its
+    metadata.json file
+
+    :param bucket: The bucket with the workflow outputs
+    :param results_folder: Path to the results folder
+    :param caper_job_id: The caper job id
+    :return: The workflow outputs, without the workflow name prefix
+    :rtype: dict
+    :raise: FileNotFoundError, ValueError
+    """
+    blob = bucket.get_blob(f"{results_folder}/{caper_job_id}/metadata.json")
+    if blob is None:
+        raise FileNotFoundError(
+            f"ERROR: metadata.json not found for job {caper_job_id}"
+        )
+    metadata = load_json_blob(blob)
+    if metadata.get("status") != "Succeeded":
+        raise ValueError(
+            f"Sub-workflow {caper_job_id} has status {metadata.get('status')}. "
+            f"All the sub-workflows must succeed before running PlexedPiper"
+        )
+    return {
+        key.removeprefix("proteomics_msgfplus."): value
+        for key, value in metadata["outputs"].items()
+    }
+
+
+def main():
+    parser = create_arguments()
+    args = parser.parse_args()
+    profiling.start(args.profile)
+
+    bucket_origin = args.bucket_origin.rstrip("/")
+    results_folder = args.results_folder.rstrip("/")
+
+    print("\nWRITE JSON CONFIG FILE FOR PLEXEDPIPER (SPLIT MSGF+ SUB-WORKFLOWS)")
+    print("----------------------------------------------")
+    print("+ GCP gcp_project:", args.gcp_project)
+    print("+ Template json path: ", args.template)
+    print("+ Sub-workflows: ", len(args.caper_job_id))
+
+    with open(args.template) as json_file:
+        json_data = json.load(json_file)
+
+    storage_client = get_storage_client(args.gcp_project)
+    bucket = storage_client.bucket(bucket_origin)
+
+    for caper_job_id in args.caper_job_id:
+        print("+ Loading outputs of job: ", caper_job_id)
+        with profiling.span("metadata load"):
+            outputs = load_workflow_outputs(bucket, results_folder, caper_job_id)
+        for output in MERGED_OUTPUTS:
+            files = [f for f in outputs.get(output) or [] if f is not None]
+            json_data[f"proteomics_plexedpiper.{output}"].extend(files)
+
+    n_syn = len(json_data["proteomics_plexedpiper.syn"])
+    if n_syn == 0:
+        print("\n\tERROR: No PHRP syn files found in the sub-workflow outputs")
+        sys.exit(1)
+    print("+ Total number of PHRP syn files: ", n_syn)
+
+    print("+ Full path for the config file: ", args.output_config_json)
+    output_folder = os.path.dirname(args.output_config_json)
+    if output_folder:
+        Path(output_folder).mkdir(parents=True, exist_ok=True)
+    with open(args.output_config_json, "w") as outfile:
+        json.dump(json_data, outfile, indent=4)
+
+    print("+ ALL DONE!")
+
+
+if __name__ == "__main__":
+    main()
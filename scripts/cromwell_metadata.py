@@ -0,0 +1,241 @@
+"""
+Helpers to read the call attempts of a Cromwell workflow metadata.json.
+"""
+
+from datetime import datetime
+from pathlib import Path
+
+# Cromwell execution events that happen before the VM starts working on the task
+QUEUED_EVENTS = (
+    "Pending",
+    "RequestingExecutionToken",
+    "WaitingForValueStore",
+    "PreparingJob",
+    "waiting for quota",
+)
+
+# Call inputs naming the sample of a scattered call, and the suffixes to remove from
+# their file names to get the sample id
+SAMPLE_INPUTS = (
+    "sample_id",
+    "raw_file",
+    "input_mzml",
+    "input_fixed_mzml",
+    "input_mzid",
+    "input_mzid_final",
+    "input_tsv",
+    "input_syn",
+)
+SAMPLE_SUFFIXES = (".raw", "_FIXED.mzML", ".mzML", "_final.mzid", ".mzid", ".tsv", "_syn.txt")
+
+# Disk size used by the workflow tasks when none is requested
+DEFAULT_DISK_GB = 100
+
+# GCE us-central1 N1 custom machine prices (USD per hour)
+PRICES = {
+    "cpu": 0.033174,
+    "gb": 0.004446,
+    "preemptible_cpu": 0.00698,
+    "preemptible_gb": 0.00094,
+    "disk_gb": 0.04 / 730,
+}
+
+
+def parse_time(timestamp: str | None) -> datetime | None:
+    """
+    Parse a Cromwell timestamp (ISO 8601, e.g. 2023-03-07T18:30:21.456Z).
+
+    :param timestamp: The timestamp string
+    :return: The timezone aware datetime, or None if no timestamp is given
+    """
+    if not timestamp:
+        return None
+    return datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+
+
+def seconds_between(start: str | None, end: str | None) -> float:
+    """
+    Seconds elapsed between two Cromwell timestamps.
+
+    :param start: The start timestamp
+    :param end: The end timestamp
+    :return: The elapsed seconds, 0 if any of the timestamps is missing
+    """
+    start_time, end_time = parse_time(start), parse_time(end)
+    if start_time is None or end_time is None:
+        return 0.0
+    return (end_time - start_time).total_seconds()
+
+
+def task_name(call_name: str) -> str:
+    """
+    Task name of a call, without the workflow name prefix.
+
+    :param call_name: The call name (e.g. proteomics_msgfplus.masic)
+    :return: The task name (e.g. masic)
+    """
+    return call_name.split(".", 1)[-1]
+
+
+def iter_call_attempts(metadata: dict):
+    """
+    Iterate over all call attempts of a workflow.
+
+    :param metadata: The workflow metadata.json object
+    :return: Iterator of (task name, call attempt) tuples
+    """
+    for call_name, attempts in metadata.get("calls", {}).items():
+        for attempt in attempts:
+            yield task_name(call_name), attempt
+
+
+def attempt_samples(attempt: dict) -> set[str]:
+    """
+    Sample ids named by the inputs of a call attempt.
+
+    :param attempt: The call attempt metadata object
+    :return: The sample ids (raw file names without extension)
+    """
+    samples = set()
+    inputs = attempt.get("inputs", {})
+    for key in SAMPLE_INPUTS:
+        value = inputs.get(key)
+        if not isinstance(value, str):
+            continue
+        name = Path(value).name
+        for suffix in SAMPLE_SUFFIXES:
+            if name.endswith(suffix):
+                name = name.removesuffix(suffix)
+                break
+        samples.add(name)
+    return samples
+
+
+def is_preempted(attempt: dict) -> bool:
+    """
+    Whether the call attempt was lost to a VM preemption.
+
+    :param attempt: The call attempt metadata object
+    :return: True if the attempt was preempted
+    """
+    if attempt.get("preempted"):
+        return True
+    if attempt.get("executionStatus") != "RetryableFailure":
+        return False
+    messages = " ".join(
+        failure.get("message", "") for failure in attempt.get("failures", [])
+    )
+    return "preempt" in messages.lower()
+
+
+def wall_seconds(attempt: dict) -> float:
+    """
+    Wall time of a call attempt.
+
+    :param attempt: The call attempt metadata object
+    :return: The wall time in seconds
+    """
+    return seconds_between(attempt.get("start"), attempt.get("end"))
+
+
+def queued_seconds(attempt: dict) -> float:
+    """
+    Time the call attempt spent waiting for an execution token, a VM or quota.
+
+    :param attempt: The call attempt metadata object
+    :return: The queued time in seconds
+    """
+    return sum(
+        seconds_between(event.get("startTime"), event.get("endTime"))
+        for event in attempt.get("executionEvents", [])
+        if event.get("description", "").startswith(QUEUED_EVENTS)
+    )
+
+
+def attempt_cpus(attempt: dict) -> int:
+    """
+    Number of CPUs requested by the call attempt.
+
+    :param attempt: The call attempt metadata object
+    :return: The number of CPUs (1 if unknown)
+    """
+    return int(attempt.get("runtimeAttributes", {}).get("cpu", 1))
+
+
+def task_statistics(metadata_list: list[dict]) -> dict[str, dict]:
+    """
+    Aggregate the call attempts of one or many workflows per task.
+
+    :param metadata_list: The workflow metadata.json objects
+    :return: Mapping of task name to its statistics: shards, attempts, preemptions,
+        failed attempts, wall/queued/CPU hours and the longest attempt
+    """
+    stats = {}
+    for metadata in metadata_list:
+        for name, attempt in iter_call_attempts(metadata):
+            task = stats.setdefault(
+                name,
+                {
+                    "task": name,
+                    "shards": 0,
+                    "attempts": 0,
+                    "preemptions": 0,
+                    "failed_attempts": 0,
+                    "wall_hours": 0.0,
+                    "queued_hours": 0.0,
+                    "cpu_hours": 0.0,
+                    "max_wall_hours": 0.0,
+                },
+            )
+            wall = wall_seconds(attempt) / 3600
+            task["attempts"] += 1
+            if attempt.get("attempt", 1) == 1:
+                task["shards"] += 1
+            if is_preempted(attempt):
+                task["preemptions"] += 1
+            elif attempt.get("executionStatus") not in ("Done", "Running"):
+                task["failed_attempts"] += 1
+            task["wall_hours"] += wall
+            task["queued_hours"] += queued_seconds(attempt) / 3600
+            task["cpu_hours"] += wall * attempt_cpus(attempt)
+            task["max_wall_hours"] = max(task["max_wall_hours"], wall)
+
+    for task in stats.values():
+        task["mean_wall_hours"] = task["wall_hours"] / max(task["attempts"], 1)
+    return stats
+
+
+def attempt_shape(attempt: dict) -> dict:
+    """
+    Shape requested by a call attempt.
+
+    :param attempt: The call attempt metadata object
+    :return: A dict with ncpu, ramGB, disk (GB) and preemptible
+    """
+    runtime = attempt.get("runtimeAttributes", {})
+    memory = runtime.get("memory", "0 GB").split()
+    ram = float(memory[0]) * (1 / 1024 if len(memory) > 1 and memory[1] == "MB" else 1)
+    disks = runtime.get("disks", f"local-disk {DEFAULT_DISK_GB} HDD").split()
+    return {
+        "ncpu": int(runtime.get("cpu", 1)),
+        "ramGB": ram,
+        "disk": int(disks[1]) if len(disks) > 1 else DEFAULT_DISK_GB,
+        "preemptible": bool(attempt.get("preemptible")),
+    }
+
+
+def attempt_cost(shape: dict, hours: float, preemptible: bool) -> float:
+    """
+    Estimated cost of running a shape for some hours.
+
+    :param shape: A dict with ncpu, ramGB and disk
+    :param hours: The wall time in hours
+    :param preemptible: Whether the VM was preemptible
+    :return: The cost in USD
+    """
+    kind = "preemptible_" if preemptible else ""
+    return hours * (
+        shape["ncpu"] * PRICES[f"{kind}cpu"]
+        + shape["ramGB"] * PRICES[f"{kind}gb"]
+        + shape["disk"] * PRICES["disk_gb"]
+    )
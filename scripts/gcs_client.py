@@ -0,0 +1,96 @@
+"""
+Shared Google Cloud Storage client factory.
+
+storage.Client uses a requests session whose connection pools keep 10 connections per
+host. When more threads than that use the client (the copy tool, the metadata
+downloads), the extra connections are discarded after every request ("Connection pool
+is full") and new TCP/TLS connections are opened all the time. The clients created
+here size the pools to the number of worker threads, and are shared by all the
+buckets and callers of a project in the process.
+"""
+
+import os
+import threading
+
+import google.auth
+from google.auth.transport.requests import AuthorizedSession
+from google.cloud import storage
+from requests.adapters import HTTPAdapter
+
+# default number of threads of a ThreadPoolExecutor
+DEFAULT_MAX_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+
+_clients: dict[str | None, storage.Client] = {}
+_lock = threading.Lock()
+
+
+def get_storage_client(
+    project: str | None = None, max_workers: int = DEFAULT_MAX_WORKERS
+) -> storage.Client:
+    """
+    Storage client of a project, with connection pools sized for the given number of
+    concurrent threads. The client is created once per project: later calls return
+    it, growing its pools if more workers are requested.
+
+    :param project: The GCP project (default: the project of the credentials)
+    :param max_workers: The number of threads using the client concurrently
+    :return: The storage client
+    """
+    with _lock:
+        client = _clients.get(project)
+        if client is not None:
+            for adapter in client._http.adapters.values():
+                if adapter._pool_maxsize < max_workers:
+                    # the counters of the pools closed by the rebuild are kept
+                    adapter.closed_pool_stats = _pool_stats(adapter)
+                    adapter.poolmanager.clear()
+                    adapter.init_poolmanager(
+                        adapter._pool_connections, max_workers, adapter._pool_block
+                    )
+            return client
+
+        credentials, _ = google.auth.default(scopes=storage.Client.SCOPE)
+        session = AuthorizedSession(credentials)
+        # a pool per host (storage, oauth2), a connection per worker thread
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max_workers)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+
+        kwargs = {"credentials": credentials, "_http": session}
+        if project is not None:
+            kwargs["project"] = project
+        client = storage.Client(**kwargs)
+        _clients[project] = client
+        return client
+
+
+def _pool_stats(adapter: HTTPAdapter) -> tuple[int, int]:
+    # requests sent and connections opened by the pools of an adapter, including
+    # the pools closed when it was resized
+    requests, connections = getattr(adapter, "closed_pool_stats", (0, 0))
+    pools = adapter.poolmanager.pools
+    for key in list(pools.keys()):
+        pool = pools.get(key)
+        if pool is None:
+            continue
+        requests += pool.num_requests
+        connections += pool.num_connections
+    return requests, connections
+
+
+def connection_stats(client: storage.Client) -> dict:
+    """
+    Number of HTTP requests sent by a client and of connections it opened.
+
+    :param client: A client from get_storage_client
+    :return: A dict with the requests, connections and the connection reuse rate
+        (share of the requests sent over an already open connection)
+    """
+    requests = connections = 0
+    adapters = {id(x): x for x in client._http.adapters.values()}
+    for adapter in adapters.values():
+        adapter_requests, adapter_connections = _pool_stats(adapter)
+        requests += adapter_requests
+        connections += adapter_connections
+    reuse = 1 - connections / requests if requests else 0.0
+    return {"requests": requests, "connections": connections, "reuse_rate": reuse}
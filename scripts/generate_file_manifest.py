@@ -5,8 +5,10 @@ from typing import Iterator, Tuple
 
 
 try:
-    from google.cloud import storage
     from google.cloud.storage import Blob, Bucket
+
+    from gcs_client import get_storage_client
+    import profiling
 except ImportError:
     print("Please install google-cloud-storage", file=sys.stderr)
     sys.exit(1)
@@ -17,7 +19,7 @@ if sys.version_info[1] < 9:
     raise Exception("Must be using at least Python 3.9")
 
 SEPARATOR = ","
-storage_client = storage.Client()
+storage_client = get_storage_client()
 
 
 def parse_bucket_path(path: str) -> Tuple[str, str]:
@@ -45,6 +47,25 @@ def parse_bucket_path(path: str) -> Tuple[str, str]:
     return bucket.rstrip("/"), f"{key.rstrip('/')}/"
 
 
+def blob_md5(blob: Blob) -> str:
+    """
+    The hexadecimal MD5 of an object. Composite objects (e.g. the raw files staged by
+    stage_raw_files.py) have no MD5 hash: their MD5 is read from the md5 custom
+    metadata.
+
+    :param blob: The object (from list_blobs)
+    :return: The MD5
+    """
+    if blob.md5_hash is not None:
+        return b64decode(blob.md5_hash).hex()
+    if blob.metadata and "md5" in blob.metadata:
+        return blob.metadata["md5"]
+    raise ValueError(
+        f"gs://{blob.bucket.name}/{blob.name} has no MD5 (composite object without "
+        "md5 metadata). Copy it with `gsutil cp` to rewrite it as a regular object"
+    )
+
+
 def generate_manifest(path, outfile):
     lines = 0
     data = "file_name,md5\n"
@@ -54,14 +75,15 @@ def generate_manifest(path, outfile):
     bucket: Bucket = storage_client.bucket(bucket_name)
     blob_list: Iterator[Blob] = bucket.list_blobs(prefix=prefix)
 
-    for blob in blob_list:
-        print(f"Processing {blob.name}")
-        if blob.name.endswith("/") or "file_manifest" in blob.name:
-            continue
-        relative_filename = blob.name.removeprefix(prefix)
-        decoded_hash = b64decode(blob.md5_hash).hex()
-        data += f"{relative_filename},{decoded_hash}\n"
-        lines += 1
+    with profiling.span("listing"):
+        for blob in blob_list:
+            print(f"Processing {blob.name}")
+            if blob.name.endswith("/") or "file_manifest" in blob.name:
+                continue
+            relative_filename = blob.name.removeprefix(prefix)
+            decoded_hash = blob_md5(blob)
+            data += f"{relative_filename},{decoded_hash}\n"
+            lines += 1
 
     manifest_name = f"{prefix}{outfile}"
 
@@ -69,7 +91,8 @@ def generate_manifest(path, outfile):
     print(data)
 
     file_manifest_blob = Blob(bucket=bucket, name=manifest_name)
-    file_manifest_blob.upload_from_string(data, content_type="text/csv")
+    with profiling.span("manifest upload"):
+        file_manifest_blob.upload_from_string(data, content_type="text/csv")
 
     if lines == 0:
         raise Exception(f"No files found at {path}. Please double check")
@@ -90,7 +113,9 @@ def main():
     parser.add_argument(
         "output", default="file_manifest.csv", help="Name of the output file"
     )
+    profiling.add_argument(parser)
     args = parser.parse_args()
+    profiling.start(args.profile)
     generate_manifest(args.data_path, args.output)
 
 
@@ -0,0 +1,278 @@
+"""
+Timeline analysis of Cromwell workflow runs: time breakdown of every call attempt,
+critical path, straggler shards and Chrome trace-event export (chrome://tracing,
+https://ui.perfetto.dev).
+"""
+
+from statistics import median
+
+from cromwell_metadata import (
+    QUEUED_EVENTS,
+    iter_call_attempts,
+    parse_time,
+    seconds_between,
+    wall_seconds,
+)
+
+# Upstream tasks of every task, as wired in the workflows. A scattered task depends on
+# the same shard of a scattered upstream task, and on all the shards of an upstream
+# task when it is not scattered itself.
+DEPENDENCIES = {
+    # proteomics_msgfplus
+    "masic": [],
+    "msconvert": [],
+    "msgf_sequences": [],
+    "msgf_tryptic": ["msconvert", "msgf_sequences"],
+    "msconvert_mzrefiner": ["msconvert", "msgf_tryptic"],
+    "ppm_errorcharter": ["msconvert_mzrefiner", "msgf_tryptic"],
+    "msgf_identification": ["msconvert_mzrefiner", "msgf_sequences"],
+    "mzml_split": ["msconvert_mzrefiner"],
+    "msgf_identification_chunk": ["mzml_split", "msgf_sequences"],
+    "mzid_merge": ["msgf_identification_chunk"],
+    "msgf_fused_search": ["msconvert", "msgf_sequences"],
+    "mzidtotsvconverter": ["msgf_identification", "mzid_merge", "msgf_fused_search"],
+    "phrp": ["mzidtotsvconverter", "msgf_sequences"],
+    "ascore": ["phrp", "msgf_identification", "mzml_split", "msgf_fused_search"],
+    "wrapper_pp": ["masic", "phrp", "ascore"],
+    # proteomics_maxquant_scatter
+    "maxquant_file": [],
+    "maxquant_combined": ["maxquant_file"],
+}
+
+# Execution events (PAPI) that make up the time breakdown of a call attempt
+BREAKDOWN_EVENTS = {
+    "localization": ("Localization",),
+    "docker_pull": ("Pulling",),
+    "run": ("UserAction",),
+    "delocalization": ("Delocalization",),
+    "queued": QUEUED_EVENTS,
+}
+BREAKDOWN_COLUMNS = ["queued", "docker_pull", "localization", "run", "delocalization", "other"]
+
+
+def time_breakdown(attempt: dict) -> dict[str, float]:
+    """
+    Split the wall time of a call attempt into queued, docker pull, localization, run
+    and delocalization time. The rest (VM start up, waiting between events) is
+    reported as other.
+
+    :param attempt: The call attempt metadata object
+    :return: Mapping of category to seconds
+    """
+    breakdown = dict.fromkeys(BREAKDOWN_COLUMNS, 0.0)
+    for event in attempt.get("executionEvents", []):
+        description = event.get("description", "")
+        for category, prefixes in BREAKDOWN_EVENTS.items():
+            if description.startswith(prefixes):
+                breakdown[category] += seconds_between(
+                    event.get("startTime"), event.get("endTime")
+                )
+                break
+    accounted = sum(breakdown.values())
+    breakdown["other"] = max(0.0, wall_seconds(attempt) - accounted)
+    return breakdown
+
+
+def call_spans(metadata: dict) -> dict[tuple[str, int], dict]:
+    """
+    Time span of every call (task and shard), from the start of its first attempt to
+    the end of its last one, so that retries count toward the call.
+
+    :param metadata: The workflow metadata.json object
+    :return: Mapping of (task, shard index) to a dict with start, end and attempts
+    """
+    spans = {}
+    for name, attempt in iter_call_attempts(metadata):
+        start, end = parse_time(attempt.get("start")), parse_time(attempt.get("end"))
+        if start is None or end is None:
+            continue
+        span = spans.setdefault(
+            (name, attempt.get("shardIndex", -1)),
+            {"start": start, "end": end, "attempts": 0},
+        )
+        span["start"] = min(span["start"], start)
+        span["end"] = max(span["end"], end)
+        span["attempts"] += 1
+    return spans
+
+
+def _upstream_calls(spans, task, shard):
+    upstream = []
+    for upstream_task in DEPENDENCIES.get(task, []):
+        for (name, upstream_shard) in spans:
+            if name != upstream_task:
+                continue
+            if shard == -1 or upstream_shard == -1 or upstream_shard == shard:
+                upstream.append((name, upstream_shard))
+    return upstream
+
+
+def critical_path(metadata: dict) -> list[dict]:
+    """
+    Chain of calls that determined the workflow wall time: starting from the call
+    that ended last, walk back to the upstream call that ended last, until a call
+    without upstream calls is reached.
+
+    :param metadata: The workflow metadata.json object
+    :return: The calls of the critical path in execution order, as dicts with task,
+        shard, start and end (hours since the workflow start), duration and the wait
+        (hours between the end of the upstream call and the start of the call)
+    """
+    spans = call_spans(metadata)
+    if not spans:
+        return []
+    origin = parse_time(metadata.get("start")) or min(x["start"] for x in spans.values())
+
+    path = []
+    call = max(spans, key=lambda x: spans[x]["end"])
+    while call is not None:
+        upstream = _upstream_calls(spans, *call)
+        previous = max(upstream, key=lambda x: spans[x]["end"]) if upstream else None
+        span = spans[call]
+        ready = spans[previous]["end"] if previous else origin
+        path.append(
+            {
+                "task": call[0],
+                "shard": call[1],
+                "start_hours": (span["start"] - origin).total_seconds() / 3600,
+                "end_hours": (span["end"] - origin).total_seconds() / 3600,
+                "duration_hours": (span["end"] - span["start"]).total_seconds() / 3600,
+                "wait_hours": max(0.0, (span["start"] - ready).total_seconds() / 3600),
+                "attempts": span["attempts"],
+            }
+        )
+        call = previous
+    return path[::-1]
+
+
+def stragglers(metadata: dict, factor: float = 2.0) -> list[dict]:
+    """
+    Shards of a scattered task that took longer than factor times the median duration
+    of the task.
+
+    :param metadata: The workflow metadata.json object
+    :param factor: Straggler threshold, as a multiple of the median duration
+    :return: The straggler calls (task, shard, duration, median, ratio), slowest first
+    """
+    by_task = {}
+    for (task, shard), span in call_spans(metadata).items():
+        if shard == -1:
+            continue
+        duration = (span["end"] - span["start"]).total_seconds() / 3600
+        by_task.setdefault(task, []).append((shard, duration))
+
+    found = []
+    for task, durations in by_task.items():
+        typical = median(d for _, d in durations)
+        if len(durations) < 3 or typical <= 0:
+            continue
+        for shard, duration in durations:
+            if duration > factor * typical:
+                found.append(
+                    {
+                        "task": task,
+                        "shard": shard,
+                        "duration_hours": duration,
+                        "median_hours": typical,
+                        "ratio": duration / typical,
+                    }
+                )
+    return sorted(found, key=lambda x: x["ratio"], reverse=True)
+
+
+def task_breakdown(metadata_list: list[dict]) -> dict[str, dict[str, float]]:
+    """
+    Time breakdown of every task, summed over all its attempts.
+
+    :param metadata_list: The workflow metadata.json objects
+    :return: Mapping of task name to the hours per breakdown category
+    """
+    totals = {}
+    for metadata in metadata_list:
+        for name, attempt in iter_call_attempts(metadata):
+            task = totals.setdefault(name, dict.fromkeys(BREAKDOWN_COLUMNS, 0.0))
+            for category, seconds in time_breakdown(attempt).items():
+                task[category] += seconds / 3600
+    return totals
+
+
+def _microseconds(timestamp, origin):
+    return (parse_time(timestamp) - origin).total_seconds() * 1e6
+
+
+def chrome_trace(metadata_list: list[dict]) -> dict:
+    """
+    Chrome trace-event representation of one or many workflow runs: one process per
+    workflow, one thread per call (task and shard), one slice per call attempt, with
+    its execution events nested below it.
+
+    :param metadata_list: The workflow metadata.json objects
+    :return: The trace object, ready to be dumped as JSON
+    """
+    events = []
+    starts = [parse_time(m.get("start")) for m in metadata_list if m.get("start")]
+    origin = min(starts) if starts else None
+    for pid, metadata in enumerate(metadata_list, start=1):
+        events.append(
+            {
+                "name": "process_name",
+                "ph": "M",
+                "pid": pid,
+                "tid": 0,
+                "args": {"name": f"{metadata.get('workflowName')} {metadata.get('id')}"},
+            }
+        )
+        threads = {}
+        for name, attempt in iter_call_attempts(metadata):
+            if not attempt.get("start") or not attempt.get("end"):
+                continue
+            if origin is None:
+                origin = parse_time(attempt["start"])
+            shard = attempt.get("shardIndex", -1)
+            call = name if shard == -1 else f"{name}[{shard}]"
+            if call not in threads:
+                threads[call] = len(threads) + 1
+                events.append(
+                    {
+                        "name": "thread_name",
+                        "ph": "M",
+                        "pid": pid,
+                        "tid": threads[call],
+                        "args": {"name": call},
+                    }
+                )
+            tid = threads[call]
+            start = _microseconds(attempt["start"], origin)
+            events.append(
+                {
+                    "name": f"{call} attempt {attempt.get('attempt', 1)}",
+                    "cat": name,
+                    "ph": "X",
+                    "pid": pid,
+                    "tid": tid,
+                    "ts": start,
+                    "dur": _microseconds(attempt["end"], origin) - start,
+                    "args": {
+                        "executionStatus": attempt.get("executionStatus"),
+                        "backendStatus": attempt.get("backendStatus"),
+                        "cpu": attempt.get("runtimeAttributes", {}).get("cpu"),
+                        "memory": attempt.get("runtimeAttributes", {}).get("memory"),
+                    },
+                }
+            )
+            for event in attempt.get("executionEvents", []):
+                if not event.get("startTime") or not event.get("endTime"):
+                    continue
+                event_start = _microseconds(event["startTime"], origin)
+                events.append(
+                    {
+                        "name": event.get("description", ""),
+                        "cat": "executionEvent",
+                        "ph": "X",
+                        "pid": pid,
+                        "tid": tid,
+                        "ts": event_start,
+                        "dur": _microseconds(event["endTime"], origin) - event_start,
+                    }
+                )
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
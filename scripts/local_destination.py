@@ -0,0 +1,138 @@
+"""
+Local destination of copy_pipeline_results.py: the outputs are downloaded to a local
+folder instead of copied to a bucket.
+
+LocalBucket and LocalBlob implement the part of the Bucket and Blob interfaces that the
+copy tool writes through (blob, upload_from_string, open, reload), so the logs,
+commands, exploded archives and Parquet tables are written to the local folder by the
+same code as to a bucket. The output files are downloaded by download_blob: objects
+larger than SLICE_BYTES are downloaded in slices (ranged requests) by parallel
+threads, each writing its part of the file. Every file is downloaded to a temporary
+.part file, checked against the CRC32C of the object, and only then renamed.
+"""
+
+import base64
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import google_crc32c
+from google.cloud.storage import Blob
+
+SLICE_BYTES = 64 * 1024**2
+READ_CHUNK_BYTES = 8 * 1024**2
+
+
+def file_crc32c(path: str | Path) -> str:
+    """
+    CRC32C of a local file, encoded as in the object metadata.
+
+    :param path: The file
+    :return: The base64 encoded CRC32C
+    """
+    checksum = google_crc32c.Checksum()
+    with open(path, "rb") as f:
+        while chunk := f.read(READ_CHUNK_BYTES):
+            checksum.update(chunk)
+    return base64.b64encode(checksum.digest()).decode("utf-8")
+
+
+class LocalBucket:
+    """A local folder standing in for the destination bucket."""
+
+    name = "local"
+
+    def blob(self, blob_name: str) -> "LocalBlob":
+        """
+        The local file at a path.
+
+        :param blob_name: The absolute path of the file
+        """
+        return LocalBlob(blob_name, self)
+
+
+class LocalBlob:
+    """A local file standing in for a destination blob."""
+
+    def __init__(self, name: str, bucket: LocalBucket) -> None:
+        self.name = name
+        self.bucket = bucket
+        self.crc32c = None
+
+    def open(self, mode: str = "r", **kwargs):
+        """
+        Open the file, creating its folder when it is written (the keyword arguments
+        of Blob.open are ignored).
+
+        :param mode: The file mode
+        """
+        if mode.startswith("w"):
+            Path(self.name).parent.mkdir(parents=True, exist_ok=True)
+        return open(self.name, mode)
+
+    def upload_from_string(self, data: str | bytes, **kwargs) -> None:
+        """
+        Write the file (the keyword arguments of Blob.upload_from_string are ignored).
+
+        :param data: The content
+        """
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        with self.open("wb") as f:
+            f.write(data)
+
+    def reload(self) -> None:
+        """Compute the CRC32C of the file."""
+        self.crc32c = file_crc32c(self.name)
+
+
+def _download_slice(blob: Blob, path: Path, start: int, end: int) -> None:
+    with open(path, "r+b") as f:
+        f.seek(start)
+        blob.download_to_file(f, start=start, end=end, checksum=None)
+
+
+def download_blob(blob: Blob, file_name: str, slice_pool: ThreadPoolExecutor) -> int:
+    """
+    Download an object to a local file, in parallel slices if it is large, and check
+    its CRC32C.
+
+    :param blob: The object (from get_blob, with its size and CRC32C)
+    :param file_name: The local file
+    :param slice_pool: The threads downloading the slices
+    :return: The number of slices
+    :raise: ValueError if the file does not match the CRC32C of the object
+    """
+    path = Path(file_name)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    part = path.with_name(f"{path.name}.part")
+
+    size = blob.size or 0
+    try:
+        if size <= SLICE_BYTES:
+            slices = 1
+            with open(part, "wb") as f:
+                blob.download_to_file(f, checksum=None)
+        else:
+            with open(part, "wb") as f:
+                f.truncate(size)
+            starts = range(0, size, SLICE_BYTES)
+            slices = len(starts)
+            futures = [
+                slice_pool.submit(
+                    _download_slice, blob, part, start, min(start + SLICE_BYTES, size) - 1
+                )
+                for start in starts
+            ]
+            for future in futures:
+                future.result()
+
+        if blob.crc32c is not None and file_crc32c(part) != blob.crc32c:
+            raise ValueError(
+                f"CRC32C mismatch downloading gs://{blob.bucket.name}/{blob.name}"
+            )
+    except BaseException:
+        part.unlink(missing_ok=True)
+        raise
+    os.replace(part, path)
+    return slices
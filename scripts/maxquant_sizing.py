@@ -0,0 +1,387 @@
+"""
+Throughput model used to size the MaxQuant VM (CPUs and RAM).
+
+The wall time of a MaxQuant run is modelled as
+
+    hours = intercept
+            + hours_per_gb_per_thread * total_raw_GB / threads
+            + hours_per_max_file_gb * largest_raw_GB
+            + hours_per_total_gb * total_raw_GB
+
+where ``threads = min(ncpu, number of raw files)``: the per-file steps (feature
+detection, first/main search) are spread across threads, the largest file sets a lower
+bound for them, and the combined steps (FDR, protein grouping, LFQ) scale with the
+total amount of data on a single thread.
+
+The coefficients live in ``inputs/templates/maxquant/sizing-model.json`` and can be
+refitted from past runs (``#runningTimes.txt`` plus the workflow metadata.json) by
+running this script.
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+import warnings
+from pathlib import Path
+
+from gcs_client import get_storage_client
+from metadata_cache import load_json_blob
+import profiling
+
+
+warnings.filterwarnings(
+    "ignore", "Your application has authenticated using end user credentials"
+)
+
+DEFAULT_MODEL = (
+    Path(os.path.abspath(os.path.dirname(__file__))).parent
+    / "inputs/templates/maxquant/sizing-model.json"
+)
+COEFFICIENTS = [
+    "intercept_hours",
+    "hours_per_gb_per_thread",
+    "hours_per_max_file_gb",
+    "hours_per_total_gb",
+]
+GB = 1024**3
+
+
+def load_model(model_path=DEFAULT_MODEL):
+    """
+    Loads the sizing model
+
+    :param model_path: Path to the sizing model JSON file
+    :return: The sizing model
+    :rtype: dict
+    """
+    with open(model_path, encoding="utf-8") as json_file:
+        return json.load(json_file)
+
+
+def features(raw_sizes, ncpu):
+    """
+    Computes the model features of a run
+
+    :param raw_sizes: The raw file sizes in bytes
+    :param ncpu: The number of threads MaxQuant runs with
+    :return: The feature vector (same order as COEFFICIENTS)
+    :rtype: list[float]
+    """
+    total_gb = sum(raw_sizes) / GB
+    max_gb = max(raw_sizes) / GB
+    threads = max(1, min(ncpu, len(raw_sizes)))
+    return [1.0, total_gb / threads, max_gb, total_gb]
+
+
+def predict_hours(model, raw_sizes, ncpu):
+    """
+    Predicts the wall time of a MaxQuant run
+
+    :param model: The sizing model
+    :param raw_sizes: The raw file sizes in bytes
+    :param ncpu: The number of CPUs of the VM
+    :return: The predicted wall time in hours
+    :rtype: float
+    """
+    coefficients = model["coefficients"]
+    return sum(
+        coefficients[name] * x for name, x in zip(COEFFICIENTS, features(raw_sizes, ncpu))
+    )
+
+
+def ram_gb(model, raw_sizes, ncpu):
+    """
+    RAM needed by MaxQuant for the given number of CPUs
+
+    :param model: The sizing model
+    :param raw_sizes: The raw file sizes in bytes
+    :param ncpu: The number of CPUs of the VM
+    :return: The RAM in GB
+    :rtype: int
+    """
+    threads = max(1, min(ncpu, len(raw_sizes)))
+    return int(max(model["ram_gb_min"], model["ram_gb_per_thread"] * threads))
+
+
+def candidate_shapes(model, raw_sizes):
+    """
+    Predicts wall time and cost of every candidate machine shape
+
+    :param model: The sizing model
+    :param raw_sizes: The raw file sizes in bytes
+    :return: A list of dicts with ncpu, ramGB, hours and cost, sorted by cost
+    :rtype: list[dict]
+    """
+    shapes = []
+    for ncpu in model["candidate_ncpu"]:
+        ram = ram_gb(model, raw_sizes, ncpu)
+        hours = predict_hours(model, raw_sizes, ncpu)
+        cost = hours * (
+            ncpu * model["price_per_cpu_hour"] + ram * model["price_per_gb_hour"]
+        )
+        shapes.append({"ncpu": ncpu, "ramGB": ram, "hours": hours, "cost": cost})
+    return sorted(shapes, key=lambda x: (x["cost"], x["hours"]))
+
+
+def choose_shape(model, raw_sizes, target_hours):
+    """
+    Picks the cheapest machine shape whose predicted wall time meets the target. If
+    none of them does, the fastest one is returned.
+
+    :param model: The sizing model
+    :param raw_sizes: The raw file sizes in bytes
+    :param target_hours: The target wall time in hours
+    :return: The chosen shape (ncpu, ramGB, hours, cost)
+    :rtype: dict
+    """
+    shapes = candidate_shapes(model, raw_sizes)
+    meeting_target = [x for x in shapes if x["hours"] <= target_hours]
+    if meeting_target:
+        return meeting_target[0]
+    return min(shapes, key=lambda x: (x["hours"], x["cost"]))
+
+
+def _solve(matrix, vector):
+    """Solves a small linear system by Gauss-Jordan elimination with pivoting."""
+    n = len(vector)
+    a = [row[:] + [vector[i]] for i, row in enumerate(matrix)]
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda r: abs(a[r][col]))
+        a[col], a[pivot] = a[pivot], a[col]
+        if abs(a[col][col]) < 1e-12:
+            continue
+        for r in range(n):
+            if r != col:
+                factor = a[r][col] / a[col][col]
+                a[r] = [x - factor * y for x, y in zip(a[r], a[col])]
+    return [a[i][n] / a[i][i] if abs(a[i][i]) >= 1e-12 else 0.0 for i in range(n)]
+
+
+def fit_coefficients(rows, hours, ridge=1e-6, tolerance=1e-10):
+    """
+    Non-negative least squares fit of the model coefficients (Lawson-Hanson active
+    set method, on the normal equations)
+
+    :param rows: The feature vectors of the past runs
+    :param hours: The observed wall times in hours
+    :param ridge: Small ridge penalty to keep the system well conditioned
+    :param tolerance: Gradients and coefficients below this are taken as zero
+    :return: The fitted coefficients (same order as COEFFICIENTS)
+    :rtype: list[float]
+    """
+    n = len(COEFFICIENTS)
+    xtx = [
+        [sum(r[i] * r[j] for r in rows) + (ridge if i == j else 0.0) for j in range(n)]
+        for i in range(n)
+    ]
+    xty = [sum(r[i] * y for r, y in zip(rows, hours)) for i in range(n)]
+
+    def solve_passive(passive):
+        solution = _solve(
+            [[xtx[i][j] for j in passive] for i in passive], [xty[i] for i in passive]
+        )
+        z = [0.0] * n
+        for i, value in zip(passive, solution):
+            z[i] = value
+        return z
+
+    x = [0.0] * n
+    passive = []
+    for _ in range(3 * n):
+        # the negative gradient of the squared error
+        w = [xty[i] - sum(xtx[i][j] * x[j] for j in range(n)) for i in range(n)]
+        candidates = [i for i in range(n) if i not in passive and w[i] > tolerance]
+        if not candidates:
+            break
+        passive = sorted(passive + [max(candidates, key=lambda i: w[i])])
+        while True:
+            z = solve_passive(passive)
+            if all(z[i] > tolerance for i in passive):
+                x = z
+                break
+            # move towards z until a coefficient reaches zero, and drop it
+            alpha = min(x[i] / (x[i] - z[i]) for i in passive if z[i] <= tolerance)
+            x = [xi + alpha * (zi - xi) for xi, zi in zip(x, z)]
+            passive = [i for i in passive if x[i] > tolerance]
+            if not passive:
+                break
+    return [max(v, 0.0) for v in x]
+
+
+def parse_running_times(text):
+    """
+    Total running time of a MaxQuant run from its #runningTimes.txt file. The steps
+    are run one after the other, so the total is the sum of the step running times.
+
+    :param text: The content of #runningTimes.txt
+    :return: The running time in hours
+    :rtype: float
+    """
+    lines = [line.split("\t") for line in text.splitlines() if line.strip()]
+    header = lines[0]
+    column = next(i for i, name in enumerate(header) if name.startswith("Running time"))
+    return sum(float(line[column]) for line in lines[1:] if len(line) > column) / 60
+
+
+def _blob_from_path(storage_client, gs_path):
+    bucket_name, name = gs_path.removeprefix("gs://").split("/", 1)
+    return storage_client.bucket(bucket_name).get_blob(name)
+
+
+def load_past_run(storage_client, bucket, results_folder, caper_job_id):
+    """
+    Loads the observed wall time, raw file sizes and thread count of a past run
+
+    :param storage_client: The storage client
+    :param bucket: The bucket with the workflow outputs
+    :param results_folder: Path to the results folder
+    :param caper_job_id: The caper job id
+    :return: A dict with the run details, or None if the run cannot be used
+    :rtype: dict | None
+    """
+    blob = bucket.get_blob(f"{results_folder}/{caper_job_id}/metadata.json")
+    if blob is None:
+        print(f"+ WARNING: metadata.json not found for job {caper_job_id}")
+        return None
+    metadata = load_json_blob(blob)
+    attempts = [
+        x
+        for x in metadata["calls"].get("proteomics_maxquant.maxquant", [])
+        if x.get("executionStatus") == "Done"
+    ]
+    if not attempts:
+        print(f"+ WARNING: no successful maxquant call in job {caper_job_id}")
+        return None
+    attempt = attempts[-1]
+
+    running_times = _blob_from_path(storage_client, attempt["outputs"]["runningTimes"])
+    if running_times is None:
+        print(f"+ WARNING: #runningTimes.txt not found for job {caper_job_id}")
+        return None
+    hours = parse_running_times(running_times.download_as_bytes().decode("utf-8"))
+
+    raw_blobs = [
+        _blob_from_path(storage_client, raw_file)
+        for raw_file in attempt["inputs"]["raw_file"]
+    ]
+    if any(x is None for x in raw_blobs):
+        print(f"+ WARNING: raw files of job {caper_job_id} not found (deleted?)")
+        return None
+    raw_sizes = [x.size for x in raw_blobs]
+    ncpu = int(attempt["runtimeAttributes"]["cpu"])
+    # Before the thread count was rendered into mqpar.xml, it did not match the VM
+    mqpar = _blob_from_path(storage_client, attempt["inputs"]["mq_parameters"])
+    if mqpar is not None:
+        m = re.search(
+            r"<numThreads>(\d+)</numThreads>", mqpar.download_as_bytes().decode("utf-8")
+        )
+        if m:
+            ncpu = min(ncpu, int(m[1]))
+
+    return {
+        "caper_job_id": caper_job_id,
+        "hours": hours,
+        "ncpu": ncpu,
+        "n_raw": len(raw_sizes),
+        "total_gb": sum(raw_sizes) / GB,
+        "features": features(raw_sizes, ncpu),
+    }
+
+
+def create_arguments():
+    parser = argparse.ArgumentParser(
+        description="Refit the MaxQuant sizing model from past runs"
+    )
+    parser.add_argument(
+        "-g", "--gcp_project", required=True, type=str, help="GCP project name"
+    )
+    parser.add_argument(
+        "-b",
+        "--bucket_origin",
+        required=True,
+        type=str,
+        help="Bucket with the workflow output files",
+    )
+    parser.add_argument(
+        "-r",
+        "--results_folder",
+        required=True,
+        type=str,
+        help="Path to the results folder (e.g. results/proteomics_maxquant)",
+    )
+    parser.add_argument(
+        "-i",
+        "--caper_job_id",
+        required=True,
+        nargs="+",
+        type=str,
+        help="Caper job ids of past MaxQuant runs",
+    )
+    parser.add_argument(
+        "-m",
+        "--sizing_model",
+        required=False,
+        type=str,
+        default=str(DEFAULT_MODEL),
+        help=f"Sizing model JSON file to update. Default: {DEFAULT_MODEL}",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Print the fitted coefficients without updating the model file",
+    )
+    profiling.add_argument(parser)
+    return parser
+
+
+def main():
+    parser = create_arguments()
+    args = parser.parse_args()
+    profiling.start(args.profile)
+
+    model = load_model(args.sizing_model)
+    storage_client = get_storage_client(args.gcp_project)
+    bucket = storage_client.bucket(args.bucket_origin.rstrip("/"))
+    results_folder = args.results_folder.rstrip("/")
+
+    runs = []
+    with profiling.span("metadata load"):
+        for caper_job_id in args.caper_job_id:
+            run = load_past_run(storage_client, bucket, results_folder, caper_job_id)
+            if run is not None:
+                runs.append(run)
+
+    if len(runs) < len(COEFFICIENTS):
+        print(
+            f"\n\tERROR: at least {len(COEFFICIENTS)} successful runs are needed to "
+            f"fit the model ({len(runs)} found)"
+        )
+        sys.exit(1)
+
+    with profiling.span("fit"):
+        fitted = fit_coefficients([r["features"] for r in runs], [r["hours"] for r in runs])
+    model["coefficients"] = dict(zip(COEFFICIENTS, fitted))
+
+    print("+ Fitted coefficients:")
+    for name, value in model["coefficients"].items():
+        print(f"\t- {name}: {value:.4f}")
+    print("+ Observed vs predicted wall time (hours):")
+    for run in runs:
+        predicted = sum(c * x for c, x in zip(fitted, run["features"]))
+        print(
+            f"\t- {run['caper_job_id']}: {run['n_raw']} raw files, "
+            f"{run['total_gb']:.1f} GB, {run['ncpu']} threads: "
+            f"{run['hours']:.2f} vs {predicted:.2f}"
+        )
+
+    if not args.dry_run:
+        model["fitted_runs"] = [r["caper_job_id"] for r in runs]
+        with open(args.sizing_model, "w", encoding="utf-8") as outfile:
+            json.dump(model, outfile, indent=2)
+        print("+ Sizing model updated: ", args.sizing_model)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+On-disk cache of the workflow metadata.json files downloaded from Google Cloud Storage.
+
+Entries are keyed by bucket, object name and generation, so an object that is
+rewritten (new generation) is never served from a stale entry. The blob is looked up
+first (a metadata-only request returning its generation) and only downloaded when
+the cache has no entry for that generation. Entries are stored gzip compressed and
+the least recently used ones are evicted when the cache grows over its size limit.
+
+The cache folder defaults to ~/.cache/motrpac-proteomics/metadata and can be changed
+with the PROTEOMICS_METADATA_CACHE environment variable. Setting
+PROTEOMICS_METADATA_CACHE_MB=0 disables the cache.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+
+from google.cloud.storage import Blob
+
+import profiling
+
+CACHE_DIR = Path(
+    os.environ.get(
+        "PROTEOMICS_METADATA_CACHE",
+        Path.home() / ".cache" / "motrpac-proteomics" / "metadata",
+    )
+)
+MAX_CACHE_MB = int(os.environ.get("PROTEOMICS_METADATA_CACHE_MB", 2048))
+
+
+def cache_path(blob: Blob, cache_dir: Path = CACHE_DIR) -> Path:
+    """
+    Path of the cache entry of a blob generation.
+
+    :param blob: The blob, as returned by get_blob or list_blobs (with its generation)
+    :param cache_dir: The cache folder
+    :return: The path of the compressed entry
+    """
+    key = f"{blob.bucket.name}/{blob.name}#{blob.generation}"
+    return cache_dir / f"{hashlib.sha256(key.encode('utf-8')).hexdigest()}.json.gz"
+
+
+def evict(cache_dir: Path = CACHE_DIR, max_mb: int = MAX_CACHE_MB) -> None:
+    """
+    Deletes the least recently used entries until the cache fits its size limit.
+
+    :param cache_dir: The cache folder
+    :param max_mb: The size limit in MB
+    """
+    entries = []
+    for path in cache_dir.glob("*.json.gz"):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_mb * 1024**2:
+            break
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def load_json_blob(
+    blob: Blob, cache_dir: Path = CACHE_DIR, max_mb: int = MAX_CACHE_MB
+) -> dict:
+    """
+    Loads a JSON blob (e.g. a metadata.json file) from the cache, downloading it only
+    if this generation of the blob is not cached yet.
+
+    :param blob: The blob, as returned by get_blob or list_blobs (with its generation)
+    :param cache_dir: The cache folder
+    :param max_mb: The size limit of the cache in MB (0 disables the cache)
+    :return: The loaded JSON object
+    """
+    if max_mb <= 0 or blob.generation is None:
+        with profiling.span("metadata download"):
+            content = blob.download_as_bytes()
+        with profiling.span("metadata parse"):
+            return json.loads(content)
+
+    path = cache_path(blob, cache_dir)
+    try:
+        with profiling.span("metadata cache read"):
+            with gzip.open(path, "rb") as entry:
+                data = json.loads(entry.read())
+        # the modification time tracks the last use of the entry
+        os.utime(path)
+        return data
+    except (FileNotFoundError, EOFError, gzip.BadGzipFile, json.JSONDecodeError):
+        pass
+
+    with profiling.span("metadata download"):
+        content = blob.download_as_bytes(if_generation_match=blob.generation)
+    with profiling.span("metadata parse"):
+        data = json.loads(content)
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=cache_dir, suffix=".tmp", delete=False) as tmp:
+        tmp.write(gzip.compress(content, compresslevel=6))
+    os.replace(tmp.name, path)
+    evict(cache_dir, max_mb)
+    return data
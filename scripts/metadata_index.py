@@ -0,0 +1,503 @@
+"""
+SQLite index of Cromwell workflow metadata.json files.
+
+The nested calls of a metadata.json are flattened once into tables (workflows, calls,
+samples, attempts, inputs, outputs, events and failures) indexed by task, shard and
+sample, so that the copy planner (copy_pipeline_results.py --index) and the job
+summary (pipeline_job_summary.py --index) look up the calls they need instead of
+walking the whole JSON for every question. The index can also be queried directly:
+
+    python scripts/metadata_index.py -i run.sqlite -m metadata.json \\
+        -q "SELECT task, COUNT(*) FROM calls GROUP BY task"
+
+A workflow is indexed again only when its metadata.json changes (new generation of
+the object in the bucket).
+"""
+
+import argparse
+import json
+import sqlite3
+import warnings
+from pathlib import Path
+
+from cromwell_metadata import (
+    attempt_cpus,
+    attempt_samples,
+    is_preempted,
+    queued_seconds,
+    task_name,
+    wall_seconds,
+)
+from gcs_client import get_storage_client
+from metadata_cache import load_json_blob
+import profiling
+
+warnings.filterwarnings(
+    "ignore", "Your application has authenticated using end user credentials"
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS workflows (
+    workflow_id TEXT PRIMARY KEY,
+    name TEXT,
+    status TEXT,
+    start_time TEXT,
+    end_time TEXT,
+    inputs TEXT,
+    source TEXT,
+    generation INTEGER
+);
+CREATE TABLE IF NOT EXISTS calls (
+    call_id INTEGER PRIMARY KEY,
+    workflow_id TEXT NOT NULL,
+    call_name TEXT NOT NULL,
+    task TEXT NOT NULL,
+    shard INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS samples (
+    call_id INTEGER NOT NULL,
+    sample TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS attempts (
+    attempt_id INTEGER PRIMARY KEY,
+    call_id INTEGER NOT NULL,
+    attempt INTEGER NOT NULL,
+    execution_status TEXT,
+    start_time TEXT,
+    end_time TEXT,
+    wall_seconds REAL,
+    queued_seconds REAL,
+    cpu INTEGER,
+    preemptible INTEGER,
+    preempted INTEGER,
+    runtime_attributes TEXT,
+    call_root TEXT,
+    stdout TEXT,
+    stderr TEXT,
+    command_line TEXT
+);
+CREATE TABLE IF NOT EXISTS inputs (
+    attempt_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    value TEXT,
+    is_json INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS outputs (
+    attempt_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    value TEXT,
+    is_json INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS events (
+    attempt_id INTEGER NOT NULL,
+    description TEXT,
+    start_time TEXT,
+    end_time TEXT
+);
+CREATE TABLE IF NOT EXISTS failures (
+    workflow_id TEXT NOT NULL,
+    attempt_id INTEGER,
+    failure INTEGER NOT NULL,
+    depth INTEGER NOT NULL,
+    message TEXT
+);
+CREATE INDEX IF NOT EXISTS calls_workflow_call ON calls (workflow_id, call_name, shard);
+CREATE INDEX IF NOT EXISTS calls_task_shard ON calls (task, shard);
+CREATE INDEX IF NOT EXISTS samples_sample ON samples (sample);
+CREATE INDEX IF NOT EXISTS samples_call ON samples (call_id);
+CREATE INDEX IF NOT EXISTS attempts_call ON attempts (call_id, attempt);
+CREATE INDEX IF NOT EXISTS inputs_attempt ON inputs (attempt_id, name);
+CREATE INDEX IF NOT EXISTS outputs_attempt ON outputs (attempt_id, name);
+CREATE INDEX IF NOT EXISTS events_attempt ON events (attempt_id);
+CREATE INDEX IF NOT EXISTS failures_workflow ON failures (workflow_id, attempt_id);
+"""
+
+# tables with rows of a workflow, by the column that links them to it
+_WORKFLOW_ROWS = {
+    "inputs": "attempt_id IN (SELECT attempt_id FROM attempts WHERE call_id IN {calls})",
+    "outputs": "attempt_id IN (SELECT attempt_id FROM attempts WHERE call_id IN {calls})",
+    "events": "attempt_id IN (SELECT attempt_id FROM attempts WHERE call_id IN {calls})",
+    "attempts": "call_id IN {calls}",
+    "samples": "call_id IN {calls}",
+    "failures": "workflow_id = :workflow_id",
+    "calls": "workflow_id = :workflow_id",
+    "workflows": "workflow_id = :workflow_id",
+}
+
+
+def _encode(value) -> tuple[str | None, bool]:
+    """Store strings (e.g. file paths) as they are and any other value as JSON."""
+    if value is None or isinstance(value, str):
+        return value, False
+    return json.dumps(value), True
+
+
+def _decode(value: str | None, is_json: bool):
+    return json.loads(value) if is_json else value
+
+
+def _iter_failures(failures: list[dict], depth: int = 0):
+    for failure in failures:
+        yield depth, failure.get("message")
+        yield from _iter_failures(failure.get("causedBy", []), depth + 1)
+
+
+class MetadataIndex:
+    """
+    A SQLite index of one or many workflow metadata.json files.
+    """
+
+    def __init__(self, path: str | Path) -> None:
+        """
+        Open (or create) an index.
+
+        :param path: The SQLite database file
+        """
+        self.path = Path(path)
+        self.connection = sqlite3.connect(self.path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript(SCHEMA)
+
+    def __enter__(self) -> "MetadataIndex":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def find(self, source: str, generation: int | None = None) -> str | None:
+        """
+        Workflow indexed from a metadata.json file.
+
+        :param source: The location of the metadata.json file
+        :param generation: The generation of the object (None matches any)
+        :return: The workflow id, or None if that file (generation) is not indexed
+        """
+        row = self.connection.execute(
+            "SELECT workflow_id, generation FROM workflows WHERE source = ?", (source,)
+        ).fetchone()
+        if row is None or (generation is not None and row["generation"] != generation):
+            return None
+        return row["workflow_id"]
+
+    def add(
+        self, metadata: dict, source: str | None = None, generation: int | None = None
+    ) -> str:
+        """
+        Index a workflow metadata.json, replacing the rows of a previous version.
+
+        :param metadata: The workflow metadata.json object
+        :param source: The location of the metadata.json file
+        :param generation: The generation of the object
+        :return: The workflow id
+        """
+        workflow_id = metadata.get("id") or source
+        with profiling.span("metadata indexing"), self.connection:
+            self._delete(workflow_id)
+            self.connection.execute(
+                "INSERT INTO workflows VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    workflow_id,
+                    metadata.get("workflowName"),
+                    metadata.get("status"),
+                    metadata.get("start"),
+                    metadata.get("end"),
+                    json.dumps(metadata.get("inputs", {})),
+                    source,
+                    generation,
+                ),
+            )
+            self._add_failures(workflow_id, None, metadata.get("failures", []))
+            for call_name, attempts in metadata.get("calls", {}).items():
+                self._add_call(workflow_id, call_name, attempts)
+        return workflow_id
+
+    def _delete(self, workflow_id: str) -> None:
+        calls = self.connection.execute(
+            "SELECT call_id FROM calls WHERE workflow_id = ?", (workflow_id,)
+        ).fetchall()
+        call_ids = "(" + ", ".join(str(row["call_id"]) for row in calls) + ")"
+        for table, condition in _WORKFLOW_ROWS.items():
+            self.connection.execute(
+                f"DELETE FROM {table} WHERE {condition.format(calls=call_ids)}",
+                {"workflow_id": workflow_id},
+            )
+
+    def _add_failures(self, workflow_id: str, attempt_id: int | None, failures: list):
+        self.connection.executemany(
+            "INSERT INTO failures VALUES (?, ?, ?, ?, ?)",
+            (
+                (workflow_id, attempt_id, i, depth, message)
+                for i, failure in enumerate(failures)
+                for depth, message in _iter_failures([failure])
+            ),
+        )
+
+    def _add_call(self, workflow_id: str, call_name: str, attempts: list[dict]) -> None:
+        call_ids = {}
+        for attempt in attempts:
+            shard = attempt.get("shardIndex", -1)
+            if shard not in call_ids:
+                cursor = self.connection.execute(
+                    "INSERT INTO calls (workflow_id, call_name, task, shard) "
+                    "VALUES (?, ?, ?, ?)",
+                    (workflow_id, call_name, task_name(call_name), shard),
+                )
+                call_ids[shard] = cursor.lastrowid
+                self.connection.executemany(
+                    "INSERT INTO samples VALUES (?, ?)",
+                    ((cursor.lastrowid, x) for x in sorted(attempt_samples(attempt))),
+                )
+
+            cursor = self.connection.execute(
+                "INSERT INTO attempts (call_id, attempt, execution_status, start_time, "
+                "end_time, wall_seconds, queued_seconds, cpu, preemptible, preempted, "
+                "runtime_attributes, call_root, stdout, stderr, command_line) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    call_ids[shard],
+                    attempt.get("attempt", 1),
+                    attempt.get("executionStatus"),
+                    attempt.get("start"),
+                    attempt.get("end"),
+                    wall_seconds(attempt),
+                    queued_seconds(attempt),
+                    attempt_cpus(attempt),
+                    bool(attempt.get("preemptible")),
+                    is_preempted(attempt),
+                    json.dumps(attempt.get("runtimeAttributes", {})),
+                    attempt.get("callRoot"),
+                    attempt.get("stdout"),
+                    attempt.get("stderr"),
+                    attempt.get("commandLine"),
+                ),
+            )
+            attempt_id = cursor.lastrowid
+            for table in ("inputs", "outputs"):
+                self.connection.executemany(
+                    f"INSERT INTO {table} VALUES (?, ?, ?, ?)",
+                    ((attempt_id, k, *_encode(v)) for k, v in attempt.get(table, {}).items()),
+                )
+            self.connection.executemany(
+                "INSERT INTO events VALUES (?, ?, ?, ?)",
+                (
+                    (attempt_id, x.get("description"), x.get("startTime"), x.get("endTime"))
+                    for x in attempt.get("executionEvents", [])
+                ),
+            )
+            self._add_failures(workflow_id, attempt_id, attempt.get("failures", []))
+
+    def workflow_ids(self) -> list[str]:
+        """
+        :return: The ids of the indexed workflows
+        """
+        rows = self.connection.execute("SELECT workflow_id FROM workflows ORDER BY start_time")
+        return [row["workflow_id"] for row in rows]
+
+    def workflow(self, workflow_id: str) -> dict | None:
+        """
+        Workflow-level metadata, without the calls.
+
+        :param workflow_id: The workflow id
+        :return: The id, workflowName, status, start, end, inputs and failures (as in
+            metadata.json, with the messages of the failures and their causes), or None
+        """
+        row = self.connection.execute(
+            "SELECT * FROM workflows WHERE workflow_id = ?", (workflow_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        failures = {}
+        for failure in self.connection.execute(
+            "SELECT failure, depth, message FROM failures "
+            "WHERE workflow_id = ? AND attempt_id IS NULL ORDER BY rowid",
+            (workflow_id,),
+        ):
+            entry = failures.setdefault(failure["failure"], {"causedBy": []})
+            if failure["depth"] == 0:
+                entry["message"] = failure["message"]
+            else:
+                entry["causedBy"].append({"message": failure["message"]})
+        return {
+            "id": row["workflow_id"],
+            "workflowName": row["name"],
+            "status": row["status"],
+            "start": row["start_time"],
+            "end": row["end_time"],
+            "inputs": json.loads(row["inputs"]),
+            "failures": list(failures.values()),
+        }
+
+    def call_names(self, workflow_id: str) -> set[str]:
+        """
+        :param workflow_id: The workflow id
+        :return: The names of the calls of the workflow (e.g. proteomics_msgfplus.masic)
+        """
+        rows = self.connection.execute(
+            "SELECT DISTINCT call_name FROM calls WHERE workflow_id = ?", (workflow_id,)
+        )
+        return {row["call_name"] for row in rows}
+
+    def call_attempts(
+        self, workflow_id: str, call_name: str, samples: set[str] | None = None
+    ) -> list[dict]:
+        """
+        Attempts of a call, as call attempt metadata objects (shardIndex, attempt,
+        executionStatus, start, end, stdout, stderr, commandLine, callRoot, inputs and
+        outputs).
+
+        :param workflow_id: The workflow id
+        :param call_name: The call name (e.g. proteomics_msgfplus.masic)
+        :param samples: Only the shards of these samples (and the calls that are not
+            scattered). None selects all of them
+        :return: The call attempts, by shard and attempt
+        """
+        query = (
+            "SELECT c.shard, a.* FROM calls c JOIN attempts a USING (call_id) "
+            "WHERE c.workflow_id = ? AND c.call_name = ?"
+        )
+        parameters = [workflow_id, call_name]
+        if samples is not None:
+            query += (
+                " AND (c.shard = -1 OR c.call_id IN (SELECT call_id FROM samples "
+                f"WHERE sample IN ({', '.join('?' * len(samples))})))"
+            )
+            parameters += sorted(samples)
+        rows = self.connection.execute(
+            query + " ORDER BY c.shard, a.attempt", parameters
+        ).fetchall()
+        values = {}
+        for table in ("inputs", "outputs"):
+            for x in self.connection.execute(
+                f"SELECT t.attempt_id, t.name, t.value, t.is_json FROM {table} t "
+                "JOIN attempts a USING (attempt_id) JOIN calls c USING (call_id) "
+                "WHERE c.workflow_id = ? AND c.call_name = ?",
+                (workflow_id, call_name),
+            ):
+                values.setdefault((table, x["attempt_id"]), {})[x["name"]] = _decode(
+                    x["value"], x["is_json"]
+                )
+
+        attempts = []
+        for row in rows:
+            attempt = {
+                "shardIndex": row["shard"],
+                "attempt": row["attempt"],
+                "executionStatus": row["execution_status"],
+                "start": row["start_time"],
+                "end": row["end_time"],
+                "preemptible": bool(row["preemptible"]),
+                "runtimeAttributes": json.loads(row["runtime_attributes"]),
+                "callRoot": row["call_root"],
+                "stdout": row["stdout"],
+                "stderr": row["stderr"],
+                "commandLine": row["command_line"],
+            }
+            for table in ("inputs", "outputs"):
+                attempt[table] = values.get((table, row["attempt_id"]), {})
+            attempts.append({k: v for k, v in attempt.items() if v is not None})
+        return attempts
+
+    def task_statistics(self, workflow_ids: list[str] | None = None) -> dict[str, dict]:
+        """
+        Aggregate the call attempts of some workflows per task (the same statistics as
+        cromwell_metadata.task_statistics).
+
+        :param workflow_ids: The workflows (default: all the indexed workflows)
+        :return: Mapping of task name to its statistics
+        """
+        query = """
+            SELECT
+                c.task AS task,
+                SUM(a.attempt = 1) AS shards,
+                COUNT(*) AS attempts,
+                SUM(a.preempted) AS preemptions,
+                SUM(NOT a.preempted
+                    AND COALESCE(a.execution_status, '') NOT IN ('Done', 'Running'))
+                    AS failed_attempts,
+                SUM(a.wall_seconds) / 3600 AS wall_hours,
+                SUM(a.queued_seconds) / 3600 AS queued_hours,
+                SUM(a.wall_seconds * a.cpu) / 3600 AS cpu_hours,
+                MAX(a.wall_seconds) / 3600 AS max_wall_hours
+            FROM calls c JOIN attempts a USING (call_id)
+        """
+        parameters = []
+        if workflow_ids is not None:
+            query += f" WHERE c.workflow_id IN ({', '.join('?' * len(workflow_ids))})"
+            parameters = list(workflow_ids)
+        stats = {}
+        for row in self.connection.execute(query + " GROUP BY c.task", parameters):
+            task = dict(row)
+            task["mean_wall_hours"] = task["wall_hours"] / max(task["attempts"], 1)
+            stats[task["task"]] = task
+        return stats
+
+
+def create_arguments():
+    parser = argparse.ArgumentParser(
+        description="Index Cromwell metadata.json files into a SQLite database"
+    )
+    parser.add_argument(
+        "-i", "--index", required=True, type=str, help="SQLite index file"
+    )
+    parser.add_argument(
+        "-m",
+        "--metadata",
+        required=False,
+        nargs="+",
+        type=str,
+        default=[],
+        help="metadata.json files to index (local or gs://bucket/path/metadata.json)",
+    )
+    parser.add_argument(
+        "-p",
+        "--project",
+        required=False,
+        type=str,
+        help="GCP project name (to index metadata.json files on GCS)",
+    )
+    parser.add_argument(
+        "-q",
+        "--query",
+        required=False,
+        type=str,
+        help="Optional: SQL query to run on the index (results printed tab separated)",
+    )
+    profiling.add_argument(parser)
+    return parser
+
+
+def main():
+    parser = create_arguments()
+    args = parser.parse_args()
+    profiling.start(args.profile)
+
+    with MetadataIndex(args.index) as index:
+        for location in args.metadata:
+            if location.startswith("gs://"):
+                bucket_name, _, name = location.removeprefix("gs://").partition("/")
+                blob = get_storage_client(args.project).bucket(bucket_name).get_blob(name)
+                if blob is None:
+                    print(f"+ {location} not found")
+                    continue
+                if index.find(location, blob.generation) is not None:
+                    print(f"+ {location} already indexed")
+                    continue
+                workflow_id = index.add(load_json_blob(blob), location, blob.generation)
+            else:
+                with open(location, encoding="utf-8") as infile:
+                    metadata = json.load(infile)
+                workflow_id = index.add(metadata, str(Path(location).resolve()))
+            print(f"+ Indexed {workflow_id} from {location}")
+
+        if args.query is not None:
+            cursor = index.connection.execute(args.query)
+            print("\t".join(x[0] for x in cursor.description))
+            for row in cursor:
+                print("\t".join("" if x is None else str(x) for x in row))
+
+
+if __name__ == "__main__":
+    main()
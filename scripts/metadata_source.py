@@ -0,0 +1,211 @@
+"""
+Sources of the metadata of a workflow.
+
+- BucketMetadataSource: the metadata.json file that Caper writes to the output folder
+  of the workflow when it finishes (cached by generation, see metadata_cache.py),
+- FileMetadataSource: a local metadata.json file, e.g. refreshed with
+  `caper metadata WORKFLOW_ID > metadata.json` while the workflow is running,
+- CromwellMetadataSource: the metadata API of the Cromwell (or Caper) server running
+  the workflow, available while it runs. The server can filter the metadata
+  (includeKey/excludeKey), so that only the keys a tool reads are built and sent,
+  gzip compressed.
+
+The metadata is read again every time load is called, so a tool watching a running
+workflow polls its source.
+"""
+
+import json
+import re
+import threading
+from abc import ABC, abstractmethod
+from pathlib import Path
+
+import requests
+from google.cloud.storage import Blob, Bucket
+
+from metadata_cache import load_json_blob
+
+# the status of a workflow or call attempt that no longer changes
+FINAL_STATUSES = {"Succeeded", "Failed", "Aborted", "Done", "RetryableFailure"}
+
+API_VERSION = "v1"
+REQUEST_TIMEOUT = (10, 600)
+QUERY_PAGE_SIZE = 100
+
+_local = threading.local()
+
+
+def _session() -> requests.Session:
+    # one session (connection pool) per thread, requests.Session is not thread safe
+    if not hasattr(_local, "session"):
+        _local.session = requests.Session()
+        _local.session.headers["Accept-Encoding"] = "gzip"
+    return _local.session
+
+
+class MetadataSource(ABC):
+    """A location the metadata of a workflow is loaded from."""
+
+    location = ""
+
+    @abstractmethod
+    def load(self) -> dict:
+        """
+        Load the current metadata of the workflow.
+
+        :return: The metadata.json object
+        :raise: FileNotFoundError if there is no metadata at the location
+        """
+
+
+class BucketMetadataSource(MetadataSource):
+    """The metadata.json file in the output folder of a workflow."""
+
+    def __init__(self, bucket: Bucket, folder: str) -> None:
+        """
+        :param bucket: The bucket of the workflow outputs
+        :param folder: The output folder of the workflow
+        """
+        self.bucket = bucket
+        self.folder = folder.rstrip("/")
+        self.location = f"gs://{bucket.name}/{self.folder}/metadata.json"
+
+    def find_blob(self) -> Blob | None:
+        """
+        Find the metadata.json file, directly in the folder or else below it.
+
+        :return: The blob, or None if there is none
+        """
+        blob = self.bucket.get_blob(f"{self.folder}/metadata.json")
+        if blob is not None:
+            return blob
+        for blob in self.bucket.list_blobs(prefix=f"{self.folder}/"):
+            if re.match("(.*.metadata.json)", blob.name):
+                return blob
+        return None
+
+    def load(self) -> dict:
+        blob = self.find_blob()
+        if blob is None:
+            raise FileNotFoundError(f"No metadata.json file in gs://{self.bucket.name}/{self.folder}/")
+        return load_json_blob(blob)
+
+
+class FileMetadataSource(MetadataSource):
+    """A local metadata.json file."""
+
+    def __init__(self, path: str) -> None:
+        """
+        :param path: The metadata.json file
+        """
+        self.location = str(Path(path).resolve())
+
+    def load(self) -> dict:
+        with open(self.location, encoding="utf-8") as infile:
+            return json.load(infile)
+
+
+class CromwellMetadataSource(MetadataSource):
+    """The metadata of a workflow from the REST API of a Cromwell server."""
+
+    def __init__(
+        self,
+        server: str,
+        workflow_id: str,
+        include_keys: list[str] | None = None,
+        exclude_keys: list[str] | None = None,
+    ) -> None:
+        """
+        :param server: The URL of the server (e.g. http://localhost:8000)
+        :param workflow_id: The workflow id
+        :param include_keys: Only return these keys (and the keys starting with them),
+            at the workflow and call levels
+        :param exclude_keys: Return all the keys but these
+        :raise: ValueError if both include_keys and exclude_keys are given (Cromwell
+            accepts only one of them)
+        """
+        if include_keys and exclude_keys:
+            raise ValueError("Cromwell accepts either includeKey or excludeKey, not both")
+        self.server = server.rstrip("/")
+        self.workflow_id = workflow_id
+        self.include_keys = include_keys or []
+        self.exclude_keys = exclude_keys or []
+        self.location = f"{self.server}/api/workflows/{API_VERSION}/{workflow_id}/metadata"
+
+    def load(self) -> dict:
+        params = [("expandSubWorkflows", "false")]
+        params += [("includeKey", x) for x in self.include_keys]
+        params += [("excludeKey", x) for x in self.exclude_keys]
+        response = _session().get(self.location, params=params, timeout=REQUEST_TIMEOUT)
+        if response.status_code == 404:
+            raise FileNotFoundError(f"Workflow {self.workflow_id} not found on {self.server}")
+        response.raise_for_status()
+        return response.json()
+
+
+def query_workflows(
+    server: str,
+    names: list[str] | None = None,
+    statuses: list[str] | None = None,
+    page_size: int = QUERY_PAGE_SIZE,
+) -> list[dict]:
+    """
+    The workflows known to a Cromwell server (without the sub-workflows), reading all
+    the pages of the results.
+
+    :param server: The URL of the server (e.g. http://localhost:8000)
+    :param names: Only the workflows with these names (e.g. proteomics_msgfplus)
+    :param statuses: Only the workflows with these statuses (e.g. Running)
+    :param page_size: The number of workflows requested at a time
+    :return: A dict per workflow (id, name, status, submission, start, end)
+    """
+    url = f"{server.rstrip('/')}/api/workflows/{API_VERSION}/query"
+    workflows = []
+    page = 1
+    while True:
+        params = [("page", page), ("pageSize", page_size), ("includeSubworkflows", "false")]
+        params += [("name", x) for x in names or []]
+        params += [("status", x) for x in statuses or []]
+        response = _session().get(url, params=params, timeout=REQUEST_TIMEOUT)
+        response.raise_for_status()
+        body = response.json()
+        results = body.get("results", [])
+        workflows += results
+        if not results or len(workflows) >= body.get("totalResultsCount", 0):
+            return workflows
+        page += 1
+
+
+def open_metadata_source(
+    location: str,
+    workflow_id: str | None = None,
+    include_keys: list[str] | None = None,
+) -> MetadataSource:
+    """
+    The metadata source of a location given on the command line.
+
+    :param location: A local metadata.json file, the URL of a Cromwell server
+        (http://localhost:8000) or of the metadata of a workflow on the server
+        (http://localhost:8000/api/workflows/v1/WORKFLOW_ID/metadata)
+    :param workflow_id: The workflow id, if not in the URL of the server
+    :param include_keys: The keys the server returns (see CromwellMetadataSource)
+    :return: The metadata source
+    :raise: ValueError if the URL of a server is given without a workflow id
+    """
+    if not location.startswith(("http://", "https://")):
+        return FileMetadataSource(location)
+    m = re.match(r"(.*)/api/workflows/[^/]+/([^/]+)", location)
+    if m:
+        return CromwellMetadataSource(m[1], m[2], include_keys)
+    if workflow_id is None:
+        raise ValueError(f"No workflow id for the Cromwell server {location}")
+    return CromwellMetadataSource(location, workflow_id, include_keys)
+
+
+def workflow_finished(metadata: dict) -> bool:
+    """
+    Whether a workflow has finished (its metadata no longer changes).
+
+    :param metadata: The metadata.json object
+    """
+    return metadata.get("status") in FINAL_STATUSES
@@ -0,0 +1,258 @@
+"""
+Helpers to read and edit MaxQuant parameter files (mqpar.xml).
+"""
+
+import xml.etree.ElementTree as ET
+from pathlib import PureWindowsPath
+
+ET.register_namespace("xsd", "http://www.w3.org/2001/XMLSchema")
+ET.register_namespace("xsi", "http://www.w3.org/2001/XMLSchema-instance")
+
+# Elements holding one value per raw file, in the order of <filePaths>
+PER_FILE_ELEMENTS = [
+    "filePaths",
+    "experiments",
+    "fractions",
+    "ptms",
+    "paramGroupIndices",
+    "referenceChannel",
+]
+
+
+def load_mqpar(text):
+    """
+    Parses the content of a mqpar.xml file
+
+    :param text: The content of the mqpar.xml file
+    :return: The root element
+    :rtype: xml.etree.ElementTree.Element
+    """
+    return ET.fromstring(text.lstrip("\ufeff"))
+
+
+def dump_mqpar(root):
+    """
+    Serializes a mqpar.xml tree
+
+    :param root: The root element
+    :return: The content of the mqpar.xml file
+    :rtype: str
+    """
+    ET.indent(root, space="   ")
+    return '<?xml version="1.0" encoding="utf-8"?>\n' + ET.tostring(
+        root, encoding="unicode"
+    )
+
+
+def raw_file_name(path):
+    """
+    Raw file name without extension. mqpar.xml files created on Windows use
+    backslashes, so both separators are handled.
+
+    :param path: The raw file path
+    :return: The raw file name without the .raw extension
+    :rtype: str
+    """
+    name = PureWindowsPath(path).name
+    return name[: -len(".raw")] if name.lower().endswith(".raw") else name
+
+
+def mqpar_raw_files(root):
+    """
+    Raw file names listed in <filePaths>
+
+    :param root: The root element
+    :return: The raw file names without extension
+    :rtype: list[str]
+    """
+    return [raw_file_name(x.text or "") for x in root.find("filePaths")]
+
+
+def single_file_mqpar(root, raw_name, num_threads=None):
+    """
+    Copy of the parameters restricted to one raw file: every per raw file list keeps
+    only the entry of that file.
+
+    :param root: The root element
+    :param raw_name: The raw file name without extension
+    :param num_threads: Optional number of threads (the number of CPUs of the VM)
+    :return: The content of the single raw file mqpar.xml
+    :rtype: str
+    :raise: ValueError
+    """
+    names = mqpar_raw_files(root)
+    if raw_name not in names:
+        raise ValueError(f"Raw file {raw_name} is not listed in mqpar.xml <filePaths>")
+    index = names.index(raw_name)
+
+    single = ET.fromstring(ET.tostring(root))
+    for tag in PER_FILE_ELEMENTS:
+        element = single.find(tag)
+        if element is None or len(element) != len(names):
+            continue
+        for (i, child) in reversed(list(enumerate(element))):
+            if i != index:
+                element.remove(child)
+    if num_threads is not None:
+        threads = single.find("numThreads")
+        if threads is None:
+            threads = ET.SubElement(single, "numThreads")
+        threads.text = str(num_threads)
+    return dump_mqpar(single)
+
+
+def read_experimental_design(text):
+    """
+    Parses a MaxQuant experimental design file (tab separated, with the columns Name,
+    Fraction and Experiment as in MaxQuant's experimentalDesignTemplate.txt)
+
+    :param text: The content of the experimental design file
+    :return: Mapping of raw file name to (experiment, fraction)
+    :rtype: dict[str, tuple[str, str]]
+    """
+    lines = [line.rstrip("\r").split("\t") for line in text.splitlines() if line.strip()]
+    header = lines[0]
+    name, fraction, experiment = (
+        header.index("Name"),
+        header.index("Fraction"),
+        header.index("Experiment"),
+    )
+    design = {}
+    for line in lines[1:]:
+        line = line + [""] * (len(header) - len(line))
+        design[raw_file_name(line[name])] = (
+            line[experiment] or raw_file_name(line[name]),
+            line[fraction] or "32767",
+        )
+    return design
+
+
+def _set_values(root, tag, child_tag, values):
+    element = root.find(tag)
+    if element is None:
+        element = ET.SubElement(root, tag)
+    for child in list(element):
+        element.remove(child)
+    for value in values:
+        ET.SubElement(element, child_tag).text = value
+
+
+def _template_file_values(root, names):
+    # ptms and parameter group of each raw file: the template's own value for the
+    # files it lists, else the value shared by all its files
+    template_names = mqpar_raw_files(root) if root.find("filePaths") is not None else []
+    values = {}
+    for tag, default in (("ptms", "False"), ("paramGroupIndices", "0")):
+        element = root.find(tag)
+        texts = [] if element is None else [x.text or default for x in element]
+        if len(texts) != len(template_names):
+            texts = [default] * len(template_names)
+        by_name = dict(zip(template_names, texts))
+        shared = set(texts) or {default}
+        result = []
+        for name in names:
+            if name in by_name:
+                result.append(by_name[name])
+            elif len(shared) == 1:
+                result.append(next(iter(shared)))
+            else:
+                raise ValueError(
+                    f"Raw file {name} is not listed in the template, which has several "
+                    f"values of <{tag}>: {', '.join(sorted(shared))}"
+                )
+        values[tag] = result
+    return values["ptms"], values["paramGroupIndices"]
+
+
+def render_mqpar(root, raw_files, fasta_file, num_threads, design=None):
+    """
+    Renders a mqpar.xml template for a set of raw files: file list, experiment and
+    fraction of each file, sequence database and number of threads. Paths are
+    relative to the mqdata folder used by the workflow tasks. The PTM flag and
+    parameter group of a raw file listed in the template are kept; the other raw
+    files get the values shared by all the files of the template.
+
+    :param root: The root element of the template (not modified)
+    :param raw_files: The raw file paths
+    :param fasta_file: The sequence database path
+    :param num_threads: The number of threads (the number of CPUs of the VM)
+    :param design: Optional mapping of raw file name to (experiment, fraction). By
+        default, every raw file is its own experiment without fractions.
+    :return: The rendered root element
+    :rtype: xml.etree.ElementTree.Element
+    :raise: ValueError
+    """
+    rendered = ET.fromstring(ET.tostring(root))
+    names = [raw_file_name(f) for f in raw_files]
+    design = design or {}
+    missing = [n for n in names if design and n not in design]
+    if missing:
+        raise ValueError(
+            f"Raw files not listed in the experimental design: {', '.join(missing)}"
+        )
+
+    ptms, param_groups = _template_file_values(rendered, names)
+
+    _set_values(
+        rendered,
+        "filePaths",
+        "string",
+        [f"mqdata/{PureWindowsPath(f).name}" for f in raw_files],
+    )
+    _set_values(
+        rendered, "experiments", "string", [design.get(n, (n, ""))[0] for n in names]
+    )
+    _set_values(
+        rendered, "fractions", "short", [design.get(n, ("", "32767"))[1] for n in names]
+    )
+    _set_values(rendered, "ptms", "boolean", ptms)
+    _set_values(rendered, "paramGroupIndices", "int", param_groups)
+    if rendered.find("referenceChannel") is not None:
+        _set_values(rendered, "referenceChannel", "string", [""] * len(names))
+
+    fasta_paths = rendered.findall("./fastaFiles/FastaFileInfo/fastaFilePath")
+    if not fasta_paths:
+        fasta_paths = rendered.findall("./fastaFiles/string")
+    for element in fasta_paths:
+        element.text = f"mqdata/{PureWindowsPath(fasta_file).name}"
+
+    threads = rendered.find("numThreads")
+    if threads is None:
+        threads = ET.SubElement(rendered, "numThreads")
+    threads.text = str(num_threads)
+
+    return rendered
+
+
+def validate_mqpar(root, max_threads):
+    """
+    Checks a rendered mqpar.xml for inconsistencies
+
+    :param root: The root element
+    :param max_threads: The number of CPUs of the VM
+    :return: The list of errors found (empty if valid)
+    :rtype: list[str]
+    """
+    errors = []
+    file_paths = root.find("filePaths")
+    n_files = 0 if file_paths is None else len(file_paths)
+    if n_files == 0:
+        errors.append("<filePaths> is empty")
+    for tag in PER_FILE_ELEMENTS[1:]:
+        element = root.find(tag)
+        if element is not None and len(element) != n_files:
+            errors.append(f"<{tag}> has {len(element)} entries, expected {n_files}")
+    for fraction in root.iterfind("./fractions/*"):
+        if not (fraction.text or "").isdigit():
+            errors.append(f"Invalid fraction: {fraction.text}")
+    for experiment in root.iterfind("./experiments/*"):
+        if not (experiment.text or "").strip():
+            errors.append("Empty experiment name")
+    threads = root.findtext("numThreads", "")
+    if not threads.isdigit() or not 1 <= int(threads) <= max_threads:
+        errors.append(f"<numThreads> is {threads}, expected 1 to {max_threads}")
+    if not root.findall("./fastaFiles//fastaFilePath") and not root.findall(
+        "./fastaFiles/string"
+    ):
+        errors.append("No sequence database in <fastaFiles>")
+    return errors
@@ -4,6 +4,7 @@ that the proteomics pipeline can run, and the unique parameter files that each o
 requires.
 """
 
+import argparse
 from pathlib import Path
 from typing import Any
 
@@ -11,6 +12,8 @@ from pydantic import (
     BaseModel, ConfigDict, AliasGenerator, ValidationError, field_validator,
 )
 
+import profiling
+
 TEMPLATE_DIR = Path(__file__).parent.parent / "inputs/templates/msgfplus"
 
 
@@ -25,10 +28,12 @@ class CromwellInputFile(BaseModel):
 
 class DockerImages(CromwellInputFile):
     ascore_docker: str | None = None
+    fused_search_docker: str | None = None
     masic_docker: str
     msconvert_docker: str
     msgf_docker: str
     mzidtotsvconverter_docker: str
+    mzidmerger_docker: str | None = None
     phrp_docker: str
     ppm_errorcharter_docker: str
     wrapper_docker: str
@@ -98,24 +103,34 @@ def parse_inputs_file(inputs_file_path) -> tuple[tuple[str, str], RawInputsFile]
 
 def main() -> None:
     """Run the script"""
-    file_templates = {}
-    for p in TEMPLATE_DIR.glob("*.json"):
-        k, v = parse_inputs_file(p)
-        file_templates[k] = v
-
-    parameter_mapping = ParameterMap(
-        **{
-            # here we build the experiments mapping
-            experiment: QuantMethodMap(
-                **{
-                    # and for each experiment, we build the methods mapping
-                    method: file_templates[(experiment, method)]
-                    for method in ["lf", "tmt11", "tmt16", "tmt18"]
-                }
-            )
-            for experiment in ["pr", "ph", "ac", "ub"]
-        }
+    parser = argparse.ArgumentParser(
+        description="Print the parameter files of every assay of the MSGF+ templates "
+                    "as JSON"
     )
+    profiling.add_argument(parser)
+    args = parser.parse_args()
+    profiling.start(args.profile)
+
+    file_templates = {}
+    with profiling.span("template load"):
+        for p in TEMPLATE_DIR.glob("*.json"):
+            k, v = parse_inputs_file(p)
+            file_templates[k] = v
+
+    with profiling.span("mapping validation"):
+        parameter_mapping = ParameterMap(
+            **{
+                # here we build the experiments mapping
+                experiment: QuantMethodMap(
+                    **{
+                        # and for each experiment, we build the methods mapping
+                        method: file_templates[(experiment, method)]
+                        for method in ["lf", "tmt11", "tmt16", "tmt18"]
+                    }
+                )
+                for experiment in ["pr", "ph", "ac", "ub"]
+            }
+        )
 
     print(parameter_mapping.model_dump_json(indent=2))
 
@@ -0,0 +1,187 @@
+"""
+Conversion of the tab-separated result tables into Parquet files, next to the text
+files copied by copy_pipeline_results.py (--parquet) or on demand (this script).
+
+The tables (PlexedPiper ratio/RII, MaxQuant evidence, msms and proteinGroups) are
+streamed from the bucket in blocks of BLOCK_SIZE bytes, and every block is written as
+a row group of the Parquet file while it is uploaded, so neither of them is held in
+memory or written to the local disk. The column types are inferred from the first
+block. When a later block does not fit them (e.g. a column of integers that turns
+into a list of ids), the table is converted again with that column read as strings.
+The columns naming samples and proteins are dictionary encoded, so they load as
+categoricals.
+
+Requires pyarrow (pip3 install pyarrow).
+"""
+
+import argparse
+import logging
+import re
+import warnings
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.csv as csv
+import pyarrow.parquet as pq
+from google.cloud.storage import Blob
+
+from gcs_client import get_storage_client
+import profiling
+
+warnings.filterwarnings(
+    "ignore", "Your application has authenticated using end user credentials"
+)
+
+logger = logging.getLogger(__name__)
+
+# Outputs (of wrapper_pp, maxquant and maxquant_combined) converted by the copy tool
+PARQUET_OUTPUTS = {
+    "results_ratio",
+    "results_rii",
+    "evidence",
+    "msms",
+    "proteinGroups",
+}
+
+# Sample and protein columns of the PlexedPiper and MaxQuant tables
+DICTIONARY_COLUMNS = (
+    # PlexedPiper
+    "protein_id",
+    "ptm_id",
+    "gene_symbol",
+    "entrez_id",
+    "redundant_ids",
+    "organism_name",
+    # MaxQuant
+    "Raw file",
+    "Experiment",
+    "Proteins",
+    "Leading proteins",
+    "Leading razor protein",
+    "Protein IDs",
+    "Majority protein IDs",
+    "Gene names",
+    "Protein names",
+)
+
+BLOCK_SIZE = 16 * 1024**2
+NULL_VALUES = ["", "NA", "NaN", "n. def."]
+PARQUET_CONTENT_TYPE = "application/vnd.apache.parquet"
+
+
+def parquet_name(name: str) -> str:
+    """
+    Name of the Parquet file of a table (the extension replaced by .parquet).
+
+    :param name: The table file name or path
+    :return: The Parquet file name or path
+    """
+    return str(Path(name).with_suffix(".parquet"))
+
+
+def _open_reader(source, column_types: dict) -> csv.CSVStreamingReader:
+    return csv.open_csv(
+        source,
+        read_options=csv.ReadOptions(block_size=BLOCK_SIZE),
+        parse_options=csv.ParseOptions(delimiter="\t", quote_char=False),
+        convert_options=csv.ConvertOptions(
+            column_types=column_types,
+            null_values=NULL_VALUES,
+            strings_can_be_null=True,
+        ),
+    )
+
+
+def _write_parquet(source_blob: Blob, destination_blob: Blob, column_types: dict):
+    with source_blob.open("rb", chunk_size=BLOCK_SIZE) as source:
+        reader = _open_reader(source, column_types)
+        with destination_blob.open(
+            "wb", ignore_flush=True, content_type=PARQUET_CONTENT_TYPE
+        ) as destination:
+            with pq.ParquetWriter(
+                destination, reader.schema, compression="zstd"
+            ) as writer:
+                rows = 0
+                for batch in reader:
+                    writer.write_batch(batch)
+                    rows += batch.num_rows
+    return reader.schema, rows
+
+
+def convert_table(source_blob: Blob, destination_blob: Blob) -> dict:
+    """
+    Converts a tab-separated table into a Parquet file.
+
+    :param source_blob: The table
+    :param destination_blob: The Parquet file to write
+    :return: A dict with the number of rows and columns, and the columns read as
+        strings because they did not fit the inferred types
+    """
+    dictionary = pa.dictionary(pa.int32(), pa.string())
+    column_types = {name: dictionary for name in DICTIONARY_COLUMNS}
+    as_strings = []
+    while True:
+        try:
+            schema, rows = _write_parquet(source_blob, destination_blob, column_types)
+            break
+        except pa.ArrowInvalid as e:
+            # e.g. "In CSV column #4: Row #1502: CSV conversion error to int64"
+            match = re.search(r"CSV column #(\d+)", str(e))
+            with source_blob.open("rb", chunk_size=BLOCK_SIZE) as source:
+                inferred = _open_reader(source, column_types).schema
+            if match is None or int(match[1]) >= len(inferred):
+                raise
+            name = inferred.names[int(match[1])]
+            if name in as_strings:
+                raise
+            logger.warning("%s: %s. Reading %s as strings", source_blob.name, e, name)
+            column_types[name] = pa.string()
+            as_strings.append(name)
+    return {"rows": rows, "columns": len(schema), "as_strings": as_strings}
+
+
+def create_arguments():
+    parser = argparse.ArgumentParser(
+        description="Convert tab-separated result tables on GCS into Parquet files "
+        "(written next to them)"
+    )
+    parser.add_argument(
+        "-p", "--project", required=True, type=str, help="GCP project name"
+    )
+    parser.add_argument(
+        "tables",
+        nargs="+",
+        type=str,
+        help="Tables to convert (gs://bucket/path/evidence.txt ...)",
+    )
+    profiling.add_argument(parser)
+    return parser
+
+
+def main():
+    parser = create_arguments()
+    args = parser.parse_args()
+    profiling.start(args.profile)
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s :: %(message)s")
+
+    storage_client = get_storage_client(args.project)
+    for table in args.tables:
+        bucket_name, _, name = table.removeprefix("gs://").partition("/")
+        bucket = storage_client.bucket(bucket_name)
+        source_blob = bucket.get_blob(name)
+        if source_blob is None:
+            logger.error("%s not found", table)
+            continue
+        with profiling.span("parquet conversion"):
+            result = convert_table(source_blob, bucket.blob(parquet_name(name)))
+        logger.info(
+            "gs://%s/%s: %d rows, %d columns",
+            bucket_name,
+            parquet_name(name),
+            result["rows"],
+            result["columns"],
+        )
+
+
+if __name__ == "__main__":
+    main()
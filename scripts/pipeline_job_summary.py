@@ -1,15 +1,63 @@
 import argparse
+import csv
 import json
+import re
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 
 import dateparser
-from google.cloud import storage
+
+from cromwell_metadata import task_statistics
+from gcs_client import get_storage_client
+from metadata_cache import load_json_blob
+from metadata_index import MetadataIndex
+from metadata_source import CromwellMetadataSource, query_workflows
+from preemption import preemption_waste, recommend_preemptible
+from job_timeline import (
+    BREAKDOWN_COLUMNS,
+    chrome_trace,
+    critical_path,
+    stragglers,
+    task_breakdown,
+)
+import profiling
 
 
 warnings.filterwarnings(
     "ignore", "Your application has authenticated using end user credentials"
 )
 
+# the metadata keys of the summary and statistics, requested from a Cromwell server
+SUMMARY_METADATA_KEYS = [
+    'workflowName',
+    'status',
+    'start',
+    'end',
+    'failures',
+    'executionStatus',
+    'shardIndex',
+    'attempt',
+    'preempted',
+    'preemptible',
+    'runtimeAttributes',
+    'executionEvents',
+]
+# the large metadata keys that no report reads
+UNUSED_METADATA_KEYS = ['submittedFiles', 'commandLine']
+
+STATISTICS_COLUMNS = [
+    'task',
+    'shards',
+    'attempts',
+    'preemptions',
+    'failed_attempts',
+    'wall_hours',
+    'mean_wall_hours',
+    'max_wall_hours',
+    'queued_hours',
+    'cpu_hours',
+]
+
 
 def arg_parser():
     parser = argparse.ArgumentParser(description='Calculate a job completion time')
@@ -19,65 +67,450 @@ def arg_parser():
     parser.add_argument(
         '-b',
         '--bucket_origin',
-        required=True,
+        required=False,
         type=str,
-        help='Bucket with output files',
+        help='Bucket with output files. Required without -u/--cromwell_server',
     )
     parser.add_argument(
         '-r',
         '--results_folder',
-        required=True,
+        required=False,
         type=str,
-        help='Path to the results folder',
+        help='Path to the results folder. Required without -u/--cromwell_server',
+    )
+    parser.add_argument(
+        '-u',
+        '--cromwell_server',
+        required=False,
+        type=str,
+        help='Optional: load the metadata from the Cromwell/Caper server running the '
+        'workflows (e.g. http://localhost:8000) instead of the metadata.json files, '
+        'including the running workflows. Only the metadata keys used by the reports '
+        'are requested. With -a, the workflows are listed from the server',
     )
     parser.add_argument(
         '-i',
         '--caper_job_id',
-        required=True,
+        required=False,
+        nargs='+',
+        type=str,
+        help='Caper job id(s) (E.g.: 9c6ff6fe-ce7d-4d23-ac18-9935614d6f9b)',
+    )
+    parser.add_argument(
+        '-a',
+        '--all_jobs',
+        action='store_true',
+        help='Summarize all the jobs found in the results folder '
+        '(instead of -i CAPER_JOB_ID)',
+    )
+    parser.add_argument(
+        '-o',
+        '--output',
+        required=False,
         type=str,
-        help='Caper job id (E.g.: 9c6ff6fe-ce7d-4d23-ac18-9935614d6f9b)',
+        help='Optional: export the per-task statistics to a .csv or .json file',
+    )
+    parser.add_argument(
+        '-w',
+        '--workers',
+        required=False,
+        type=int,
+        default=16,
+        help='Number of metadata files downloaded concurrently. Default: 16',
     )
+    parser.add_argument(
+        '-c',
+        '--critical_path',
+        action='store_true',
+        help='Print the critical path, straggler shards and the time breakdown '
+        '(queued, docker pull, localization, run, delocalization) of every task',
+    )
+    parser.add_argument(
+        '-s',
+        '--straggler_factor',
+        required=False,
+        type=float,
+        default=2.0,
+        help='Shards taking longer than this times the median duration of the task '
+        'are reported as stragglers. Default: 2.0',
+    )
+    parser.add_argument(
+        '-e',
+        '--preemption',
+        action='store_true',
+        help='Print the compute lost to preempted and retried attempts of every task, '
+        'and the preemptible setting that minimizes its expected cost',
+    )
+    parser.add_argument(
+        '-t',
+        '--trace',
+        required=False,
+        type=str,
+        help='Optional: export the timeline of the jobs to a Chrome trace-event '
+        'JSON file (open it with chrome://tracing or https://ui.perfetto.dev)',
+    )
+    parser.add_argument(
+        '-x',
+        '--index',
+        required=False,
+        type=str,
+        help='Optional: SQLite metadata index (see metadata_index.py). Only the '
+        'metadata.json files not indexed yet (or rewritten) are downloaded, and the '
+        'summary and per-task statistics are queried from the index',
+    )
+    profiling.add_argument(parser)
     return parser
 
 
-def main():
-    parser = arg_parser()
-    args = parser.parse_args()
+def discover_job_ids(storage_client, bucket_origin, results_folder):
+    """
+    Lists the caper job ids (sub-folders) of a results folder
+
+    :param storage_client: The storage client
+    :param bucket_origin: Bucket with output files
+    :param results_folder: Path to the results folder
+    :return: The caper job ids
+    :rtype: list[str]
+    """
+    blobs = storage_client.list_blobs(
+        bucket_origin, prefix=f'{results_folder}/', delimiter='/'
+    )
+    # consume the iterator to populate the prefixes
+    for _ in blobs:
+        pass
+    job_ids = []
+    for prefix in sorted(blobs.prefixes):
+        m = re.match(rf'{re.escape(results_folder)}/([^/]+)/$', prefix)
+        if m:
+            job_ids.append(m[1])
+    return job_ids
 
-    project_name = args.project.rstrip('/')
-    print('\nGCP project:', project_name)
 
-    bucket_origin = args.bucket_origin.rstrip('/')
-    print('Bucket origin:', bucket_origin)
+def load_metadata(bucket, results_folder, caper_job_id):
+    """
+    Downloads the metadata.json file of a job
 
-    results_folder = args.results_folder.rstrip('/')
-    print('Results folder:', results_folder)
+    :param bucket: Bucket with output files
+    :param results_folder: Path to the results folder
+    :param caper_job_id: The caper job id
+    :return: The loaded metadata.json object, None if not found
+    :rtype: dict | None
+    """
+    blob = bucket.get_blob(f"{results_folder}/{caper_job_id}/metadata.json")
+    if blob is None:
+        return None
+    return load_json_blob(blob)
 
-    caper_job_id = args.caper_job_id
-    print('Caper Job ID:', caper_job_id)
 
-    storage_client = storage.Client(project_name)
-    blob = storage_client.bucket(bucket_origin).blob(f"{results_folder}/{caper_job_id}/metadata.json")
+def load_server_metadata(server, caper_job_id, full_metadata):
+    """
+    Queries the metadata of a job from a Cromwell server, filtered to the keys read
+    by the summary and statistics (or by all the reports)
 
-    if blob.exists():
-        metadata = json.loads(blob.download_as_string().decode('utf-8'))
+    :param server: The URL of the server
+    :param caper_job_id: The caper job (workflow) id
+    :param full_metadata: Whether to request the keys of the critical path,
+        preemption and timeline reports too
+    :return: The metadata object, None if the workflow is not found
+    :rtype: dict | None
+    """
+    if full_metadata:
+        source = CromwellMetadataSource(
+            server, caper_job_id, exclude_keys=UNUSED_METADATA_KEYS
+        )
+    else:
+        source = CromwellMetadataSource(
+            server, caper_job_id, include_keys=SUMMARY_METADATA_KEYS
+        )
+    try:
+        return source.load()
+    except FileNotFoundError:
+        return None
+
+
+def load_indexed_metadata(index, bucket, results_folder, caper_job_ids, workers,
+                          full_metadata):
+    """
+    Indexes the metadata.json files of the jobs that are not indexed yet, or were
+    rewritten since they were indexed
+
+    :param index: The MetadataIndex
+    :param bucket: Bucket with output files
+    :param results_folder: Path to the results folder
+    :param caper_job_ids: The caper job ids
+    :param workers: Number of metadata files downloaded concurrently
+    :param full_metadata: Whether to also load the full metadata.json objects (for
+        the critical path, preemption and timeline reports)
+    :return: The workflow-level metadata of every job from the index (None if not
+        found) and its workflow id, and the metadata.json objects (None if not
+        full_metadata)
+    :rtype: tuple[list[dict | None], list[str | None], list[dict | None]]
+    """
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        blobs = list(pool.map(
+            lambda x: bucket.get_blob(f'{results_folder}/{x}/metadata.json'),
+            caper_job_ids,
+        ))
+        sources = [None if b is None else f'gs://{bucket.name}/{b.name}' for b in blobs]
+        workflow_ids = [
+            None if b is None else index.find(source, b.generation)
+            for b, source in zip(blobs, sources)
+        ]
+        # download only what has to be indexed (or is needed as a whole)
+        all_metadata = list(pool.map(
+            lambda x: load_json_blob(x[0]) if x[0] is not None and (
+                x[1] is None or full_metadata) else None,
+            zip(blobs, workflow_ids),
+        ))
+
+    for i, (blob, source, metadata) in enumerate(zip(blobs, sources, all_metadata)):
+        if blob is not None and workflow_ids[i] is None:
+            workflow_ids[i] = index.add(metadata, source, blob.generation)
+            print(f'+ Indexed {workflow_ids[i]}')
+    workflows = [None if x is None else index.workflow(x) for x in workflow_ids]
+    return workflows, workflow_ids, all_metadata if full_metadata else None
+
+
+def print_job_summary(caper_job_id, metadata):
+    """
+    Prints the running time and errors of a job
+
+    :param caper_job_id: The caper job id
+    :param metadata: The loaded metadata.json object
+    """
+    print(f'\n+ Caper Job ID: {caper_job_id} ({metadata.get("workflowName")}: '
+          f'{metadata.get("status")})')
+    if metadata.get('start') and metadata.get('end'):
         start_time = dateparser.parse(metadata['start'])
         end_time = dateparser.parse(metadata['end'])
         print(f'Pipeline Running Time: {end_time - start_time}')
-    else:
-        print('\nMetadata file not found!!!\n')
-        return
 
     if 'failures' in metadata and metadata['failures']:
         failures_length = len(metadata['failures'])
         print(f'PIPELINE ERRORS ({failures_length})')
         for i, failure in enumerate(metadata['failures']):
-            causeby_len = len(failure['causedBy'])
             for j, causedBy in enumerate(failure['causedBy']):
                 output = causedBy['message']
                 print(f'\t- MESSAGE {j+1}: {output}')
     else:
         print('+ No errors found')
 
+
+def print_statistics(stats):
+    """
+    Prints the per-task statistics as a table, tasks sorted by CPU hours
+
+    :param stats: The per-task statistics
+    """
+    rows = sorted(stats.values(), key=lambda x: x['cpu_hours'], reverse=True)
+    width = max([len(x['task']) for x in rows] + [4])
+    print(f'\nPER-TASK STATISTICS ({len(rows)} tasks)')
+    print(f'{"task":<{width}}  shards  attempts  preempted  failed  '
+          f'wall_h  mean_h  max_h  queued_h  cpu_h')
+    for row in rows:
+        print(f'{row["task"]:<{width}}  {row["shards"]:>6}  {row["attempts"]:>8}  '
+              f'{row["preemptions"]:>9}  {row["failed_attempts"]:>6}  '
+              f'{row["wall_hours"]:>6.1f}  {row["mean_wall_hours"]:>6.2f}  '
+              f'{row["max_wall_hours"]:>5.2f}  {row["queued_hours"]:>8.1f}  '
+              f'{row["cpu_hours"]:>5.1f}')
+    total = sum(x['cpu_hours'] for x in rows)
+    print(f'Total CPU hours: {total:.1f}')
+
+
+def print_critical_path(metadata, straggler_factor):
+    """
+    Prints the critical path and the straggler shards of a job
+
+    :param metadata: The loaded metadata.json object
+    :param straggler_factor: Straggler threshold, as a multiple of the median duration
+    """
+    path = critical_path(metadata)
+    if path:
+        total = path[-1]['end_hours']
+        print(f'\nCRITICAL PATH ({metadata.get("id")}: {total:.2f} hours)')
+        print('task                        shard  start_h  wait_h  duration_h  attempts')
+        for step in path:
+            print(f'{step["task"]:<26}  {step["shard"]:>6}  {step["start_hours"]:>7.2f}  '
+                  f'{step["wait_hours"]:>6.2f}  {step["duration_hours"]:>10.2f}  '
+                  f'{step["attempts"]:>8}')
+        waiting = sum(x['wait_hours'] for x in path)
+        print(f'Time waiting between calls of the critical path: {waiting:.2f} hours')
+
+    slow = stragglers(metadata, straggler_factor)
+    if slow:
+        print(f'\nSTRAGGLERS (>{straggler_factor}x the median duration of the task)')
+        for x in slow:
+            print(f'\t- {x["task"]} shard {x["shard"]}: {x["duration_hours"]:.2f} hours '
+                  f'({x["ratio"]:.1f}x the median of {x["median_hours"]:.2f} hours)')
+    else:
+        print('+ No stragglers found')
+
+
+def print_breakdown(breakdown):
+    """
+    Prints the time breakdown of every task, tasks sorted by total hours
+
+    :param breakdown: The per-task time breakdown (hours per category)
+    """
+    rows = sorted(breakdown.items(), key=lambda x: sum(x[1].values()), reverse=True)
+    width = max([len(x[0]) for x in rows] + [4])
+    print('\nTIME BREAKDOWN (hours, all attempts)')
+    print(f'{"task":<{width}}  ' + '  '.join(BREAKDOWN_COLUMNS))
+    for task, hours in rows:
+        print(f'{task:<{width}}  '
+              + '  '.join(f'{hours[x]:>{len(x)}.2f}' for x in BREAKDOWN_COLUMNS))
+
+
+def print_preemption(waste):
+    """
+    Prints the compute lost to preempted and retried attempts and the recommended
+    preemptible setting of every task, tasks sorted by lost cost
+
+    :param waste: The per-task preemption waste statistics
+    """
+    rows = sorted(waste.values(), key=lambda x: x['lost_cost'], reverse=True)
+    width = max([len(x['task']) for x in rows] + [4])
+    print('\nPREEMPTION AND RETRY WASTE')
+    print(f'{"task":<{width}}  preempted  lost_h  lost_cpu_h  retried_h  lost_usd  '
+          f'rate/h  preemptible  recommended  expected_usd  expected_h')
+    for task in rows:
+        advice = recommend_preemptible(task)
+        print(f'{task["task"]:<{width}}  {task["preemptions"]:>9}  '
+              f'{task["preempted_hours"]:>6.2f}  {task["preempted_cpu_hours"]:>10.2f}  '
+              f'{task["retried_hours"]:>9.2f}  {task["lost_cost"]:>8.2f}  '
+              f'{advice["rate"]:>6.3f}  {advice["current"]:>11}  '
+              f'{advice["recommended"]:>11}  '
+              f'{advice["current_cost"]:>5.2f}->{advice["recommended_cost"]:<5.2f}  '
+              f'{advice["current_wall_hours"]:>4.1f}->{advice["recommended_wall_hours"]:<4.1f}')
+    lost_hours = sum(x['preempted_hours'] + x['retried_hours'] for x in rows)
+    lost_cost = sum(x['lost_cost'] for x in rows)
+    print(f'Total VM hours lost: {lost_hours:.1f} (${lost_cost:.2f})')
+    print('Expected cost and wall time are per call (one shard), with the current and '
+          'the recommended preemptible setting')
+
+
+def export_statistics(stats, output):
+    """
+    Exports the per-task statistics to a CSV or JSON file
+
+    :param stats: The per-task statistics
+    :param output: The output file name (.csv or .json)
+    """
+    rows = [
+        {k: round(v, 4) if isinstance(v, float) else v for k, v in row.items()}
+        for row in sorted(stats.values(), key=lambda x: x['cpu_hours'], reverse=True)
+    ]
+    if output.endswith('.json'):
+        with open(output, 'w', encoding='utf-8') as outfile:
+            json.dump(rows, outfile, indent=4)
+    else:
+        with open(output, 'w', encoding='utf-8', newline='') as outfile:
+            writer = csv.DictWriter(outfile, fieldnames=STATISTICS_COLUMNS)
+            writer.writeheader()
+            writer.writerows(rows)
+    print(f'+ Per-task statistics exported to {output}')
+
+
+def main():
+    parser = arg_parser()
+    args = parser.parse_args()
+    profiling.start(args.profile)
+    if not args.caper_job_id and not args.all_jobs:
+        parser.error('one of the arguments -i/--caper_job_id -a/--all_jobs is required')
+    server = args.cromwell_server
+    if server is None and (args.bucket_origin is None or args.results_folder is None):
+        parser.error('-b/--bucket_origin and -r/--results_folder are required without '
+                     '-u/--cromwell_server')
+    if server is not None and args.index is not None:
+        parser.error('-x/--index indexes the metadata.json files, it cannot be used '
+                     'with -u/--cromwell_server')
+
+    project_name = args.project.rstrip('/')
+    print('\nGCP project:', project_name)
+
+    if server is not None:
+        server = server.rstrip('/')
+        print('Cromwell server:', server)
+        with profiling.span('listing'):
+            caper_job_ids = args.caper_job_id or [
+                x['id'] for x in query_workflows(server)
+            ]
+    else:
+        bucket_origin = args.bucket_origin.rstrip('/')
+        print('Bucket origin:', bucket_origin)
+
+        results_folder = args.results_folder.rstrip('/')
+        print('Results folder:', results_folder)
+
+        storage_client = get_storage_client(project_name, args.workers)
+        bucket = storage_client.bucket(bucket_origin)
+
+        with profiling.span('listing'):
+            caper_job_ids = args.caper_job_id or discover_job_ids(
+                storage_client, bucket_origin, results_folder
+            )
+    print('Caper Job IDs:', len(caper_job_ids))
+
+    full_metadata = args.critical_path or args.preemption or args.trace is not None
+    with profiling.span('metadata load'):
+        if server is not None:
+            with ThreadPoolExecutor(max_workers=args.workers) as pool:
+                all_metadata = list(pool.map(
+                    lambda x: load_server_metadata(server, x, full_metadata),
+                    caper_job_ids,
+                ))
+            workflows = all_metadata
+        elif args.index is not None:
+            index = MetadataIndex(args.index)
+            workflows, workflow_ids, all_metadata = load_indexed_metadata(
+                index, bucket, results_folder, caper_job_ids, args.workers, full_metadata
+            )
+        else:
+            with ThreadPoolExecutor(max_workers=args.workers) as pool:
+                all_metadata = list(pool.map(
+                    lambda x: load_metadata(bucket, results_folder, x), caper_job_ids
+                ))
+            workflows = all_metadata
+
+    found = []
+    for i, (caper_job_id, metadata) in enumerate(zip(caper_job_ids, workflows)):
+        if metadata is None:
+            print(f'\nMetadata file not found for {caper_job_id}!!!')
+            continue
+        print_job_summary(caper_job_id, metadata)
+        found.append(i)
+
+    if not found:
+        return
+
+    with profiling.span('statistics'):
+        if args.index is not None:
+            stats = index.task_statistics([workflow_ids[i] for i in found])
+        else:
+            stats = task_statistics([all_metadata[i] for i in found])
+    print_statistics(stats)
+    if args.output is not None:
+        export_statistics(stats, args.output)
+
+    if not full_metadata:
+        return
+    found = [all_metadata[i] for i in found]
+
+    if args.critical_path:
+        with profiling.span('critical path'):
+            for metadata in found:
+                print_critical_path(metadata, args.straggler_factor)
+            print_breakdown(task_breakdown(found))
+
+    if args.preemption:
+        with profiling.span('preemption'):
+            print_preemption(preemption_waste(found))
+
+    if args.trace is not None:
+        with profiling.span('trace'), open(args.trace, 'w', encoding='utf-8') as outfile:
+            json.dump(chrome_trace(found), outfile)
+        print(f'+ Timeline exported to {args.trace}')
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,157 @@
+"""
+Compute lost to preempted (and otherwise retried) call attempts, and the preemptible
+setting that minimizes the expected cost of every task.
+
+Cromwell runs the first ``preemptible`` attempts of a task on preemptible VMs and
+falls back to an on-demand VM after that many preemptions. Preemptions are modelled
+as a Poisson process: with the rate ``lambda`` observed for the task (preemptions per
+hour spent on preemptible VMs), an attempt of ``T`` hours is preempted with
+probability ``q = 1 - exp(-lambda * T)``, after ``1/lambda - T * (1 - q) / q`` hours
+on average. The expected cost of ``k`` preemptible attempts is then
+
+    sum(q^i for i < k) * ((1 - q) * T + q * lost) * preemptible_price
+    + q^k * T * on_demand_price
+
+GCE stops preemptible VMs after MAX_PREEMPTIBLE_HOURS, so longer tasks are always
+preempted.
+"""
+
+import math
+
+from cromwell_metadata import (
+    attempt_cost,
+    attempt_shape,
+    is_preempted,
+    iter_call_attempts,
+    wall_seconds,
+)
+
+MAX_PREEMPTIBLE_HOURS = 24
+MAX_PREEMPTIBLE_TRIES = 3
+
+
+def preemption_waste(metadata_list: list[dict]) -> dict[str, dict]:
+    """
+    Per task compute lost to preempted and other retried attempts, across one or many
+    workflow runs.
+
+    :param metadata_list: The workflow metadata.json objects
+    :return: Mapping of task name to a dict with the number of attempts, preemptible
+        hours (exposure), preemptions, preempted and retried VM/CPU hours, lost cost,
+        mean hours of the successful attempts, the shape and the current preemptible
+        setting
+    """
+    waste = {}
+    for metadata in metadata_list:
+        for name, attempt in iter_call_attempts(metadata):
+            task = waste.setdefault(
+                name,
+                {
+                    "task": name,
+                    "attempts": 0,
+                    "preemptible_hours": 0.0,
+                    "preemptions": 0,
+                    "preempted_hours": 0.0,
+                    "preempted_cpu_hours": 0.0,
+                    "retried_hours": 0.0,
+                    "lost_cost": 0.0,
+                    "done_hours": [],
+                    "shape": None,
+                    "preemptible": 0,
+                },
+            )
+            shape = attempt_shape(attempt)
+            hours = wall_seconds(attempt) / 3600
+            task["attempts"] += 1
+            task["shape"] = shape
+            task["preemptible"] = max(
+                task["preemptible"],
+                int(attempt.get("runtimeAttributes", {}).get("preemptible", 0)),
+            )
+            if shape["preemptible"]:
+                task["preemptible_hours"] += hours
+            if is_preempted(attempt):
+                task["preemptions"] += 1
+                task["preempted_hours"] += hours
+                task["preempted_cpu_hours"] += hours * shape["ncpu"]
+                task["lost_cost"] += attempt_cost(shape, hours, shape["preemptible"])
+            elif attempt.get("executionStatus") == "RetryableFailure":
+                task["retried_hours"] += hours
+                task["lost_cost"] += attempt_cost(shape, hours, shape["preemptible"])
+            elif attempt.get("executionStatus") == "Done":
+                task["done_hours"].append(hours)
+    return waste
+
+
+def expected_cost(
+    shape: dict, hours: float, rate: float, tries: int
+) -> tuple[float, float]:
+    """
+    Expected cost and wall time of a task run with a preemptible setting.
+
+    :param shape: The shape of the task (ncpu, ramGB, disk)
+    :param hours: The wall time of an attempt that is not preempted
+    :param rate: The preemption rate (preemptions per preemptible hour)
+    :param tries: The preemptible setting (number of preemptible attempts)
+    :return: The expected cost (USD) and wall time (hours)
+    """
+    if hours >= MAX_PREEMPTIBLE_HOURS:
+        q, lost = 1.0, float(MAX_PREEMPTIBLE_HOURS)
+    elif rate <= 0:
+        q, lost = 0.0, 0.0
+    else:
+        q = 1 - math.exp(-rate * hours)
+        lost = 1 / rate - hours * (1 - q) / q if q > 0 else 0.0
+
+    per_try_hours = (1 - q) * hours + q * lost
+    preemptible_cost = attempt_cost(shape, per_try_hours, True)
+    reach = 1.0
+    cost = wall = 0.0
+    for _ in range(tries):
+        cost += reach * preemptible_cost
+        wall += reach * per_try_hours
+        reach *= q
+    cost += reach * attempt_cost(shape, hours, False)
+    wall += reach * hours
+    return cost, wall
+
+
+def recommend_preemptible(task: dict) -> dict:
+    """
+    Preemptible setting minimizing the expected cost of a task.
+
+    :param task: The task waste statistics (see preemption_waste)
+    :return: A dict with the preemption rate, the attempt hours, and the recommended
+        and current settings with their expected cost and wall time
+    """
+    rate = 0.0
+    if task["preemptible_hours"]:
+        rate = task["preemptions"] / task["preemptible_hours"]
+    hours = (
+        sum(task["done_hours"]) / len(task["done_hours"])
+        if task["done_hours"]
+        else task["preempted_hours"] / max(task["preemptions"], 1)
+    )
+    options = {
+        tries: expected_cost(task["shape"], hours, rate, tries)
+        for tries in range(MAX_PREEMPTIBLE_TRIES + 1)
+    }
+    # on ties, keep the current setting
+    best = min(
+        options,
+        key=lambda x: (options[x][0], options[x][1], x != task["preemptible"]),
+    )
+    current_cost, current_wall = expected_cost(
+        task["shape"], hours, rate, task["preemptible"]
+    )
+    return {
+        "task": task["task"],
+        "rate": rate,
+        "hours": hours,
+        "current": task["preemptible"],
+        "current_cost": current_cost,
+        "current_wall_hours": current_wall,
+        "recommended": best,
+        "recommended_cost": options[best][0],
+        "recommended_wall_hours": options[best][1],
+    }
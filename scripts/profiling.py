@@ -0,0 +1,262 @@
+"""
+Profiling of the scripts (--profile PREFIX).
+
+When enabled, a script records:
+
+- a CPU profile of its main thread (cProfile), saved as PREFIX.prof (open it with
+  snakeviz or pstats),
+- wall-clock samples of the stacks of all its threads every SAMPLE_SECONDS, saved as
+  folded stacks in PREFIX.folded (flamegraph.pl, speedscope or
+  https://www.speedscope.app), so the time spent waiting for GCS in the copy threads
+  shows up too,
+- the wall time and peak memory (tracemalloc) of its major phases (spans),
+
+and writes a report of them to PREFIX.txt when it exits.
+
+The scripts mark their phases with ``with profiling.span("metadata load"):``. When
+profiling is disabled (the default), span returns a shared no-op context manager and
+nothing else runs.
+"""
+
+import atexit
+import cProfile
+import io
+import pstats
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from pathlib import Path
+
+SAMPLE_SECONDS = 0.01
+TOP_FUNCTIONS = 40
+TOP_FRAMES = 25
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+_profiler: "Profiler | None" = None
+
+
+class _Span:
+    def __init__(self, profiler: "Profiler", name: str) -> None:
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler.open_span()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        peak = tracemalloc.get_traced_memory()[1]
+        self.profiler.close_span()
+        self.profiler.record_span(self.name, seconds, peak)
+        return False
+
+
+def span(name: str):
+    """
+    Context manager timing a phase of a script (no-op unless profiling).
+
+    :param name: The phase name (e.g. metadata load, listing, planning, copying)
+    """
+    if _profiler is None:
+        return _NULL_SPAN
+    return _Span(_profiler, name)
+
+
+def _thread_group(name: str) -> str:
+    # ThreadPoolExecutor-0_12 -> ThreadPoolExecutor-0
+    return re.sub(r"_\d+$", "", name)
+
+
+def _frame_name(code) -> str:
+    return f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})"
+
+
+class Profiler:
+    """
+    CPU profile, wall-clock stack samples and spans of a script run.
+    """
+
+    def __init__(self, prefix: str, sample_seconds: float = SAMPLE_SECONDS) -> None:
+        """
+        :param prefix: The prefix of the output files (PREFIX.txt, .prof and .folded)
+        :param sample_seconds: The interval between two stack samples
+        """
+        self.prefix = prefix
+        self.sample_seconds = sample_seconds
+        self.spans: dict[str, dict] = {}
+        self.samples: Counter = Counter()
+        self.n_samples = 0
+        self._lock = threading.Lock()
+        self._open_spans = 0
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, name="profiler", daemon=True)
+        self._profile = cProfile.Profile()
+
+    def open_span(self) -> None:
+        """
+        Count a span opened in any thread. The tracemalloc peak is process-wide: it is
+        reset only when no other span is open, so a span opened inside (or during)
+        another one reports the peak since the start of the oldest open span.
+        """
+        with self._lock:
+            if self._open_spans == 0:
+                tracemalloc.reset_peak()
+            self._open_spans += 1
+
+    def close_span(self) -> None:
+        """Count a span closed in any thread."""
+        with self._lock:
+            self._open_spans -= 1
+
+    def record_span(self, name: str, seconds: float, peak: int) -> None:
+        """
+        Add a span to the totals of its name.
+
+        :param name: The span name
+        :param seconds: The wall time of the span
+        :param peak: The peak traced memory during the span, in bytes
+        """
+        with self._lock:
+            totals = self.spans.setdefault(
+                name, {"calls": 0, "seconds": 0.0, "max_seconds": 0.0, "peak": 0}
+            )
+            totals["calls"] += 1
+            totals["seconds"] += seconds
+            totals["max_seconds"] = max(totals["max_seconds"], seconds)
+            totals["peak"] = max(totals["peak"], peak)
+
+    def _sample(self) -> None:
+        own = threading.get_ident()
+        while not self._stop.wait(self.sample_seconds):
+            names = {x.ident: x.name for x in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame.f_code))
+                    frame = frame.f_back
+                stack.append(_thread_group(names.get(ident, str(ident))))
+                self.samples[";".join(reversed(stack))] += 1
+            self.n_samples += 1
+
+    def start(self) -> None:
+        """Start tracing memory, the CPU profile and the stack sampler."""
+        tracemalloc.start()
+        self._wall_start = time.perf_counter()
+        self._cpu_start = time.process_time()
+        self._sampler.start()
+        self._profile.enable()
+
+    def stop(self) -> None:
+        """Stop profiling and write the report, CPU profile and folded stacks."""
+        self._profile.disable()
+        self._stop.set()
+        self._sampler.join()
+        wall = time.perf_counter() - self._wall_start
+        cpu = time.process_time() - self._cpu_start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        Path(self.prefix).parent.mkdir(parents=True, exist_ok=True)
+        self._profile.dump_stats(f"{self.prefix}.prof")
+        with open(f"{self.prefix}.folded", "w", encoding="utf-8") as outfile:
+            for stack, count in self.samples.most_common():
+                outfile.write(f"{stack} {count}\n")
+        with open(f"{self.prefix}.txt", "w", encoding="utf-8") as outfile:
+            outfile.write(self.report(wall, cpu, peak))
+        print(f"+ Profile written to {self.prefix}.txt, .prof and .folded", file=sys.stderr)
+
+    def report(self, wall: float, cpu: float, peak: int) -> str:
+        """
+        The text report of the run.
+
+        :param wall: The wall time in seconds
+        :param cpu: The CPU time of the process in seconds
+        :param peak: The peak traced memory in bytes
+        :return: The report
+        """
+        out = io.StringIO()
+        out.write(f"PROFILE: {' '.join(sys.argv)}\n")
+        out.write(
+            f"Wall time: {wall:.2f} s, CPU time: {cpu:.2f} s, "
+            f"peak traced memory: {peak / 1024**2:.1f} MB, "
+            f"stack samples: {self.n_samples} (every {self.sample_seconds * 1000:.0f} ms)\n"
+        )
+
+        out.write("\nSPANS (wall time and peak traced memory of the phases)\n")
+        width = max([len(x) for x in self.spans] + [4])
+        out.write(f"{'span':<{width}}  calls  total_s  share    max_s  peak_MB\n")
+        for name, x in sorted(self.spans.items(), key=lambda x: -x[1]["seconds"]):
+            out.write(
+                f"{name:<{width}}  {x['calls']:>5}  {x['seconds']:>7.2f}  "
+                f"{x['seconds'] / max(wall, 1e-9):>5.1%}  {x['max_seconds']:>7.2f}  "
+                f"{x['peak'] / 1024**2:>7.1f}\n"
+            )
+
+        out.write("\nHOTTEST FRAMES (all threads, share of the wall-clock samples)\n")
+        frames = Counter()
+        for stack, count in self.samples.items():
+            frames[stack.rsplit(";", 1)[-1]] += count
+        total = max(sum(frames.values()), 1)
+        for frame, count in frames.most_common(TOP_FRAMES):
+            out.write(f"{count / total:>6.1%}  {frame}\n")
+
+        out.write(f"\nTOP {TOP_FUNCTIONS} FUNCTIONS (main thread CPU profile)\n")
+        stats = pstats.Stats(self._profile, stream=out)
+        stats.sort_stats("cumulative").print_stats(TOP_FUNCTIONS)
+        return out.getvalue()
+
+
+def start(prefix: str | None) -> None:
+    """
+    Start profiling the script until it exits, if a prefix is given.
+
+    :param prefix: The prefix of the output files, or None to leave profiling off
+    """
+    global _profiler
+    if prefix is None or _profiler is not None:
+        return
+    _profiler = Profiler(prefix)
+    _profiler.start()
+    atexit.register(stop)
+
+
+def stop() -> None:
+    """Stop profiling (if running) and write its outputs."""
+    global _profiler
+    if _profiler is None:
+        return
+    profiler, _profiler = _profiler, None
+    profiler.stop()
+
+
+def add_argument(parser) -> None:
+    """
+    Add the --profile option to the argument parser of a script.
+
+    :param parser: The argparse.ArgumentParser
+    """
+    parser.add_argument(
+        "--profile",
+        required=False,
+        type=str,
+        metavar="PREFIX",
+        help="Optional: profile the script and write PREFIX.txt (report: phases, "
+        "peak memory, hottest functions), PREFIX.prof (cProfile) and PREFIX.folded "
+        "(flamegraph stacks)",
+    )
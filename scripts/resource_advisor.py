@@ -0,0 +1,397 @@
+"""
+Recommends right-sized VM shapes (ncpu, ramGB, disk) for the MSGF+ pipeline tasks
+from the history of past runs, and writes updated msgfplus templates.
+
+For every task of the past runs (metadata.json files), the advisor collects the
+requested shapes, the wall time of every attempt and the attempts that failed because
+the task ran out of memory or out of disk. Tasks share their resources through the
+template key prefixes (e.g. msconvert_ncpu is used by msconvert, msconvert_mzrefiner,
+ppm_errorcharter and mzidtotsvconverter), so the recommendation is made per prefix:
+
+- ramGB: increased by RAM_STEP when attempts ran out of memory (the MS-GF+ Java heap
+  follows msgf_ramGB, see msgf_heap_headroom_mb in the workflow).
+- ncpu: single threaded tools get the fewest CPUs that the RAM can be attached to
+  (GCE custom machine types allow up to MAX_GB_PER_CPU GB per CPU).
+- disk: doubled when attempts ran out of disk.
+
+The cost of the past attempts is estimated with the current and the recommended
+shapes (failed attempts that the new shape would prevent are not counted).
+"""
+
+import argparse
+import json
+import math
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from pydantic import ValidationError
+
+from cromwell_metadata import (
+    DEFAULT_DISK_GB,
+    attempt_cost,
+    attempt_shape,
+    iter_call_attempts,
+    wall_seconds,
+)
+from gcs_client import get_storage_client
+from parameter_mapping_generator import (
+    TEMPLATE_DIR,
+    DockerImages,
+    RawInputsFile,
+    parse_inputs_file,
+)
+from pipeline_job_summary import discover_job_ids, load_metadata
+import profiling
+
+
+warnings.filterwarnings(
+    "ignore", "Your application has authenticated using end user credentials"
+)
+
+WF_PREFIX = "proteomics_msgfplus."
+
+# Template key prefix of the resources of every task
+TASK_PREFIXES = {
+    "masic": "masic_",
+    "msconvert": "msconvert_",
+    "msconvert_mzrefiner": "msconvert_",
+    "ppm_errorcharter": "msconvert_",
+    "mzidtotsvconverter": "msconvert_",
+    "mzml_split": "msconvert_",
+    "mzid_merge": "msconvert_",
+    "msgf_sequences": "msgf_",
+    "msgf_tryptic": "msgf_",
+    "msgf_identification": "msgf_",
+    "msgf_identification_chunk": "msgf_",
+    "msgf_fused_search": "msgf_",
+    "phrp": "phrp_",
+    "ascore": "ascore_",
+    "wrapper_pp": "wrapper_",
+}
+
+# Prefixes of the tasks running multi-threaded tools
+MULTI_THREADED = {"msgf_", "wrapper_"}
+
+RAM_STEP = 1.5
+MAX_GB_PER_CPU = 6.5
+
+OOM_MESSAGES = (
+    "outofmemoryerror",
+    "out of memory",
+    "oom-kill",
+    "exit code 137",
+    "cannot allocate memory",
+)
+DISK_MESSAGES = ("no space left on device", "disk quota exceeded", "not enough space")
+
+
+def failure_reason(attempt: dict) -> str | None:
+    """
+    Whether a call attempt failed because it ran out of memory or out of disk.
+
+    :param attempt: The call attempt metadata object
+    :return: "oom", "disk" or None
+    """
+    messages = []
+    stack = list(attempt.get("failures", []))
+    while stack:
+        failure = stack.pop()
+        messages.append(failure.get("message", "").lower())
+        stack.extend(failure.get("causedBy", []))
+    text = " ".join(messages)
+    if any(x in text for x in OOM_MESSAGES):
+        return "oom"
+    if any(x in text for x in DISK_MESSAGES):
+        return "disk"
+    return None
+
+
+def match_template(
+    metadata: dict, templates: dict[tuple[str, str], RawInputsFile]
+) -> tuple[str, str] | None:
+    """
+    Template (experiment, quantification method) a run was configured from, matched
+    by the names of its parameter files.
+
+    :param metadata: The workflow metadata.json object
+    :param templates: The validated templates
+    :return: The (experiment, quantification method) key, or None if none matches
+    """
+    inputs = {
+        k.removeprefix(WF_PREFIX): v
+        for k, v in metadata.get("inputs", {}).items()
+        if isinstance(v, str)
+    }
+    for key, template in templates.items():
+        parameters = template.model_dump(exclude_none=True)
+        if parameters and all(
+            Path(inputs.get(field, "")).name == Path(value).name
+            for field, value in parameters.items()
+        ):
+            return key
+    return None
+
+
+def collect_usage(metadata_list: list[dict]) -> dict[str, dict]:
+    """
+    Per template prefix usage of the past runs: attempts, hours, failures and the
+    attempts themselves (shape, hours, failure reason).
+
+    :param metadata_list: The workflow metadata.json objects
+    :return: Mapping of template prefix to its usage
+    """
+    usage = {}
+    for metadata in metadata_list:
+        for name, attempt in iter_call_attempts(metadata):
+            prefix = TASK_PREFIXES.get(name)
+            if prefix is None:
+                continue
+            entry = usage.setdefault(
+                prefix,
+                {"attempts": [], "oom": 0, "disk": 0, "hours": 0.0, "max_hours": 0.0},
+            )
+            hours = wall_seconds(attempt) / 3600
+            reason = failure_reason(attempt)
+            if reason is not None:
+                entry[reason] += 1
+            entry["hours"] += hours
+            entry["max_hours"] = max(entry["max_hours"], hours)
+            entry["attempts"].append(
+                {"shape": attempt_shape(attempt), "hours": hours, "reason": reason}
+            )
+    return usage
+
+
+def recommend(prefix: str, current: dict, usage: dict) -> dict:
+    """
+    Recommended shape of a template prefix.
+
+    :param prefix: The template key prefix (e.g. msgf_)
+    :param current: The current shape (ncpu, ramGB, disk) in the template
+    :param usage: The usage of the prefix in the past runs
+    :return: The recommended shape (ncpu, ramGB, disk)
+    """
+    ram = current["ramGB"]
+    if usage["oom"]:
+        requested = max(a["shape"]["ramGB"] for a in usage["attempts"])
+        ram = math.ceil(max(ram, requested) * RAM_STEP)
+
+    ncpu = current["ncpu"]
+    if prefix not in MULTI_THREADED:
+        ncpu = max(1, math.ceil(ram / MAX_GB_PER_CPU))
+
+    disk = current["disk"]
+    if usage["disk"]:
+        disk = 2 * max([disk] + [a["shape"]["disk"] for a in usage["attempts"]])
+
+    return {"ncpu": ncpu, "ramGB": ram, "disk": disk}
+
+
+def estimate_cost(usage: dict, shape: dict | None = None) -> float:
+    """
+    Cost of the past attempts of a template prefix, with the shapes they requested or
+    with a recommended shape. Attempts that failed for a reason the recommended shape
+    fixes are not counted.
+
+    :param usage: The usage of the prefix in the past runs
+    :param shape: Optional recommended shape
+    :return: The cost in USD
+    """
+    cost = 0.0
+    for attempt in usage["attempts"]:
+        preemptible = attempt["shape"]["preemptible"]
+        if shape is None:
+            cost += attempt_cost(attempt["shape"], attempt["hours"], preemptible)
+            continue
+        if attempt["reason"] == "oom" and shape["ramGB"] > attempt["shape"]["ramGB"]:
+            continue
+        if attempt["reason"] == "disk" and shape["disk"] > attempt["shape"]["disk"]:
+            continue
+        cost += attempt_cost(shape, attempt["hours"], preemptible)
+    return cost
+
+
+def current_shape(template: dict, prefix: str) -> dict | None:
+    """
+    Shape of a template prefix in a template.
+
+    :param template: The template JSON object
+    :param prefix: The template key prefix (e.g. msgf_)
+    :return: The shape (ncpu, ramGB, disk), or None if the template does not set it
+    """
+    ncpu = template.get(f"{WF_PREFIX}{prefix}ncpu")
+    ram = template.get(f"{WF_PREFIX}{prefix}ramGB")
+    if ncpu is None or ram is None:
+        return None
+    disk = template.get(f"{WF_PREFIX}{prefix}disk")
+    return {"ncpu": ncpu, "ramGB": ram, "disk": disk or DEFAULT_DISK_GB}
+
+
+def validate_template(path: Path) -> None:
+    """
+    Validates a template with the models used to build the parameter mapping
+
+    :param path: Path to the template JSON file
+    :raise: ValidationError
+    """
+    parse_inputs_file(path)
+    with path.open("r") as f_obj:
+        DockerImages.model_validate_json(f_obj.read())
+
+
+def create_arguments():
+    parser = argparse.ArgumentParser(
+        description="Recommend right-sized resources for the msgfplus templates "
+        "from past runs"
+    )
+    parser.add_argument(
+        "-g", "--gcp_project", required=True, type=str, help="GCP project name"
+    )
+    parser.add_argument(
+        "-b",
+        "--bucket_origin",
+        required=True,
+        type=str,
+        help="Bucket with the workflow output files",
+    )
+    parser.add_argument(
+        "-r",
+        "--results_folder",
+        required=True,
+        type=str,
+        help="Path to the results folder (e.g. results/proteomics_msgfplus)",
+    )
+    parser.add_argument(
+        "-i",
+        "--caper_job_id",
+        required=False,
+        nargs="+",
+        type=str,
+        help="Caper job ids of past runs (default: all the jobs in the results folder)",
+    )
+    parser.add_argument(
+        "-t",
+        "--templates_folder",
+        required=False,
+        type=str,
+        default=str(TEMPLATE_DIR),
+        help=f"Folder with the msgfplus templates. Default: {TEMPLATE_DIR}",
+    )
+    parser.add_argument(
+        "-o",
+        "--output_folder",
+        required=False,
+        type=str,
+        help="Folder to write the updated templates to (use the templates folder to "
+        "update them in place). If not provided, only the recommendations are printed",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        required=False,
+        type=int,
+        default=16,
+        help="Number of metadata files downloaded concurrently. Default: 16",
+    )
+    profiling.add_argument(parser)
+    return parser
+
+
+def main():
+    parser = create_arguments()
+    args = parser.parse_args()
+    profiling.start(args.profile)
+
+    storage_client = get_storage_client(args.gcp_project, args.workers)
+    bucket_origin = args.bucket_origin.rstrip("/")
+    bucket = storage_client.bucket(bucket_origin)
+    results_folder = args.results_folder.rstrip("/")
+
+    with profiling.span("listing"):
+        caper_job_ids = args.caper_job_id or discover_job_ids(
+            storage_client, bucket_origin, results_folder
+        )
+    with (
+        profiling.span("metadata load"),
+        ThreadPoolExecutor(max_workers=args.workers) as pool,
+    ):
+        all_metadata = [
+            m
+            for m in pool.map(
+                lambda x: load_metadata(bucket, results_folder, x), caper_job_ids
+            )
+            if m is not None
+        ]
+    print(f"+ Past runs loaded: {len(all_metadata)} of {len(caper_job_ids)}")
+
+    templates_folder = Path(args.templates_folder)
+    paths = {}
+    templates = {}
+    for path in sorted(templates_folder.glob("config-msgfplus-*.json")):
+        key, model = parse_inputs_file(path)
+        paths[key] = path
+        templates[key] = model
+
+    runs = {}
+    with profiling.span("template matching"):
+        for metadata in all_metadata:
+            key = match_template(metadata, templates)
+            if key is None:
+                print(f"+ WARNING: no template matches the parameters of {metadata.get('id')}")
+                continue
+            runs.setdefault(key, []).append(metadata)
+
+    total_before = total_after = 0.0
+    for key, metadata_list in sorted(runs.items()):
+        path = paths[key]
+        with path.open("r") as f_obj:
+            template = json.load(f_obj)
+
+        print(f"\n+ {path.name} ({len(metadata_list)} runs)")
+        print(
+            "\tprefix        attempts  oom  disk  max_h   current (cpu/GB/disk)  "
+            "recommended   cost before  cost after"
+        )
+        for prefix, usage in sorted(collect_usage(metadata_list).items()):
+            current = current_shape(template, prefix)
+            if current is None:
+                continue
+            shape = recommend(prefix, current, usage)
+            before, after = estimate_cost(usage), estimate_cost(usage, shape)
+            total_before += before
+            total_after += after
+            print(
+                f"\t{prefix:<12}  {len(usage['attempts']):>8}  {usage['oom']:>3}  "
+                f"{usage['disk']:>4}  {usage['max_hours']:>5.2f}   "
+                f"{current['ncpu']:>3}/{current['ramGB']:>3}/{current['disk']:>4}"
+                f"{'':13}{shape['ncpu']:>3}/{shape['ramGB']:>3}/{shape['disk']:>4}"
+                f"   ${before:>10.2f}  ${after:>9.2f}"
+            )
+            template[f"{WF_PREFIX}{prefix}ncpu"] = shape["ncpu"]
+            template[f"{WF_PREFIX}{prefix}ramGB"] = shape["ramGB"]
+            if f"{WF_PREFIX}{prefix}disk" in template or shape["disk"] != current["disk"]:
+                template[f"{WF_PREFIX}{prefix}disk"] = shape["disk"]
+
+        if args.output_folder is not None:
+            output_folder = Path(args.output_folder)
+            output_folder.mkdir(parents=True, exist_ok=True)
+            output_path = output_folder / path.name
+            with output_path.open("w") as outfile:
+                json.dump(template, outfile, indent=2)
+                outfile.write("\n")
+            try:
+                validate_template(output_path)
+            except ValidationError as err:
+                print(f"\n\tERROR: the updated template {output_path} is not valid")
+                raise err
+            print(f"+ Updated template: {output_path}")
+
+    print(
+        f"\n+ Estimated cost of the past runs: ${total_before:.2f} with the current "
+        f"shapes, ${total_after:.2f} with the recommended shapes"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+"""
+Persistent cache of the MS-GF+ sequence database index (the BuildSA suffix arrays
+built by the msgf_sequences task) on Google Cloud Storage.
+
+The index only depends on the content of the FASTA file and on the MS-GF+ version, so
+it is stored under
+
+    <cache location>/<FASTA md5>/<MS-GF+ version>/<FASTA name>/
+        sequencedb_files.tar.gz
+        <FASTA name>.revCat.fasta
+
+The FASTA name is part of the key because the index files are named after it. The
+MD5 comes from the blob metadata (no download), and the MS-GF+ version from the tag of
+the msgf docker image.
+
+create_config_msgfplus.py -k looks the index up and passes it to the workflow
+(msgf_sequencedb_files, msgf_revcat_fasta), which then skips msgf_sequences. This
+script stores the index built by past runs into the cache.
+"""
+
+import argparse
+import base64
+import json
+import warnings
+from pathlib import Path
+
+from gcs_client import get_storage_client
+from metadata_cache import load_json_blob
+import profiling
+
+
+warnings.filterwarnings(
+    "ignore", "Your application has authenticated using end user credentials"
+)
+
+WF_PREFIX = "proteomics_msgfplus."
+SEQUENCEDB_FILES = "sequencedb_files.tar.gz"
+
+
+def parse_gs_path(gs_path):
+    """
+    Splits a gs:// path into bucket name and object name (or folder)
+
+    :param gs_path: The gs://bucket/path location
+    :return: The bucket name and the path (without trailing slash)
+    :rtype: tuple[str, str]
+    """
+    bucket_name, _, name = gs_path.removeprefix("gs://").partition("/")
+    return bucket_name, name.rstrip("/")
+
+
+def fasta_hash(blob):
+    """
+    Content hash of a FASTA blob, taken from its metadata. Composite objects have no
+    MD5, their CRC32C is used instead.
+
+    :param blob: The FASTA blob (from get_blob)
+    :return: The hex digest
+    :rtype: str
+    """
+    if blob.md5_hash:
+        return base64.b64decode(blob.md5_hash).hex()
+    return "crc32c-" + base64.b64decode(blob.crc32c).hex()
+
+
+def msgf_version(docker):
+    """
+    MS-GF+ version of a docker image (its tag)
+
+    :param docker: The msgf docker image (e.g. .../msgfplus:v2024.03.26)
+    :return: The version (e.g. v2024.03.26)
+    :rtype: str
+    """
+    image = docker.rsplit("/", 1)[-1]
+    if "@" in image:
+        return image.split("@", 1)[1].replace(":", "-")[:19]
+    if ":" in image:
+        return image.split(":", 1)[1]
+    return "latest"
+
+
+def cache_folder(cache_location, fasta_blob, msgf_docker):
+    """
+    Location of the index of a FASTA file built with a MS-GF+ version
+
+    :param cache_location: The cache location (gs://bucket/folder)
+    :param fasta_blob: The FASTA blob (from get_blob)
+    :param msgf_docker: The msgf docker image
+    :return: The cache folder (gs://bucket/folder/<md5>/<version>/<fasta name>)
+    :rtype: str
+    """
+    return (
+        f"{cache_location.rstrip('/')}/{fasta_hash(fasta_blob)}/"
+        f"{msgf_version(msgf_docker)}/{Path(fasta_blob.name).stem}"
+    )
+
+
+def cached_files(fasta_blob):
+    """
+    Workflow inputs and file names of a cached index
+
+    :param fasta_blob: The FASTA blob
+    :return: Mapping of workflow input to file name
+    :rtype: dict[str, str]
+    """
+    return {
+        "msgf_sequencedb_files": SEQUENCEDB_FILES,
+        "msgf_revcat_fasta": f"{Path(fasta_blob.name).stem}.revCat.fasta",
+    }
+
+
+def get_fasta_blob(storage_client, fasta_sequence_db):
+    """
+    Gets the FASTA blob (metadata only)
+
+    :param storage_client: The storage client
+    :param fasta_sequence_db: The FASTA file location (gs://bucket/path.fasta)
+    :return: The blob
+    :raise: FileNotFoundError
+    """
+    bucket_name, name = parse_gs_path(fasta_sequence_db)
+    blob = storage_client.bucket(bucket_name).get_blob(name)
+    if blob is None:
+        raise FileNotFoundError(f"ERROR: sequence db {fasta_sequence_db} not found")
+    return blob
+
+
+def lookup(storage_client, cache_location, fasta_sequence_db, msgf_docker):
+    """
+    Looks up the index of a FASTA file in the cache
+
+    :param storage_client: The storage client
+    :param cache_location: The cache location (gs://bucket/folder)
+    :param fasta_sequence_db: The FASTA file location (gs://bucket/path.fasta)
+    :param msgf_docker: The msgf docker image
+    :return: The workflow inputs (without prefix) of the cached index, None if missing
+    :rtype: dict[str, str] | None
+    """
+    fasta_blob = get_fasta_blob(storage_client, fasta_sequence_db)
+    folder = cache_folder(cache_location, fasta_blob, msgf_docker)
+    bucket_name, prefix = parse_gs_path(folder)
+    bucket = storage_client.bucket(bucket_name)
+
+    inputs = {}
+    for key, file_name in cached_files(fasta_blob).items():
+        if bucket.get_blob(f"{prefix}/{file_name}") is None:
+            return None
+        inputs[key] = f"{folder}/{file_name}"
+    return inputs
+
+
+def store(storage_client, cache_location, metadata):
+    """
+    Stores the index built by the msgf_sequences task of a run into the cache
+
+    :param storage_client: The storage client
+    :param cache_location: The cache location (gs://bucket/folder)
+    :param metadata: The workflow metadata.json object
+    :return: The cache folder, None if the run did not build an index
+    :rtype: str | None
+    """
+    attempts = [
+        x
+        for x in metadata.get("calls", {}).get(f"{WF_PREFIX}msgf_sequences", [])
+        if x.get("executionStatus") == "Done"
+    ]
+    if not attempts:
+        return None
+    outputs = attempts[-1]["outputs"]
+    inputs = {k.removeprefix(WF_PREFIX): v for k, v in metadata["inputs"].items()}
+
+    fasta_blob = get_fasta_blob(storage_client, inputs["fasta_sequence_db"])
+    folder = cache_folder(cache_location, fasta_blob, inputs["msgf_docker"])
+    bucket_name, prefix = parse_gs_path(folder)
+    cache_bucket = storage_client.bucket(bucket_name)
+
+    sources = {
+        "msgf_sequencedb_files": outputs["sequencedb_files"],
+        "msgf_revcat_fasta": outputs["revcat_fasta"],
+    }
+    for key, file_name in cached_files(fasta_blob).items():
+        if cache_bucket.get_blob(f"{prefix}/{file_name}") is not None:
+            continue
+        source_bucket_name, source_name = parse_gs_path(sources[key])
+        source_bucket = storage_client.bucket(source_bucket_name)
+        source_bucket.copy_blob(
+            source_bucket.blob(source_name), cache_bucket, f"{prefix}/{file_name}"
+        )
+
+    cache_bucket.blob(f"{prefix}/manifest.json").upload_from_string(
+        json.dumps(
+            {
+                "fasta_sequence_db": inputs["fasta_sequence_db"],
+                "fasta_hash": fasta_hash(fasta_blob),
+                "msgf_docker": inputs["msgf_docker"],
+                "workflow_id": metadata.get("id"),
+            },
+            indent=4,
+        ),
+        content_type="application/json",
+    )
+    return folder
+
+
+def create_arguments():
+    parser = argparse.ArgumentParser(
+        description="Store the MS-GF+ sequence db index built by past runs into the "
+        "sequence db cache"
+    )
+    parser.add_argument(
+        "-g", "--gcp_project", required=True, type=str, help="GCP project name"
+    )
+    parser.add_argument(
+        "-k",
+        "--sequence_db_cache",
+        required=True,
+        type=str,
+        help="Sequence db cache location (e.g. gs://bucket/msgfplus-sequence-db-cache)",
+    )
+    parser.add_argument(
+        "-b",
+        "--bucket_origin",
+        required=True,
+        type=str,
+        help="Bucket with the workflow output files",
+    )
+    parser.add_argument(
+        "-r",
+        "--results_folder",
+        required=True,
+        type=str,
+        help="Path to the results folder (e.g. results/proteomics_msgfplus)",
+    )
+    parser.add_argument(
+        "-i",
+        "--caper_job_id",
+        required=True,
+        nargs="+",
+        type=str,
+        help="Caper job ids of the runs that built the index",
+    )
+    profiling.add_argument(parser)
+    return parser
+
+
+def main():
+    parser = create_arguments()
+    args = parser.parse_args()
+    profiling.start(args.profile)
+
+    storage_client = get_storage_client(args.gcp_project)
+    bucket = storage_client.bucket(args.bucket_origin.rstrip("/"))
+    results_folder = args.results_folder.rstrip("/")
+
+    for caper_job_id in args.caper_job_id:
+        blob = bucket.get_blob(f"{results_folder}/{caper_job_id}/metadata.json")
+        if blob is None:
+            print(f"+ WARNING: metadata.json not found for job {caper_job_id}")
+            continue
+        metadata = load_json_blob(blob)
+        with profiling.span("cache store"):
+            folder = store(storage_client, args.sequence_db_cache, metadata)
+        if folder is None:
+            print(f"+ Job {caper_job_id} did not build a sequence db index (skipped)")
+        else:
+            print(f"+ Job {caper_job_id}: sequence db index cached in {folder}")
+
+
+if __name__ == "__main__":
+    main()
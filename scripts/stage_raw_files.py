@@ -0,0 +1,349 @@
+"""
+Uploads a local folder of raw files to the bucket folder that the pipeline reads them
+from (folder_raw), and writes the manifest of the uploaded files for the config
+generators (create_config_msgfplus.py and create_config_maxquant.py --raw_manifest).
+
+Several files are uploaded at the same time. Files larger than COMPONENT_BYTES are
+uploaded as parallel composite uploads: their slices are uploaded concurrently as
+temporary objects (<folder>/.staging/<file>/<n>) and composed into the final object,
+which is checked against the CRC32C of the local file before the slices are deleted.
+Composite objects have no MD5 hash: the MD5 of the file is computed locally and
+stored in the custom metadata of the object (md5, hexadecimal), where
+generate_file_manifest.py reads it.
+An interrupted upload is resumed by running the same command again: the files already
+in the bucket with the same size and CRC32C are skipped, and so are the slices already
+uploaded.
+"""
+
+import argparse
+import base64
+import csv
+import fnmatch
+import hashlib
+import math
+import sys
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import google_crc32c
+from google.api_core.exceptions import GoogleAPICallError
+from google.cloud.storage import Blob, Bucket
+
+from gcs_client import DEFAULT_MAX_WORKERS, get_storage_client
+import profiling
+
+warnings.filterwarnings(
+    "ignore", "Your application has authenticated using end user credentials"
+)
+
+COMPONENT_BYTES = 256 * 1024**2
+# objects composed in a single request
+MAX_COMPONENTS = 32
+READ_CHUNK_BYTES = 8 * 1024**2
+STAGING_FOLDER = ".staging"
+MANIFEST_COLUMNS = ["raw_file", "size", "crc32c"]
+
+
+def range_crc32c(path: Path, start: int = 0, length: int | None = None) -> str:
+    """
+    CRC32C of (a range of) a local file, encoded as in the object metadata.
+
+    :param path: The file
+    :param start: The first byte of the range
+    :param length: The length of the range (default: to the end of the file)
+    :return: The base64 encoded CRC32C
+    """
+    checksum = google_crc32c.Checksum()
+    remaining = length if length is not None else math.inf
+    with open(path, "rb") as f:
+        f.seek(start)
+        while remaining > 0:
+            chunk = f.read(int(min(READ_CHUNK_BYTES, remaining)))
+            if not chunk:
+                break
+            checksum.update(chunk)
+            remaining -= len(chunk)
+    return base64.b64encode(checksum.digest()).decode("utf-8")
+
+
+def file_hashes(path: Path) -> tuple[str, str]:
+    """
+    CRC32C and MD5 of a local file, read once.
+
+    :param path: The file
+    :return: The base64 encoded CRC32C (as in the object metadata) and the
+        hexadecimal MD5
+    """
+    checksum, md5 = google_crc32c.Checksum(), hashlib.md5()
+    with open(path, "rb") as f:
+        while chunk := f.read(READ_CHUNK_BYTES):
+            checksum.update(chunk)
+            md5.update(chunk)
+    return base64.b64encode(checksum.digest()).decode("utf-8"), md5.hexdigest()
+
+
+def _upload_component(
+    bucket: Bucket, path: Path, name: str, start: int, length: int, existing: Blob | None
+) -> Blob:
+    crc32c = range_crc32c(path, start, length)
+    if existing is not None and existing.size == length and existing.crc32c == crc32c:
+        return existing
+    blob = bucket.blob(name)
+    with open(path, "rb") as f:
+        f.seek(start)
+        blob.upload_from_file(f, size=length, checksum="crc32c")
+    return blob
+
+
+def upload_raw_file(
+    bucket: Bucket,
+    path: Path,
+    blob_name: str,
+    component_pool: ThreadPoolExecutor,
+    component_bytes: int = COMPONENT_BYTES,
+) -> dict:
+    """
+    Uploads a file, as a parallel composite upload if it is larger than
+    <component_bytes>, unless it is already in the bucket.
+
+    :param bucket: The destination bucket
+    :param path: The local file
+    :param blob_name: The object name
+    :param component_pool: The threads uploading the slices
+    :param component_bytes: The minimum size of a slice
+    :return: The manifest entry (raw_file, size, crc32c), the number of components
+        uploaded (0 if the file was already in the bucket) and the upload seconds
+    :raise: ValueError if the uploaded object does not match the CRC32C of the file
+    """
+    start_time = time.perf_counter()
+    size = path.stat().st_size
+    crc32c, md5 = file_hashes(path)
+    entry = {"raw_file": f"gs://{bucket.name}/{blob_name}", "size": size, "crc32c": crc32c}
+
+    blob = bucket.get_blob(blob_name)
+    if blob is not None and blob.size == size and blob.crc32c == crc32c:
+        if blob.md5_hash is None and not (blob.metadata or {}).get("md5"):
+            # composed by an earlier version of this script
+            blob.metadata = {"md5": md5}
+            blob.patch()
+        return {**entry, "components": 0, "seconds": 0.0}
+
+    blob = bucket.blob(blob_name)
+    if size <= component_bytes:
+        components = 1
+        blob.upload_from_filename(str(path), checksum="crc32c")
+    else:
+        slice_bytes = max(component_bytes, math.ceil(size / MAX_COMPONENTS))
+        starts = range(0, size, slice_bytes)
+        components = len(starts)
+        folder, _, _ = blob_name.rpartition("/")
+        staging = f"{folder}/" if folder else ""
+        staging += f"{STAGING_FOLDER}/{path.name}/"
+        existing = {x.name: x for x in bucket.list_blobs(prefix=staging)}
+        futures = [
+            component_pool.submit(
+                _upload_component,
+                bucket,
+                path,
+                f"{staging}{i:02d}",
+                start,
+                min(slice_bytes, size - start),
+                existing.get(f"{staging}{i:02d}"),
+            )
+            for i, start in enumerate(starts)
+        ]
+        sources = [future.result() for future in futures]
+        blob.content_type = "application/octet-stream"
+        # a composite object has no MD5 hash
+        blob.metadata = {"md5": md5}
+        blob.compose(sources)
+
+    if blob.crc32c != crc32c:
+        raise ValueError(f"CRC32C mismatch after uploading gs://{bucket.name}/{blob_name}")
+    if components > 1:
+        for source in sources:
+            source.delete()
+    return {**entry, "components": components, "seconds": time.perf_counter() - start_time}
+
+
+def write_raw_manifest(entries: list[dict], manifest: str) -> None:
+    """
+    Writes the manifest of the uploaded raw files (comma separated: raw_file, size,
+    crc32c).
+
+    :param entries: The manifest entries (from upload_raw_file)
+    :param manifest: The local manifest file
+    """
+    Path(manifest).parent.mkdir(parents=True, exist_ok=True)
+    with open(manifest, "w", newline="") as outfile:
+        writer = csv.DictWriter(outfile, fieldnames=MANIFEST_COLUMNS, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(sorted(entries, key=lambda x: x["raw_file"]))
+
+
+def read_raw_manifest(manifest: str) -> list[dict]:
+    """
+    Reads the manifest of the raw files written by this script.
+
+    :param manifest: The local manifest file
+    :return: A dict per raw file with its gs:// location (raw_file), size and crc32c
+    :raise: ValueError if the manifest is empty or its columns are not the expected ones
+    """
+    with open(manifest, newline="") as infile:
+        reader = csv.DictReader(infile)
+        if reader.fieldnames is None or not set(MANIFEST_COLUMNS) <= set(reader.fieldnames):
+            raise ValueError(
+                f"{manifest} is not a raw file manifest (columns: {', '.join(MANIFEST_COLUMNS)})"
+            )
+        entries = [{**row, "size": int(row["size"])} for row in reader]
+    if not entries:
+        raise ValueError(f"No raw files in the manifest {manifest}")
+    return entries
+
+
+def create_arguments():
+    parser = argparse.ArgumentParser(
+        description="Upload a local folder of raw files to GCS (parallel composite "
+        "uploads, resumable) and write the manifest for the config generators"
+    )
+    parser.add_argument(
+        "-g", "--gcp_project", required=True, type=str, help="GCP project name"
+    )
+    parser.add_argument(
+        "-l",
+        "--local_folder",
+        required=True,
+        type=str,
+        help="Local folder with the raw files",
+    )
+    parser.add_argument(
+        "-d",
+        "--destination",
+        required=True,
+        type=str,
+        help="Raw file folder on GCS (e.g. gs://my-bucket/raw/study-x/)",
+    )
+    parser.add_argument(
+        "-m",
+        "--manifest",
+        required=False,
+        type=str,
+        default="raw_manifest.csv",
+        help="Manifest of the uploaded files, for the config generators "
+        "(--raw_manifest). Default: raw_manifest.csv",
+    )
+    parser.add_argument(
+        "-p",
+        "--pattern",
+        required=False,
+        type=str,
+        default="*.raw",
+        help="File name pattern of the raw files. Default: *.raw",
+    )
+    parser.add_argument(
+        "-n",
+        "--parallel_files",
+        required=False,
+        type=int,
+        default=4,
+        help="Number of files uploaded at the same time. Default: 4",
+    )
+    parser.add_argument(
+        "-w",
+        "--max_workers",
+        required=False,
+        type=int,
+        default=DEFAULT_MAX_WORKERS,
+        help="Number of threads uploading the slices of the large files. "
+        f"Default: {DEFAULT_MAX_WORKERS}",
+    )
+    parser.add_argument(
+        "-c",
+        "--component_mb",
+        required=False,
+        type=int,
+        default=COMPONENT_BYTES // 1024**2,
+        help="Files larger than this (MB) are uploaded in slices of at least this "
+        f"size (at most {MAX_COMPONENTS} slices). Default: {COMPONENT_BYTES // 1024**2}",
+    )
+    profiling.add_argument(parser)
+    return parser
+
+
+def main():
+    parser = create_arguments()
+    args = parser.parse_args()
+    profiling.start(args.profile)
+
+    bucket_name, _, folder = args.destination.removeprefix("gs://").partition("/")
+    folder = folder.strip("/")
+    paths = sorted(
+        x
+        for x in Path(args.local_folder).iterdir()
+        if x.is_file() and fnmatch.fnmatch(x.name, args.pattern)
+    )
+    if not paths:
+        sys.exit(f"ERROR: No {args.pattern} files found in {args.local_folder}")
+
+    total_bytes = sum(x.stat().st_size for x in paths)
+    print("\nSTAGE RAW FILES")
+    print("---------------")
+    print("+ Local folder: ", args.local_folder)
+    print(f"+ Raw files: {len(paths)} ({total_bytes / 1024**3:.1f} GB)")
+    print(f"+ Destination: gs://{bucket_name}/{folder}")
+
+    client = get_storage_client(args.gcp_project, args.max_workers + args.parallel_files)
+    bucket = client.bucket(bucket_name)
+    start_time = time.perf_counter()
+    entries, errors = [], []
+    with (
+        profiling.span("upload"),
+        ThreadPoolExecutor(max_workers=args.max_workers) as component_pool,
+    ):
+        with ThreadPoolExecutor(max_workers=args.parallel_files) as file_pool:
+            futures = {
+                path: file_pool.submit(
+                    upload_raw_file,
+                    bucket,
+                    path,
+                    f"{folder}/{path.name}" if folder else path.name,
+                    component_pool,
+                    args.component_mb * 1024**2,
+                )
+                for path in paths
+            }
+            for path, future in futures.items():
+                try:
+                    entry = future.result()
+                except (GoogleAPICallError, ValueError, OSError) as e:
+                    print(f"\t- ERROR: {path.name}: {e}")
+                    errors.append(path.name)
+                    continue
+                entries.append(entry)
+                if entry["components"] == 0:
+                    print(f"\t- {path.name}: already uploaded")
+                else:
+                    print(
+                        f"\t- {path.name}: {entry['size'] / 1024**3:.2f} GB, "
+                        f"{entry['components']} component(s), {entry['seconds']:.0f} s"
+                    )
+
+    seconds = time.perf_counter() - start_time
+    uploaded = sum(x["size"] for x in entries if x["components"])
+    print(
+        f"+ Uploaded {uploaded / 1024**3:.1f} GB in {seconds:.0f} s "
+        f"({uploaded / 1024**2 / max(seconds, 1e-9):.0f} MB/s)"
+    )
+    if errors:
+        sys.exit(
+            f"ERROR: {len(errors)} file(s) failed. Run the same command again to resume"
+        )
+    with profiling.span("manifest"):
+        write_raw_manifest(entries, args.manifest)
+    print("+ Manifest: ", args.manifest)
+
+
+if __name__ == "__main__":
+    main()
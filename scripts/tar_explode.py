@@ -0,0 +1,176 @@
+"""
+Explodes the tar.gz archives of the pipeline outputs (the MASIC, PHRP and AScore
+inputs of PlexedPiper packaged by wrapper_pp) into individual objects, without
+downloading them to the local disk.
+
+The archive is read from the bucket as a stream and decompressed on the fly
+(tarfile "r|gz"), and every member is uploaded as its own object while the next ones
+are read. Members up to STREAM_MEMBER_BYTES are read into memory and uploaded by a
+pool of threads, with at most MAX_BUFFERED_BYTES waiting to be uploaded. The pool
+and the byte budget can be shared by the archives exploded at the same time. Larger
+members are uploaded while they are read. A manifest (<archive>_manifest.csv) lists
+the members with their size, MD5 and CRC32C.
+"""
+
+import base64
+import hashlib
+import tarfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import google_crc32c
+from google.cloud.storage import Blob, Bucket
+
+from gcs_client import DEFAULT_MAX_WORKERS
+
+# Archives among the outputs of wrapper_pp
+TAR_OUTPUTS = {
+    "final_output_masic_tar",
+    "final_output_phrp_tar",
+    "final_output_ascore",
+}
+
+STREAM_MEMBER_BYTES = 64 * 1024**2
+MAX_BUFFERED_BYTES = 512 * 1024**2
+READ_CHUNK_BYTES = 8 * 1024**2
+
+
+class ByteBudget:
+    """Blocks the readers while too many bytes are waiting to be uploaded."""
+
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self.used = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, size: int) -> None:
+        with self._condition:
+            # a member larger than the limit waits for all the others
+            while self.used and self.used + size > self.limit:
+                self._condition.wait()
+            self.used += size
+
+    def release(self, size: int) -> None:
+        with self._condition:
+            self.used -= size
+            self._condition.notify_all()
+
+
+def exploded_folder(archive_name: str) -> str:
+    """
+    Folder of the members of an archive (its name without the .tar.gz extension).
+
+    :param archive_name: The archive file name or path
+    :return: The folder name or path
+    """
+    for extension in (".tar.gz", ".tgz", ".tar"):
+        if archive_name.endswith(extension):
+            return archive_name.removesuffix(extension)
+    return archive_name
+
+
+def _upload_member(blob: Blob, data: bytes) -> None:
+    blob.upload_from_string(
+        data, content_type="application/octet-stream", checksum="crc32c"
+    )
+
+
+def _stream_member(blob: Blob, member_file, md5, crc32c) -> None:
+    with blob.open("wb", ignore_flush=True) as out:
+        while chunk := member_file.read(READ_CHUNK_BYTES):
+            md5.update(chunk)
+            crc32c.update(chunk)
+            out.write(chunk)
+    blob.reload()
+    if blob.crc32c != base64.b64encode(crc32c.digest()).decode("utf-8"):
+        raise ValueError(f"CRC32C mismatch after uploading gs://{blob.bucket.name}/{blob.name}")
+
+
+def explode_archive(
+    archive_blob: Blob,
+    destination_bucket: Bucket,
+    destination_folder: str,
+    max_workers: int = DEFAULT_MAX_WORKERS,
+    pool: ThreadPoolExecutor | None = None,
+    budget: ByteBudget | None = None,
+) -> list[dict]:
+    """
+    Uploads the files of a tar.gz archive as individual objects.
+
+    :param archive_blob: The archive
+    :param destination_bucket: The bucket to upload the files to
+    :param destination_folder: The folder to upload the files to (the paths of the
+        files inside the archive are kept)
+    :param max_workers: The number of upload threads, if no pool is given
+    :param pool: The upload threads, shared with other archives (default: a pool of
+        max_workers threads for this archive)
+    :param budget: The bytes waiting to be uploaded, shared with other archives
+        (default: MAX_BUFFERED_BYTES for this archive)
+    :return: The manifest: a dict per file with its name, size, md5 and crc32c
+    """
+    destination_folder = destination_folder.rstrip("/")
+    budget = budget or ByteBudget(MAX_BUFFERED_BYTES)
+    own_pool = pool is None
+    if own_pool:
+        pool = ThreadPoolExecutor(max_workers=max_workers)
+    manifest = []
+    futures: list[Future] = []
+
+    try:
+        with archive_blob.open("rb", chunk_size=READ_CHUNK_BYTES) as raw:
+            with tarfile.open(fileobj=raw, mode="r|gz") as archive:
+                for member in archive:
+                    if not member.isfile():
+                        continue
+                    name = member.name.removeprefix("./")
+                    blob = destination_bucket.blob(f"{destination_folder}/{name}")
+                    member_file = archive.extractfile(member)
+                    md5, crc32c = hashlib.md5(), google_crc32c.Checksum()
+
+                    if member.size > STREAM_MEMBER_BYTES:
+                        _stream_member(blob, member_file, md5, crc32c)
+                    else:
+                        data = member_file.read()
+                        md5.update(data)
+                        crc32c.update(data)
+                        budget.acquire(len(data))
+                        future = pool.submit(_upload_member, blob, data)
+                        future.add_done_callback(
+                            lambda _, size=len(data): budget.release(size)
+                        )
+                        futures.append(future)
+
+                    manifest.append(
+                        {
+                            "file_name": name,
+                            "size": member.size,
+                            "md5": md5.hexdigest(),
+                            "crc32c": crc32c.digest().hex(),
+                        }
+                    )
+        # raise the first upload error, if any
+        for future in futures:
+            future.result()
+    finally:
+        if own_pool:
+            pool.shutdown(wait=True)
+
+    return manifest
+
+
+def upload_manifest(
+    manifest: list[dict], destination_bucket: Bucket, manifest_name: str
+) -> None:
+    """
+    Uploads the manifest of an exploded archive as a comma separated file.
+
+    :param manifest: The manifest (from explode_archive)
+    :param destination_bucket: The bucket
+    :param manifest_name: The path of the manifest file
+    """
+    data = "file_name,size,md5,crc32c\n"
+    for entry in manifest:
+        data += f"{entry['file_name']},{entry['size']},{entry['md5']},{entry['crc32c']}\n"
+    destination_bucket.blob(manifest_name).upload_from_string(
+        data, content_type="text/csv"
+    )
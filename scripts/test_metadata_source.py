@@ -0,0 +1,168 @@
+"""
+Tests of the Cromwell metadata source against a stub of the Cromwell REST API
+(python -m pytest scripts/test_metadata_source.py).
+"""
+
+import gzip
+import json
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from metadata_source import (
+    CromwellMetadataSource,
+    FileMetadataSource,
+    open_metadata_source,
+    query_workflows,
+)
+
+WORKFLOWS = {
+    f"wf{i}": {
+        "id": f"wf{i}",
+        "workflowName": "proteomics_msgfplus",
+        "status": "Succeeded",
+        "submittedFiles": {"workflow": "version 1.0"},
+        "calls": {
+            "proteomics_msgfplus.msconvert": [
+                {
+                    "shardIndex": 0,
+                    "attempt": 1,
+                    "executionStatus": "Done",
+                    "commandLine": "msconvert a.raw",
+                    "outputs": {"mzml": "gs://bucket/a.mzML"},
+                }
+            ]
+        },
+    }
+    for i in range(7)
+}
+
+
+def _filter_keys(metadata, include, exclude, top=True):
+    # the key filtering of Cromwell, at the workflow and call levels
+    filtered = {}
+    for key, value in metadata.items():
+        if key == "calls":
+            filtered[key] = {
+                call: [_filter_keys(x, include, exclude, False) for x in attempts]
+                for call, attempts in value.items()
+            }
+        elif include and any(key.startswith(x) for x in include):
+            filtered[key] = value
+        elif not include and key not in exclude:
+            filtered[key] = value
+        elif top and key == "id":
+            filtered[key] = value
+    return filtered
+
+
+class StubCromwellHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        self.server.requests.append((url.path, query, self.headers.get("Accept-Encoding")))
+        parts = url.path.split("/")
+        if url.path == "/api/workflows/v1/query":
+            page, size = int(query["page"][0]), int(query["pageSize"][0])
+            ids = sorted(WORKFLOWS)
+            body = {
+                "results": [{"id": x} for x in ids[(page - 1) * size : page * size]],
+                "totalResultsCount": len(ids),
+            }
+        elif parts[-1] == "metadata" and parts[-2] in WORKFLOWS:
+            body = _filter_keys(
+                WORKFLOWS[parts[-2]],
+                query.get("includeKey", []),
+                query.get("excludeKey", []),
+            )
+        else:
+            self.send_response(404)
+            self.end_headers()
+            return
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        if "gzip" in (self.headers.get("Accept-Encoding") or ""):
+            data = gzip.compress(data)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class CromwellMetadataSourceTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), StubCromwellHandler)
+        cls.server.requests = []
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = f"http://127.0.0.1:{cls.server.server_port}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.requests.clear()
+
+    def test_query_reads_all_pages(self):
+        workflows = query_workflows(self.url, names=["proteomics_msgfplus"], page_size=3)
+        self.assertEqual([x["id"] for x in workflows], sorted(WORKFLOWS))
+        pages = [query["page"] for _, query, _ in self.server.requests]
+        self.assertEqual(pages, [["1"], ["2"], ["3"]])
+        self.assertEqual(self.server.requests[0][1]["name"], ["proteomics_msgfplus"])
+
+    def test_include_keys(self):
+        source = CromwellMetadataSource(self.url, "wf1", include_keys=["status", "outputs"])
+        metadata = source.load()
+        self.assertEqual(metadata["status"], "Succeeded")
+        self.assertNotIn("submittedFiles", metadata)
+        attempt = metadata["calls"]["proteomics_msgfplus.msconvert"][0]
+        self.assertEqual(attempt, {"outputs": {"mzml": "gs://bucket/a.mzML"}})
+        _, query, _ = self.server.requests[0]
+        self.assertEqual(query["includeKey"], ["status", "outputs"])
+        self.assertNotIn("excludeKey", query)
+
+    def test_exclude_keys(self):
+        source = CromwellMetadataSource(
+            self.url, "wf2", exclude_keys=["submittedFiles", "commandLine"]
+        )
+        metadata = source.load()
+        self.assertNotIn("submittedFiles", metadata)
+        self.assertEqual(metadata["workflowName"], "proteomics_msgfplus")
+        attempt = metadata["calls"]["proteomics_msgfplus.msconvert"][0]
+        self.assertNotIn("commandLine", attempt)
+        self.assertEqual(attempt["executionStatus"], "Done")
+
+    def test_include_and_exclude_keys(self):
+        with self.assertRaises(ValueError):
+            CromwellMetadataSource(self.url, "wf1", ["status"], ["calls"])
+
+    def test_gzip(self):
+        metadata = CromwellMetadataSource(self.url, "wf3").load()
+        self.assertEqual(metadata["id"], "wf3")
+        self.assertIn("gzip", self.server.requests[0][2])
+
+    def test_unknown_workflow(self):
+        with self.assertRaises(FileNotFoundError):
+            CromwellMetadataSource(self.url, "unknown").load()
+
+    def test_open_metadata_source(self):
+        source = open_metadata_source(f"{self.url}/api/workflows/v1/wf4/metadata")
+        self.assertEqual((source.server, source.workflow_id), (self.url, "wf4"))
+        source = open_metadata_source(self.url, "wf5", ["status"])
+        metadata = source.load()
+        self.assertEqual((metadata["id"], metadata["status"]), ("wf5", "Succeeded"))
+        self.assertNotIn("workflowName", metadata)
+        self.assertIsInstance(open_metadata_source("metadata.json"), FileMetadataSource)
+        with self.assertRaises(ValueError):
+            open_metadata_source(self.url)
+
+
+if __name__ == "__main__":
+    unittest.main()